@@ -36,6 +36,8 @@ from plcopen.BlockInstanceCollector import BlockInstanceCollector
 from plcopen.InstanceTagnameCollector import InstanceTagnameCollector
 from plcopen.InstancesPathCollector import InstancesPathCollector
 from plcopen.POUVariablesCollector import POUVariablesCollector
+from plcopen.ProjectSearchIndex import ProjectSearchIndex
+from plcopen.ProjectSnapshot import ProjectSnapshotStore
 from plcopen.VariableInfoCollector import VariableInfoCollector
 from plcopen.types_enums import ITEM_PROJECT, DATA_TYPES, ITEM_DATATYPES, FUNCTIONS, ITEM_FUNCTION, FUNCTION_BLOCKS, \
     ITEM_FUNCTIONBLOCK, PROGRAMS, ITEM_PROGRAM, ITEM_DATATYPE, ITEM_POU, ITEM_TRANSITION, TRANSITIONS, ITEM_ACTION, \
@@ -158,11 +160,14 @@ class PLCControler(object):
         self.Project = None
         self.ProjectBufferEnabled = True
         self.ProjectBuffer = None
+        self.ProjectSnapshots = None
+        self.ProjectSearchIndex = None
         self.ProjectSaved = True
         self.Buffering = False
         self.FilePath = ""
         self.FileName = ""
         self.ProgramChunks = []
+        self.ProgramGenerationCache = {}
         self.ProgramOffset = 0
         self.NextCompiledProject = None
         self.CurrentCompiledProject = None
@@ -456,7 +461,8 @@ class PLCControler(object):
         warnings = []
         if self.Project is not None:
             try:
-                self.ProgramChunks = GenerateCurrentProgram(self, self.Project, errors, warnings, logger=logger)
+                self.ProgramChunks = GenerateCurrentProgram(self, self.Project, errors, warnings, logger=logger,
+                                                           cache=self.ProgramGenerationCache)
                 self.NextCompiledProject = self.Copy(self.Project)
                 program_text = "".join([item[0] for item in self.ProgramChunks])
                 if filepath is not None:
@@ -2786,7 +2792,8 @@ class PLCControler(object):
             return tasks_data, instances_data
 
     def OpenXMLFile(self, filepath):
-        self.Project, error = LoadProject(filepath)
+        # graphical bodies are parsed on first access
+        self.Project, error = LoadProject(filepath, lazy=True)
         if self.Project is None:
             print(_("Project file syntax error:\n\n") + error)
             return _("Project file syntax error:\n\n") + error
@@ -2822,7 +2829,11 @@ class PLCControler(object):
     # -------------------------------------------------------------------------------
 
     def SearchInProject(self, criteria):
-        project_matches = self.Project.Search(criteria)
+        if self.ProjectSearchIndex is not None:
+            project_matches = self.ProjectSearchIndex.Search(
+                criteria, self.GetProjectState())
+        else:
+            project_matches = self.Project.Search(criteria)
         ctn_matches = self.CTNSearch(criteria)
         return project_matches + ctn_matches
 
@@ -2839,6 +2850,32 @@ class PLCControler(object):
             return search_results
         return []
 
+    def GetProjectState(self):
+        """Return snapshot of current project state"""
+        if self.Buffering:
+            # project changed since last buffered state
+            return self.ProjectSnapshots.Snapshot(self.Project)
+        return self.ProjectBuffer.Current()
+
+    def GetProjectSearchIndex(self):
+        """Return search index following current project state"""
+        if self.ProjectSearchIndex is not None:
+            index = self.ProjectSearchIndex
+            index.Update(self.GetProjectState())
+        else:
+            # no undo buffer, index project only for this query
+            index = ProjectSearchIndex(ProjectSnapshotStore())
+            index.Update(index.Snapshots.Snapshot(self.Project))
+        return index
+
+    def FindReferencesInProject(self, name):
+        """Return tagnames of project elements referring to an identifier"""
+        return self.GetProjectSearchIndex().FindReferences(name)
+
+    def GetRenameImpactInProject(self, name):
+        """Return occurrences of an identifier changed by renaming it"""
+        return self.GetProjectSearchIndex().GetRenameImpact(name)
+
     # -------------------------------------------------------------------------------
     #                      Current Buffering Management Functions
     # -------------------------------------------------------------------------------
@@ -2849,9 +2886,13 @@ class PLCControler(object):
 
     def CreateProjectBuffer(self, saved):
         if self.ProjectBufferEnabled:
-            self.ProjectBuffer = UndoBuffer(PLCOpenParser.Dumps(self.Project), saved)
+            self.ProjectSnapshots = ProjectSnapshotStore()
+            self.ProjectBuffer = UndoBuffer(self.ProjectSnapshots.Snapshot(self.Project), saved)
+            self.ProjectSearchIndex = ProjectSearchIndex(self.ProjectSnapshots)
         else:
             self.ProjectBuffer = None
+            self.ProjectSnapshots = None
+            self.ProjectSearchIndex = None
             self.ProjectSaved = saved
 
     def IsProjectBufferEnabled(self):
@@ -2866,9 +2907,16 @@ class PLCControler(object):
                 current_saved = self.ProjectBuffer.IsCurrentSaved()
             self.CreateProjectBuffer(current_saved)
 
+    def _BufferProjectSnapshot(self):
+        self.ProjectBuffer.Buffering(self.ProjectSnapshots.Snapshot(self.Project))
+        # forget elements states that dropped out of undo buffer
+        self.ProjectSnapshots.Purge(self.ProjectBuffer.Buffer)
+        # reindex changed elements
+        self.ProjectSearchIndex.Update(self.ProjectBuffer.Current())
+
     def BufferProject(self):
         if self.ProjectBuffer is not None:
-            self.ProjectBuffer.Buffering(PLCOpenParser.Dumps(self.Project))
+            self._BufferProjectSnapshot()
         else:
             self.ProjectSaved = False
 
@@ -2880,7 +2928,7 @@ class PLCControler(object):
 
     def EndBuffering(self):
         if self.ProjectBuffer is not None and self.Buffering:
-            self.ProjectBuffer.Buffering(PLCOpenParser.Dumps(self.Project))
+            self._BufferProjectSnapshot()
             self.Buffering = False
 
     def MarkProjectAsSaved(self):
@@ -2900,11 +2948,15 @@ class PLCControler(object):
     def LoadPrevious(self):
         self.EndBuffering()
         if self.ProjectBuffer is not None:
-            self.Project = PLCOpenParser.Loads(self.ProjectBuffer.Previous())
+            state = self.ProjectBuffer.Previous()
+            if state is not None:
+                self.Project = self.ProjectSnapshots.Restore(self.Project, state)
 
     def LoadNext(self):
         if self.ProjectBuffer is not None:
-            self.Project = PLCOpenParser.Loads(self.ProjectBuffer.Next())
+            state = self.ProjectBuffer.Next()
+            if state is not None:
+                self.Project = self.ProjectSnapshots.Restore(self.Project, state)
 
     def GetBufferState(self):
         if self.ProjectBuffer is not None:
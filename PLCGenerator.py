@@ -21,9 +21,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import hashlib
 import operator
 import traceback
 
+from lxml import etree
+
 from plcopen import PLCOpenParser
 from plcopen.structures import *
 # Dictionary associating PLCOpen variable categories to the corresponding
@@ -104,7 +107,7 @@ class PLCGenException(Exception):
 class ProgramGenerator(object):
 
     # Create a new PCL program generator
-    def __init__(self, controler, project, errors, warnings, logger=None):
+    def __init__(self, controler, project, errors, warnings, logger=None, cache=None):
         # Keep reference of the controler and project
         self.Controler = controler
         self.Project = project
@@ -115,6 +118,12 @@ class ProgramGenerator(object):
         self.Errors = errors
         self.Warnings = warnings
         self.logger = logger
+        # Generated chunks of data types and POUs kept between generations,
+        # {key: (dependencies, program, warnings)}
+        self.Cache = cache
+        self.CacheKeysUsed = set()
+        self.TypesSignature = b""
+        self.DependenciesStack = []
 
     # Compute value according to type given
     def ComputeValue(self, value, var_type):
@@ -127,6 +136,7 @@ class ProgramGenerator(object):
 
     # Generate a data type from its name
     def GenerateDataType(self, datatype_name):
+        self.AddDependency("datatype", datatype_name)
         # Verify that data type hasn't been generated yet
         if not self.DatatypeComputed.get(datatype_name, True):
             # If not mark data type as computed
@@ -134,116 +144,122 @@ class ProgramGenerator(object):
 
             # Getting datatype model from project
             datatype = self.Project.getdataType(datatype_name)
-            tagname = ComputeDataTypeName(datatype.getname())
-            datatype_def = [("  ", ()),
-                            (datatype.getname(), (tagname, "name")),
-                            (" : ", ())]
-            basetype_content = datatype.baseType.getcontent()
-            basetype_content_type = basetype_content.getLocalTag()
-            # Data type derived directly from a user defined type
-            if basetype_content_type == "derived":
-                basetype_name = basetype_content.getname()
+            self.Program += self.GenerateCached(
+                datatype, lambda warnings: self.ComputeDataType(datatype))
+
+    # Compute declaration of a data type from its model
+    def ComputeDataType(self, datatype):
+        tagname = ComputeDataTypeName(datatype.getname())
+        datatype_def = [("  ", ()),
+                        (datatype.getname(), (tagname, "name")),
+                        (" : ", ())]
+        basetype_content = datatype.baseType.getcontent()
+        basetype_content_type = basetype_content.getLocalTag()
+        # Data type derived directly from a user defined type
+        if basetype_content_type == "derived":
+            basetype_name = basetype_content.getname()
+            self.GenerateDataType(basetype_name)
+            datatype_def += [(basetype_name, (tagname, "base"))]
+        # Data type is a subrange
+        elif basetype_content_type in ["subrangeSigned", "subrangeUnsigned"]:
+            base_type = basetype_content.baseType.getcontent()
+            base_type_type = base_type.getLocalTag()
+            # Subrange derived directly from a user defined type
+            if base_type_type == "derived":
+                basetype_name = base_type_type.getname()
                 self.GenerateDataType(basetype_name)
-                datatype_def += [(basetype_name, (tagname, "base"))]
-            # Data type is a subrange
-            elif basetype_content_type in ["subrangeSigned", "subrangeUnsigned"]:
-                base_type = basetype_content.baseType.getcontent()
-                base_type_type = base_type.getLocalTag()
-                # Subrange derived directly from a user defined type
-                if base_type_type == "derived":
-                    basetype_name = base_type_type.getname()
-                    self.GenerateDataType(basetype_name)
-                # Subrange derived directly from an elementary type
-                else:
-                    basetype_name = base_type_type
-                min_value = basetype_content.range.getlower()
-                max_value = basetype_content.range.getupper()
-                datatype_def += [(basetype_name, (tagname, "base")),
-                                 (" (", ()),
-                                 ("%s" % min_value, (tagname, "lower")),
-                                 ("..", ()),
-                                 ("%s" % max_value, (tagname, "upper")),
-                                 (")", ())]
-            # Data type is an enumerated type
-            elif basetype_content_type == "enum":
-                values = [[(value.getname(), (tagname, "value", i))]
-                          for i, value in enumerate(
-                        basetype_content.xpath("ppx:values/ppx:value",
-                                               namespaces=PLCOpenParser.NSMAP))]
-                datatype_def += [("(", ())]
-                datatype_def += JoinList([(", ", ())], values)
-                datatype_def += [(")", ())]
-            # Data type is an array
-            elif basetype_content_type == "array":
-                base_type = basetype_content.baseType.getcontent()
-                base_type_type = base_type.getLocalTag()
-                # Array derived directly from a user defined type
-                if base_type_type == "derived":
-                    basetype_name = base_type.getname()
-                    self.GenerateDataType(basetype_name)
-                # Array derived directly from an elementary type
-                else:
-                    basetype_name = base_type_type.upper()
-                dimensions = [[("%s" % dimension.getlower(), (tagname, "range", i, "lower")),
-                               ("..", ()),
-                               ("%s" % dimension.getupper(), (tagname, "range", i, "upper"))]
-                              for i, dimension in enumerate(basetype_content.getdimension())]
-                datatype_def += [("ARRAY [", ())]
-                datatype_def += JoinList([(",", ())], dimensions)
-                datatype_def += [("] OF ", ()),
-                                 (basetype_name, (tagname, "base"))]
-            # Data type is a structure
-            elif basetype_content_type == "struct":
-                elements = []
-                for i, element in enumerate(basetype_content.getvariable()):
-                    element_type = element.type.getcontent()
-                    element_type_type = element_type.getLocalTag()
-                    # Structure element derived directly from a user defined type
-                    if element_type_type == "derived":
-                        elementtype_name = element_type.getname()
-                        self.GenerateDataType(elementtype_name)
-                    elif element_type_type == "array":
-                        base_type = element_type.baseType.getcontent()
-                        base_type_type = base_type.getLocalTag()
-                        # Array derived directly from a user defined type
-                        if base_type_type == "derived":
-                            basetype_name = base_type.getname()
-                            self.GenerateDataType(basetype_name)
-                        # Array derived directly from an elementary type
-                        else:
-                            basetype_name = base_type_type.upper()
-                        dimensions = ["%s..%s" % (dimension.getlower(), dimension.getupper())
-                                      for dimension in element_type.getdimension()]
-                        elementtype_name = "ARRAY [%s] OF %s" % (",".join(dimensions), basetype_name)
-                    # Structure element derived directly from an elementary type
-                    else:
-                        elementtype_name = element_type_type.upper()
-                    element_text = [("\n    ", ()),
-                                    (element.getname(), (tagname, "struct", i, "name")),
-                                    (" : ", ()),
-                                    (elementtype_name, (tagname, "struct", i, "type"))]
-                    if element.initialValue is not None:
-                        element_text.extend([(" := ", ()),
-                                             (self.ComputeValue(element.initialValue.getvalue(), elementtype_name),
-                                              (tagname, "struct", i, "initial value"))])
-                    element_text.append((";", ()))
-                    elements.append(element_text)
-                datatype_def += [("STRUCT", ())]
-                datatype_def += JoinList([("", ())], elements)
-                datatype_def += [("\n  END_STRUCT", ())]
-            # Data type derived directly from a elementary type
+            # Subrange derived directly from an elementary type
+            else:
+                basetype_name = base_type_type
+            min_value = basetype_content.range.getlower()
+            max_value = basetype_content.range.getupper()
+            datatype_def += [(basetype_name, (tagname, "base")),
+                             (" (", ()),
+                             ("%s" % min_value, (tagname, "lower")),
+                             ("..", ()),
+                             ("%s" % max_value, (tagname, "upper")),
+                             (")", ())]
+        # Data type is an enumerated type
+        elif basetype_content_type == "enum":
+            values = [[(value.getname(), (tagname, "value", i))]
+                      for i, value in enumerate(
+                    basetype_content.xpath("ppx:values/ppx:value",
+                                           namespaces=PLCOpenParser.NSMAP))]
+            datatype_def += [("(", ())]
+            datatype_def += JoinList([(", ", ())], values)
+            datatype_def += [(")", ())]
+        # Data type is an array
+        elif basetype_content_type == "array":
+            base_type = basetype_content.baseType.getcontent()
+            base_type_type = base_type.getLocalTag()
+            # Array derived directly from a user defined type
+            if base_type_type == "derived":
+                basetype_name = base_type.getname()
+                self.GenerateDataType(basetype_name)
+            # Array derived directly from an elementary type
             else:
-                datatype_def += [(basetype_content_type.upper(), (tagname, "base"))]
-            # Data type has an initial value
-            if datatype.initialValue is not None:
-                datatype_def += [(" := ", ()),
-                                 (self.ComputeValue(datatype.initialValue.getvalue(), datatype_name),
-                                  (tagname, "initial value"))]
-            datatype_def += [(";\n", ())]
-            self.Program += datatype_def
+                basetype_name = base_type_type.upper()
+            dimensions = [[("%s" % dimension.getlower(), (tagname, "range", i, "lower")),
+                           ("..", ()),
+                           ("%s" % dimension.getupper(), (tagname, "range", i, "upper"))]
+                          for i, dimension in enumerate(basetype_content.getdimension())]
+            datatype_def += [("ARRAY [", ())]
+            datatype_def += JoinList([(",", ())], dimensions)
+            datatype_def += [("] OF ", ()),
+                             (basetype_name, (tagname, "base"))]
+        # Data type is a structure
+        elif basetype_content_type == "struct":
+            elements = []
+            for i, element in enumerate(basetype_content.getvariable()):
+                element_type = element.type.getcontent()
+                element_type_type = element_type.getLocalTag()
+                # Structure element derived directly from a user defined type
+                if element_type_type == "derived":
+                    elementtype_name = element_type.getname()
+                    self.GenerateDataType(elementtype_name)
+                elif element_type_type == "array":
+                    base_type = element_type.baseType.getcontent()
+                    base_type_type = base_type.getLocalTag()
+                    # Array derived directly from a user defined type
+                    if base_type_type == "derived":
+                        basetype_name = base_type.getname()
+                        self.GenerateDataType(basetype_name)
+                    # Array derived directly from an elementary type
+                    else:
+                        basetype_name = base_type_type.upper()
+                    dimensions = ["%s..%s" % (dimension.getlower(), dimension.getupper())
+                                  for dimension in element_type.getdimension()]
+                    elementtype_name = "ARRAY [%s] OF %s" % (",".join(dimensions), basetype_name)
+                # Structure element derived directly from an elementary type
+                else:
+                    elementtype_name = element_type_type.upper()
+                element_text = [("\n    ", ()),
+                                (element.getname(), (tagname, "struct", i, "name")),
+                                (" : ", ()),
+                                (elementtype_name, (tagname, "struct", i, "type"))]
+                if element.initialValue is not None:
+                    element_text.extend([(" := ", ()),
+                                         (self.ComputeValue(element.initialValue.getvalue(), elementtype_name),
+                                          (tagname, "struct", i, "initial value"))])
+                element_text.append((";", ()))
+                elements.append(element_text)
+            datatype_def += [("STRUCT", ())]
+            datatype_def += JoinList([("", ())], elements)
+            datatype_def += [("\n  END_STRUCT", ())]
+        # Data type derived directly from a elementary type
+        else:
+            datatype_def += [(basetype_content_type.upper(), (tagname, "base"))]
+        # Data type has an initial value
+        if datatype.initialValue is not None:
+            datatype_def += [(" := ", ()),
+                             (self.ComputeValue(datatype.initialValue.getvalue(), datatype.getname()),
+                              (tagname, "initial value"))]
+        datatype_def += [(";\n", ())]
+        return datatype_def
 
     # Generate a POU from its name
     def GeneratePouProgram(self, pou_name):
+        self.AddDependency("pou", pou_name)
         # Verify that POU hasn't been generated yet
         if not self.PouComputed.get(pou_name, True):
             # If not mark POU as computed
@@ -254,14 +270,71 @@ class ProgramGenerator(object):
             pou_type = pou.getpouType()
             # Verify that POU type exists
             if pou_type in pouTypeNames:
-                # Create a POU program generator
-                pou_program = PouProgramGenerator(self, pou.getname(), pouTypeNames[pou_type], self.Errors,
-                                                  self.Warnings)
-                program = pou_program.GenerateProgram(pou)
-                self.Program += program
+                def GeneratePou(warnings):
+                    # Create a POU program generator
+                    pou_program = PouProgramGenerator(self, pou.getname(), pouTypeNames[pou_type], self.Errors,
+                                                      warnings)
+                    return pou_program.GenerateProgram(pou)
+                self.Program += self.GenerateCached(pou, GeneratePou)
             else:
                 raise PLCGenException(_("Undefined pou type \"%s\"") % pou_type)
 
+    # Note that data type or POU currently generated depends on given one
+    def AddDependency(self, kind, name):
+        if len(self.DependenciesStack) > 0:
+            self.DependenciesStack[-1].append((kind, name))
+
+    # Compute the signature of types that generated code of any data type or
+    # POU can depend on: data types, POU interfaces and library blocks
+    def ComputeTypesSignature(self):
+        signature = hashlib.sha1()
+        for datatype in self.Project.getdataTypes():
+            signature.update(etree.tostring(datatype))
+        for pou in self.Project.getpous():
+            signature.update(("%s:%s" % (pou.getname(), pou.getpouType())).encode())
+            interface = pou.getinterface()
+            if interface is not None:
+                signature.update(etree.tostring(interface))
+        # interface of library blocks and data types, as generated code
+        # of elements using them depends on it too
+        for name in sorted(self.Controler.TotalTypesDict.keys()):
+            for _section, blocktype in self.Controler.TotalTypesDict[name]:
+                signature.update(repr(
+                    (name, blocktype["type"], blocktype["extensible"],
+                     blocktype["inputs"], blocktype["outputs"])).encode())
+        for confnodetypes in self.Controler.ConfNodeTypes:
+            for datatype in confnodetypes["types"].getdataTypes():
+                signature.update(etree.tostring(datatype))
+        return signature.digest()
+
+    # Return program chunks of a data type or POU model, either from cache
+    # or by calling generate, after having generated the data types and POUs
+    # it depends on
+    def GenerateCached(self, element, generate):
+        if self.Cache is None:
+            return generate(self.Warnings)
+        key = hashlib.sha1(self.TypesSignature + etree.tostring(element)).digest()
+        entry = self.Cache.get(key)
+        if entry is None:
+            self.DependenciesStack.append([])
+            warnings = []
+            try:
+                program = generate(warnings)
+            finally:
+                dependencies = self.DependenciesStack.pop()
+                self.Warnings.extend(warnings)
+            self.Cache[key] = (dependencies, program, warnings)
+        else:
+            dependencies, program, warnings = entry
+            for kind, name in dependencies:
+                if kind == "datatype":
+                    self.GenerateDataType(name)
+                else:
+                    self.GeneratePouProgram(name)
+            self.Warnings.extend(warnings)
+        self.CacheKeysUsed.add(key)
+        return program
+
     # Generate a POU defined and used in text
     def GeneratePouProgramInText(self, text):
         for pou_name in list(self.PouComputed.keys()):
@@ -467,6 +540,8 @@ class ProgramGenerator(object):
 
     # Generate the entire program for current project
     def GenerateProgram(self):
+        if self.Cache is not None:
+            self.TypesSignature = self.ComputeTypesSignature()
         # Find all data types defined
         for datatype in self.Project.getdataTypes():
             self.DatatypeComputed[datatype.getname()] = False
@@ -488,6 +563,10 @@ class ProgramGenerator(object):
         # Generate every configurations defined
         for config in self.Project.getconfigurations():
             self.Program += self.GenerateConfiguration(config)
+        # Forget chunks of data types and POUs that don't exist anymore
+        if self.Cache is not None:
+            for key in set(self.Cache.keys()) - self.CacheKeysUsed:
+                self.Cache.pop(key)
 
     # Return generated program
     def GetGeneratedProgram(self):
@@ -1853,7 +1932,7 @@ class PouProgramGenerator(object):
         return program
 
 
-def GenerateCurrentProgram(controler, project, errors, warnings, logger=None):
-    generator = ProgramGenerator(controler, project, errors, warnings, logger)
+def GenerateCurrentProgram(controler, project, errors, warnings, logger=None, cache=None):
+    generator = ProgramGenerator(controler, project, errors, warnings, logger, cache)
     generator.GenerateProgram()
     return generator.GetGeneratedProgram()
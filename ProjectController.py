@@ -62,11 +62,12 @@ from features import catalog, libraries, file_editors
 from plcopen.structures import IEC_KEYWORDS
 from plcopen.types_enums import ComputeConfigurationResourceName, ITEM_CONFNODE
 from runtime import PlcStatus
-from runtime.typemapping import DebugTypesSize, UnpackDebugBuffer
+from runtime.typemapping import DebugTypesSize, DebugTraceLayout, TracesDropCount
 from util.BitmapLibrary import GetBitmap
 from util.MiniTextControler import MiniTextControler
 from util.ProcessLogger import ProcessLogger
 from util.TranslationCatalogs import NoTranslate
+from util.VariablesTable import VariablesTable
 from util.misc import CheckPathPerm, GetClassImporter
 from wxasync.src.wxasync import StartCoroutine
 
@@ -276,6 +277,8 @@ class ProjectController(ConfigTreeNode, PLCControler):
         # Setup debug information
         self.IECdebug_datas = {}
         self.IECdebug_force = {}
+        # IEC path -> deadband of REAL/LREAL variables traced by change
+        self.IECdebug_deadbands = {}
         self.IECdebug_lock = Lock()
 
         self.DebugTimer = None
@@ -644,12 +647,13 @@ class ProjectController(ConfigTreeNode, PLCControler):
         if len(self.Libraries) == 0:
             return [], [], ()
         self.GetIECProgramsAndVariables()
+        VariablesList = self._VariablesTable.Rows()
         LibIECCflags = '"-I%s" -Wno-unused-function' % os.path.abspath(
             self.GetIECLibPath())
         LocatedCCodeAndFlags = []
         Extras = []
         for lib in self.Libraries:
-            res = lib.Generate_C(buildpath, self._VariablesList, LibIECCflags)
+            res = lib.Generate_C(buildpath, VariablesList, LibIECCflags)
             LocatedCCodeAndFlags.append(res[:2])
             if len(res) > 2:
                 Extras.extend(res[2:])
@@ -968,88 +972,26 @@ class ProjectController(ConfigTreeNode, PLCControler):
         CSV file generated by IEC2C compiler.
         """
         self._ProgramList = None
-        self._VariablesList = None
-        self._DbgVariablesList = None
-        self._IECPathToIdx = {}
+        self._VariablesTable = None
         self._Ticktime = 0
         self.TracedIECPath = []
         self.TracedIECTypes = []
+        self.TracedIECLayout = DebugTraceLayout([])
 
     def GetIECProgramsAndVariables(self):
         """
-        Parse CSV-like file  VARIABLES.csv resulting from IEC2C compiler.
-        Each section is marked with a line staring with '//'
-        list of all variables used in various POUs
+        Load table of programs and variables from CSV-like file
+        VARIABLES.csv resulting from IEC2C compiler.
+        Table is persisted in build directory, and only parsed again
+        when CSV changed.
         """
-        if self._ProgramList is None or self._VariablesList is None:
+        if self._VariablesTable is None:
             try:
                 csvfile = os.path.join(self._getBuildPath(), "VARIABLES.csv")
-                # describes CSV columns
-                ProgramsListAttributeName = ["num", "C_path", "type"]
-                VariablesListAttributeName = [
-                    "num", "vartype", "IEC_path", "C_path", "type", "derived"]
-                self._ProgramList = []
-                self._VariablesList = []
-                self._DbgVariablesList = []
-                self._IECPathToIdx = {}
-
-                # Separate sections
-                ListGroup = []
-                for line in open(csvfile, 'r', encoding='utf-8').readlines():
-                    strippedline = line.strip()
-                    if strippedline.startswith("//"):
-                        # Start new section
-                        ListGroup.append([])
-                    elif len(strippedline) > 0 and len(ListGroup) > 0:
-                        # append to this section
-                        ListGroup[-1].append(strippedline)
-
-                # first section contains programs
-                for line in ListGroup[0]:
-                    # Split and Maps each field to dictionnary entries
-                    attrs = dict(
-                        list(zip(ProgramsListAttributeName, line.strip().split(';'))))
-                    # Truncate "C_path" to remove conf an resources names
-                    attrs["C_path"] = '__'.join(
-                        attrs["C_path"].split(".", 2)[1:])
-                    # Push this dictionnary into result.
-                    self._ProgramList.append(attrs)
-
-                # second section contains all variables
-                config_FBs = {}
-                Idx = 0
-                for line in ListGroup[1]:
-                    # Split and Maps each field to dictionnary entries
-                    attrs = dict(
-                        list(zip(VariablesListAttributeName, line.strip().split(';'))))
-                    # Truncate "C_path" to remove conf an resources names
-                    parts = attrs["C_path"].split(".", 2)
-                    if len(parts) > 2:
-                        config_FB = config_FBs.get(tuple(parts[:2]))
-                        if config_FB:
-                            parts = [config_FB] + parts[2:]
-                            attrs["C_path"] = '.'.join(parts)
-                        else:
-                            attrs["C_path"] = '__'.join(parts[1:])
-                    else:
-                        attrs["C_path"] = '__'.join(parts)
-                        if attrs["vartype"] == "FB":
-                            config_FBs[tuple(parts)] = attrs["C_path"]
-                    if attrs["vartype"] not in ["FB", "EXT","TEMP"] and attrs["type"] in DebugTypesSize:
-                        # Push this dictionnary into result.
-                        self._DbgVariablesList.append(attrs)
-                        # Fill in IEC<->C translation dicts
-                        IEC_path = attrs["IEC_path"]
-                        self._IECPathToIdx[IEC_path] = (Idx, attrs["type"])
-                        # Ignores numbers given in CSV file
-                        # Idx=int(attrs["num"])
-                        # Count variables only, ignore FBs
-                        Idx += 1
-                    self._VariablesList.append(attrs)
-
-                # third section contains ticktime
-                if len(ListGroup) > 2:
-                    self._Ticktime = int(ListGroup[2][0])
+                table = VariablesTable.Load(csvfile, DebugTypesSize)
+                self._VariablesTable = table
+                self._ProgramList = table.Programs
+                self._Ticktime = table.Ticktime
 
             except Exception:
                 print(
@@ -1067,35 +1009,37 @@ class ProjectController(ConfigTreeNode, PLCControler):
         self.GetIECProgramsAndVariables()
 
         # prepare debug code
+        table = self._VariablesTable
         variable_decl_array = []
         bofs = 0
-        for v in self._DbgVariablesList:
-            sz = DebugTypesSize.get(v["type"], 0)
-            variable_decl_array += [
-                "{&(%(C_path)s), " % v +
+        for row in table.DebugRows:
+            iectype = table.Type[row]
+            bofs += DebugTypesSize.get(iectype, 0)
+            variable_decl_array.append(
+                "{&(%s), " % table.CPath[row] +
                 {
-                    # "EXT": "%(type)s_P_ENUM",
-                    "IN": "%(type)s_P_ENUM",
-                    "MEM": "%(type)s_O_ENUM",
-                    "OUT": "%(type)s_O_ENUM",
-                    "VAR": "%(type)s_ENUM"
-                }[v["vartype"]] % v +
-                "}"]
-            bofs += sz
+                    # "EXT": "%s_P_ENUM",
+                    "IN": "%s_P_ENUM",
+                    "MEM": "%s_O_ENUM",
+                    "OUT": "%s_O_ENUM",
+                    "VAR": "%s_ENUM"
+                }[table.VarType[row]] % iectype +
+                "}")
         debug_code = targets.GetCode("plc_debug.c") % {
             "buffer_size": bofs,
             "programs_declarations": "\n".join(["extern %(type)s %(C_path)s;" %
                                                 p for p in self._ProgramList]),
             "extern_variables_declarations": "\n".join([
                 {
-                    # "EXT": "extern __IEC_%(type)s_p %(C_path)s;",
-                    "IN": "extern __IEC_%(type)s_p %(C_path)s;",
-                    "MEM": "extern __IEC_%(type)s_p %(C_path)s;",
-                    "OUT": "extern __IEC_%(type)s_p %(C_path)s;",
-                    "VAR": "extern __IEC_%(type)s_t %(C_path)s;",
-                    "FB": "extern       %(type)s   %(C_path)s;"
-                }[v["vartype"]] % v
-                for v in self._VariablesList if v["C_path"].find('.') < 0]),
+                    # "EXT": "extern __IEC_%s_p %s;",
+                    "IN": "extern __IEC_%s_p %s;",
+                    "MEM": "extern __IEC_%s_p %s;",
+                    "OUT": "extern __IEC_%s_p %s;",
+                    "VAR": "extern __IEC_%s_t %s;",
+                    "FB": "extern       %s   %s;"
+                }[vartype] % (iectype, C_path)
+                for vartype, iectype, C_path in
+                zip(table.VarType, table.Type, table.CPath) if C_path.find('.') < 0]),
             "variable_decl_array": ",\n".join(variable_decl_array),
             "var_access_code": targets.GetCode("var_access.c")
         }
@@ -1113,9 +1057,23 @@ class ProjectController(ConfigTreeNode, PLCControler):
                            [loc for loc, _Cfiles, DoCalls in
                             self.LocationCFilesAndCFLAGS if loc and DoCalls]))
 
+        # resources run functions (upper case, as generated by compiler),
+        # for targets running each resource on its own thread
+        resources = [resource.getname().upper()
+                     for config in self.Project.getconfigurations()
+                     for resource in config.getresource()]
+        resources_dict = {
+            "resources_prototypes": "\n".join([
+                ("void %(s)s_run__(unsigned long tick);\n" +
+                 "#ifndef %(s)s_CPU\n#define %(s)s_CPU -1\n#endif") % {'s': name} for name in resources]),
+            "resources_count": len(resources),
+            "resources_run": ", ".join(["%s_run__" % name for name in resources]),
+            "resources_cpus": ", ".join(["%s_CPU" % name for name in resources])
+        }
+
         # Generate main, based on template
         if not self.BeremizRoot.getDisable_Extensions():
-            plc_main_code = targets.GetCode("plc_main_head.c") % {
+            plc_main_code = targets.GetCode("plc_main_head.c") % dict(resources_dict, **{
                 "calls_prototypes": "\n".join([(
                                                        "int __init_%(s)s();\n" +
                                                        "void __cleanup_%(s)s(void);\n" +
@@ -1134,15 +1092,15 @@ class ProjectController(ConfigTreeNode, PLCControler):
                 "cleanup_calls": "\n    ".join([
                     "if(init_level >= %d) " % i +
                     "__cleanup_%s();" % locstrs[i - 1] for i in range(len(locstrs), 0, -1)])
-            }
+            })
         else:
-            plc_main_code = targets.GetCode("plc_main_head.c") % {
+            plc_main_code = targets.GetCode("plc_main_head.c") % dict(resources_dict, **{
                 "calls_prototypes": "\n",
                 "retrieve_calls": "\n",
                 "publish_calls": "\n",
                 "init_calls": "\n",
                 "cleanup_calls": "\n"
-            }
+            })
         plc_main_code += targets.GetTargetCode(
             self.GetTarget().getcontent().getLocalTag())
         plc_main_code += targets.GetCode("plc_main_tail.c")
@@ -1162,7 +1120,9 @@ class ProjectController(ConfigTreeNode, PLCControler):
 
         buildpath = self._getBuildPath()
 
-        os.system("rd /s /q %s" % buildpath)
+        # builders that reuse previous build outputs handle stale files
+        if not getattr(self.GetBuilder(), "incremental", False):
+            os.system("rd /s /q %s" % buildpath)
 
         # Eventually create build dir
         if not os.path.exists(buildpath):
@@ -1649,6 +1609,7 @@ class ProjectController(ConfigTreeNode, PLCControler):
         Idxs = []
         self.TracedIECPath = []
         self.TracedIECTypes = []
+        self.TracedIECLayout = DebugTraceLayout([])
         # 进入监控状态
         # if not self._connector:
         #     await self._coConnect()
@@ -1663,8 +1624,7 @@ class ProjectController(ConfigTreeNode, PLCControler):
                     IECPathsToPop.append(IECPath)
                 elif IECPath != "__tick__":
                     # Convert
-                    Idx, IEC_Type = self._IECPathToIdx.get(
-                        IECPath, (None, None))
+                    Idx, IEC_Type = self.GetDebugIECVariableIdx(IECPath)
                     if Idx is not None:
                         if IEC_Type in DebugTypesSize:
                             Idxs.append((Idx, IEC_Type, IECPath))
@@ -1682,6 +1642,7 @@ class ProjectController(ConfigTreeNode, PLCControler):
                 IdxsT = list(zip(*Idxs))
                 self.TracedIECPath = IdxsT[2]
                 self.TracedIECTypes = IdxsT[1]
+                self.TracedIECLayout = DebugTraceLayout(self.TracedIECTypes)
                 await self._connector.SetTraceVariablesList(list(zip(*IdxsT[0:2])))
             else:
                 self.TracedIECPath = []
@@ -1701,8 +1662,7 @@ class ProjectController(ConfigTreeNode, PLCControler):
                 if force != 'Forced':
                     IECPathsToPop.append(IECPath)
                 # Convert
-                Idx, IEC_Type = self._IECPathToIdx.get(
-                    IECPath, (None, None))
+                Idx, IEC_Type = self.GetDebugIECVariableIdx(IECPath)
                 if Idx is not None:
                     if IEC_Type in DebugTypesSize:
                         Idxs.append((Idx, IEC_Type, value))
@@ -1738,8 +1698,13 @@ class ProjectController(ConfigTreeNode, PLCControler):
             # Rearm anti-rapid-fire timer
             self.DebugTimer.start()
 
+    def GetDebugIECVariableIdx(self, IECPath):
+        if self._VariablesTable is None:
+            return None, None
+        return self._VariablesTable.GetDebugIdx(IECPath)
+
     def GetDebugIECVariableType(self, IECPath):
-        _Idx, IEC_Type = self._IECPathToIdx.get(IECPath, (None, None))
+        _Idx, IEC_Type = self.GetDebugIECVariableIdx(IECPath)
         return IEC_Type
 
     prompt = False
@@ -1750,9 +1715,11 @@ class ProjectController(ConfigTreeNode, PLCControler):
         to a WeakKeyDictionary linking
         weakly referenced callables
         """
-        if not self._IECPathToIdx:
+        if self._VariablesTable is None:
             self.GetIECProgramsAndVariables()
-        if IECPath != "__tick__" and IECPath not in self._IECPathToIdx:
+        if IECPath != "__tick__" and (
+                self._VariablesTable is None or
+                not self._VariablesTable.HasDebugVariable(IECPath)):
             return None
 
         if len(self.IECdebug_datas) >= 450:
@@ -1847,6 +1814,24 @@ class ProjectController(ConfigTreeNode, PLCControler):
 
         StartCoroutine(self.coRegisterForceVarToConnector, self.AppFrame)
 
+    def GetDebugIECVariableDeadband(self, IECPath):
+        return self.IECdebug_deadbands.get(IECPath)
+
+    def SetDebugIECVariableDeadband(self, IECPath, deadband):
+        """
+        Set deadband of a REAL/LREAL variable : runtime only sends its
+        value when it moved further than deadband. None to disable.
+        Only applies to connectors tracing variables by change.
+        """
+        self.IECdebug_lock.acquire()
+        if deadband is None:
+            self.IECdebug_deadbands.pop(IECPath, None)
+        else:
+            self.IECdebug_deadbands[IECPath] = deadband
+        # deadbands are sent along with next keyframe
+        self.TracedIECLayout.DeltaBase = None
+        self.IECdebug_lock.release()
+
     def CallWeakcallables(self, IECPath, function_name, *cargs):
         data_tuple = self.IECdebug_datas.get(IECPath, None)
         if data_tuple is not None:
@@ -1868,6 +1853,14 @@ class ProjectController(ConfigTreeNode, PLCControler):
             return -1, "No runtime connected!"
         return self._connector.RemoteExec(script, **kwargs)
 
+    def _CheckTraceDropCount(self, packed):
+        dropped = TracesDropCount(packed)
+        if self.DebugDropCount is not None and dropped > self.DebugDropCount:
+            self.logger.write_warning(
+                _("Debugger lost %d samples, PLC runs faster than trace polling\n") %
+                (dropped - self.DebugDropCount))
+        self.DebugDropCount = dropped
+
     async def DebugThreadProc(self):
         """
         This thread waid PLC debug data, and dispatch them to subscribers
@@ -1875,17 +1868,52 @@ class ProjectController(ConfigTreeNode, PLCControler):
         self.logger.write(_("Debugger ready\n"))
         await self.coRegisterDebugVarToConnector()
         self.debug_break = False
+        self.DebugDropCount = None
         debug_getvar_retry = 0
         while self.DebugThread and (not self.debug_break) and (self._connector is not None):
             ## @todo: 连接断开时,死等不返回
             try:
-                plc_status, Traces = await self._connector.GetTraceVariables()
+                # only methods defined in connector class are really
+                # implemented, others are caught by __getattr__
+                if hasattr(type(self._connector), "GetTraceVariablesDelta"):
+                    changes_only = not any(
+                        IECdebug_data[4] for IECdebug_data in list(self.IECdebug_datas.values()))
+                    layout = self.TracedIECLayout
+                    # keyframe needed at first, and when samples were lost
+                    keyframe = layout.DeltaBase is None
+                    deadbands = None
+                    if keyframe:
+                        deadbands = dict(
+                            (position, self.IECdebug_deadbands[IECPath])
+                            for position, IECPath in enumerate(self.TracedIECPath)
+                            if IECPath in self.IECdebug_deadbands)
+                    plc_status, packed = await self._connector.GetTraceVariablesDelta(
+                        keyframe=keyframe, deadbands=deadbands, changes_only=changes_only)
+                    if packed is None:
+                        layout.DeltaBase = None
+                    Samples = []
+                    if packed:
+                        Samples = layout.UnpackDelta(packed)
+                        self._CheckTraceDropCount(packed)
+                elif hasattr(type(self._connector), "GetTraceVariablesPacked"):
+                    # unchanged samples can be dropped by runtime
+                    # if no subscriber keeps history
+                    changes_only = not any(
+                        IECdebug_data[4] for IECdebug_data in list(self.IECdebug_datas.values()))
+                    plc_status, packed = await self._connector.GetTraceVariablesPacked(
+                        changes_only=changes_only)
+                    Samples = []
+                    if packed:
+                        Samples = self.TracedIECLayout.UnpackPacked(packed)
+                        self._CheckTraceDropCount(packed)
+                else:
+                    plc_status, Traces = await self._connector.GetTraceVariables()
+                    Samples = self.TracedIECLayout.UnpackBatch(Traces) if Traces else []
                 debug_getvar_retry += 1
                 # print [dict.keys() for IECPath, (dict, log, status, fvalue) in self.IECdebug_datas.items()]
-                if len(Traces) > 0:
+                if len(Samples) > 0:
                     self.IECdebug_lock.acquire()
-                    for debug_tick, debug_buff in Traces:
-                        debug_vars = UnpackDebugBuffer(debug_buff, self.TracedIECTypes)
+                    for debug_tick, debug_vars in Samples:
                         if debug_vars is not None and len(debug_vars) == len(self.TracedIECPath):
                             for IECPath, values_buffer, value in list(
                                     zip(self.TracedIECPath, self.DebugValuesBuffers, debug_vars)):
@@ -1906,6 +1934,8 @@ class ProjectController(ConfigTreeNode, PLCControler):
                     if debug_getvar_retry > 10:
                         self.debug_break = True
             except Exception as ex:
+                # samples may have been lost, next delta needs a keyframe
+                self.TracedIECLayout.DeltaBase = None
                 self.logger.write_error(str(ex))
                 print(traceback.print_exc())
             await asyncio.sleep(0.5)
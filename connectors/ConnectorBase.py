@@ -4,14 +4,109 @@
 # See COPYING file for copyrights details.
 
 # from __future__ import absolute_import
+import asyncio
 import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ConnectorBase(object):
 
     chuncksize = 1024*1024
+    # number of chunks sent without waiting for their acknowledge
+    blobwindow = 8
+    # number of times an interrupted transfer is resumed
+    blobretries = 3
 
     async def BlobFromFile(self, filepath, seed):
+        """
+        Upload file content to runtime
+        @return: blobID to be given to NewPLC
+        """
+        digest = await asyncio.get_running_loop().run_in_executor(None, self._FileDigest, filepath)
+        try:
+            res = await self.OpenBlob(seed, os.path.getsize(filepath), digest)
+        except Exception:
+            res = None
+        if res is None:
+            # runtime without offset addressed blobs
+            return await self._SerialBlobFromFile(filepath, seed)
+        uploadID, offset = res
+        with open(filepath, "rb") as f:
+            for _retry in range(self.blobretries):
+                offset = await self._SendBlobChunks(f, uploadID, offset)
+                if offset is None:
+                    # connection lost, resume from last acknowledged chunk
+                    res = await self.OpenBlob(seed, os.path.getsize(filepath), digest)
+                    if res is None:
+                        break
+                    uploadID, offset = res
+                    continue
+                blobID = await self.CloseBlob(uploadID)
+                if blobID is not None:
+                    return blobID
+                break
+        raise IOError("Data corrupted during transfer or connection lost")
+
+    def _FileDigest(self, filepath):
+        s = hashlib.new('md5')
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chuncksize), b""):
+                s.update(chunk)
+        return s.hexdigest()
+
+    def BlobChunkWriter(self):
+        """
+        Object whose WriteChunkToBlob sends chunks from one executor thread.
+        Connectors serializing concurrent calls on one connection must
+        return a new connection here, or chunks in flight won't overlap.
+        """
+        return self
+
+    def _WriteChunk(self, writers, uploadID, offset, chunk):
+        # connectors remote calls block until answered, despite being
+        # coroutines, hence each chunk is sent from an executor thread,
+        # with the chunk writer of that thread
+        writer = getattr(writers, "writer", None)
+        if writer is None:
+            writer = writers.writer = self.BlobChunkWriter()
+        return asyncio.run(writer.WriteChunkToBlob(uploadID, offset, chunk))
+
+    async def _SendBlobChunks(self, f, uploadID, offset):
+        """
+        Send file from offset, with up to blobwindow chunks in flight
+        @return: size of file, or None if transfer was interrupted
+        """
+        loop = asyncio.get_running_loop()
+        size = os.fstat(f.fileno()).st_size
+        pending = set()
+        failed = False
+        executor = ThreadPoolExecutor(self.blobwindow)
+        # chunk writers are dropped with executor threads
+        writers = threading.local()
+        try:
+            while (offset < size or pending) and not failed:
+                while offset < size and len(pending) < self.blobwindow:
+                    f.seek(offset)
+                    chunk = f.read(self.chuncksize)
+                    pending.add(loop.run_in_executor(
+                        executor, self._WriteChunk, writers, uploadID, offset, chunk))
+                    offset += len(chunk)
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None or task.result() is None:
+                        failed = True
+        finally:
+            # don't wait for chunks still in flight after a failure
+            for task in pending:
+                task.cancel()
+            executor.shutdown(wait=False)
+        if failed:
+            return None
+        return size
+
+    async def _SerialBlobFromFile(self, filepath, seed):
         s = hashlib.new('md5')
         s.update(seed.encode())
         blobID = await self.SeedBlob(seed)
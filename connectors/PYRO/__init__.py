@@ -32,6 +32,8 @@ import Pyro4.core
 import Pyro4.util
 from Pyro4.errors import PyroError
 
+from runtime.loglevels import LogMessagesMaxBytes
+
 # from connectors.PYRO.PSK_Adapter import setupPSKAdapter
 
 service_type = '_PYRO._tcp.local.'
@@ -194,6 +196,45 @@ def PYRO_connector_factory(uri, confnodesroot):
 
         GetTraceVariables = PyroCatcher(_PyroGetTraceVariables, ("Broken", None))
 
+        async def _PyroGetTraceVariablesPacked(self, tick_step=0, changes_only=False):
+            """
+            same as GetTraceVariables, traces packed in one buffer
+            """
+            if self.RemotePLCObjectProxyCopy is None:
+                self.RemotePLCObjectProxyCopy = copy.copy(confnodesroot._connector.GetPyroProxy())
+            status, packed = self.RemotePLCObjectProxyCopy.GetTraceVariablesPacked(
+                tick_step=tick_step, changes_only=changes_only)
+            if isinstance(packed, dict):
+                packed = base64.decodebytes(packed['data'].encode())
+            return status, packed
+
+        GetTraceVariablesPacked = PyroCatcher(_PyroGetTraceVariablesPacked, ("Broken", None))
+
+        async def _PyroGetTraceVariablesDelta(self, keyframe=False, deadbands=None, changes_only=False):
+            """
+            same as GetTraceVariablesPacked, samples carry changed variables only
+            """
+            if self.RemotePLCObjectProxyCopy is None:
+                self.RemotePLCObjectProxyCopy = copy.copy(confnodesroot._connector.GetPyroProxy())
+            status, packed = self.RemotePLCObjectProxyCopy.GetTraceVariablesDelta(
+                keyframe=keyframe, deadbands=deadbands, changes_only=changes_only)
+            if isinstance(packed, dict):
+                packed = base64.decodebytes(packed['data'].encode())
+            return status, packed
+
+        GetTraceVariablesDelta = PyroCatcher(_PyroGetTraceVariablesDelta, ("Broken", None))
+
+        async def _PyroGetLogMessages(self, level, first, count, max_bytes=LogMessagesMaxBytes):
+            """
+            same as GetLogMessage for a range of messages, packed in one buffer
+            """
+            packed = RemotePLCObjectProxy.GetLogMessages(level, first, count, max_bytes)
+            if isinstance(packed, dict):
+                packed = base64.decodebytes(packed['data'].encode())
+            return packed
+
+        GetLogMessages = PyroCatcher(_PyroGetLogMessages, None)
+
         async def _PyroGetPLCstatus(self):
             return RemotePLCObjectProxy.GetPLCstatus()
 
@@ -204,6 +245,21 @@ def PYRO_connector_factory(uri, confnodesroot):
 
         RemoteExec = PyroCatcher(_PyroRemoteExec, (-1, "RemoteExec script failed!"))
 
+        def BlobChunkWriter(self):
+            """
+            Pyro proxy serializes calls made from several threads,
+            each thread sending blob chunks gets its own connection
+            """
+            RemotePLCObjectProxyClone = RemotePLCObjectProxy._pyroClone()
+
+            class PyroBlobChunkWriter(object):
+                async def _PyroWriteChunkToBlob(self, uploadID, offset, chunk):
+                    return RemotePLCObjectProxyClone.WriteChunkToBlob(uploadID, offset, chunk)
+
+                WriteChunkToBlob = PyroCatcher(_PyroWriteChunkToBlob, None)
+
+            return PyroBlobChunkWriter()
+
         def __getattr__(self, attrName):
             member = self.__dict__.get(attrName, None)
             if member is None:
@@ -20,6 +20,7 @@ from connectors.SERIAL.YAPLCProto import BOOTTransaction, YAPLCProto, STARTTrans
     SETIPTransaction, GET_PLCRTEVERTransaction, XMODEM_PLCBINTransaction, SET_FORCE_VARIABLETransaction, GET_Thread_INFO
 from modem.modem.protocol.ymodem import YMODEM
 from runtime.PLCObject import LogLevelsCount
+from runtime.loglevels import LogMessagesMaxBytes, LogMessageHeaderSize, PackLogMessages
 from runtime.typemapping import TypeTranslator
 from util.ProcessLogger import ProcessLogger
 
@@ -317,6 +318,34 @@ class YAPLCObject_SER(object):
         self.TransactionLock.acquire()
         strbuf = await self.HandleSerialTransaction(GET_LOGMSGTransaction(level, msgid))
         self.TransactionLock.release()
+        return self._DecodeLogMessage(strbuf)
+
+    async def GetLogMessages(self, level, first, count, max_bytes=LogMessagesMaxBytes):
+        """
+        Same as PLCObject.GetLogMessages. Target has no ranged request, so
+        messages are requested in a row, holding transaction lock once.
+        """
+        messages = []
+        size = 0
+        self.TransactionLock.acquire()
+        try:
+            for msgid in range(first, first + count):
+                strbuf = await self.HandleSerialTransaction(GET_LOGMSGTransaction(level, msgid))
+                if strbuf is None:
+                    # transaction failed, don't insist
+                    break
+                message = self._DecodeLogMessage(strbuf)
+                if message is None:
+                    continue
+                size += LogMessageHeaderSize + len(message[0])
+                if messages and size > max_bytes:
+                    break
+                messages.append([msgid] + message)
+        finally:
+            self.TransactionLock.release()
+        return PackLogMessages(messages)
+
+    def _DecodeLogMessage(self, strbuf):
         if strbuf is not None and len(strbuf) > 12:
             cbuf = ctypes.cast(
                 ctypes.c_char_p(strbuf[:12]),
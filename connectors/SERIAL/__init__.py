@@ -84,6 +84,9 @@ def _SERIAL_connector_factory(cls, uri, confnodesroot):
             global _SocketSession
             _SocketSession = YAPLCObject_SER(YaPySerialLib, confnodesroot, comportstr)
 
+        # explicitly declared so that log viewer can detect bulk retrieval
+        GetLogMessages = staticmethod(SocketSessionProcMapper("GetLogMessages"))
+
         def __getattr__(self, attrName):
             member = self.__dict__.get(attrName, None)
             if member is None:
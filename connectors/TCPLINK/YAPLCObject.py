@@ -2,23 +2,30 @@
 # -*- coding: utf-8 -*-
 # YAPLC connector, based on LPCObject.py and LPCAppObjet.py
 # from PLCManager
-from threading import Lock
+import asyncio
 
 from connectors.TCPLINK.YAPLCProto import YAPLCProto
 from connectors.UDPLINK import YAPLCObject_UDP
+from connectors.UDPLINK.YAPLCObject import LOGMSG_PIPELINE_DEPTH
 from wxasync.src.wxasync import StartCoroutine
 
 
 class YAPLCObject_TCP(YAPLCObject_UDP):
+    # replies come in request order on stream
+    LogMsgPipelineDepth = LOGMSG_PIPELINE_DEPTH
+
     def __init__(self, confnodesroot, comportstr):
 
-        self.TransactionLock = Lock()
+        self.TransactionLock = asyncio.Lock()
         self.PLCStatus = "Disconnected"
         self.confnodesroot = confnodesroot
         self.PLCprint = confnodesroot.logger.write
         self._Idxs = []
+        # trace indexes registered by diff, None if unknown
+        self._TraceIdxs = None
+        # whether target supports registration by diff, None if unknown
+        self.TraceDiffSupported = None
         self.ip = comportstr
-        self.TransactionLock.acquire()
         try:
             self.Connection = YAPLCProto(comportstr, 8080, 5)
         except Exception as e:
@@ -26,7 +33,6 @@ class YAPLCObject_TCP(YAPLCObject_UDP):
             self.Connection = None
             self.PLCStatus = None  # ProjectController is responsible to set "Disconnected" status
             StartCoroutine(self.confnodesroot._SetConnector(None), self.confnodesroot.AppFrame)
-        self.TransactionLock.release()
         self.errCount = 0
         self.lasttime = 0
 
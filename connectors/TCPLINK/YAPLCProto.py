@@ -3,144 +3,109 @@
 
 # YAPLC connector, based on LPCProto.py and LPCAppProto.py
 # from PLCManager
+import asyncio
 import ctypes
 import socket
+from collections import deque
 
-from connectors.UDPLINK.YAPLCProto import YAPLC_STATUS
-
-
-class YAPLCProtoError(Exception):
-    """Exception class"""
-
-    def __init__(self, msg):
-        self.msg = msg
-
-    def __str__(self):
-        return "Exception in PLC protocol : " + str(self.msg)
+from connectors.UDPLINK.YAPLCProto import YAPLC_STATUS, YAPLCProtoError
 
 
 class YAPLCProto:
+    """
+    YAPLC protocol over TCP, on asyncio streams.
+    Replies are framed as on serial link : command ack and PLC status,
+    then for transactions with data, data length and data. Requests are
+    pipelined, controller answers them in order. As protocol has no
+    request tag, echoed command byte is checked against oldest pending
+    request, and connection is reset on mismatch or timeout since stream
+    can't be resynchronized.
+    """
 
     def __init__(self, ip, port, timeout):
-        # serialize access lock
         self.port = port
         self.ip = ip
         self.timeout = timeout
-        # open serial port
-        self.tcp = None
-        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #        bufsize = self.tcp.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
-        self.tcp.connect((ip, port))
-        self.tcp.settimeout(timeout)
-        timeout = self.tcp.gettimeout()
-        self.tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        # StartCoroutine(self.Open(), self)
+        self.writer = None
+        self.ReaderTask = None
+        # (transaction, future) of pending requests, in emission order
+        self.Pending = deque()
+        self.OpenLock = asyncio.Lock()
+
+    async def Open(self):
+        async with self.OpenLock:
+            if self.writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.ip, self.port), self.timeout)
+                writer.get_extra_info("socket").setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.writer = writer
+                self.ReaderTask = asyncio.ensure_future(self._ReadReplies(reader))
 
     def flush(self):
-        try:
-            self.tcp.settimeout(0)
-            self.tcp.recv(1024)
-        except:
-            pass
+        # failed transaction may have left stream unsynchronized
+        self._Reset("flushed")
 
     async def ready(self):
+        await self.Open()
         return True
 
-    def Write(self, bv):
-        return self.tcp.send(bv)
-
-    def Read(self, nbytes):
-        return self.tcp.recv(nbytes)
-
-    def settimeout(self, val):
-        self.tcp.settimeout(val)
+    async def _ReadReplies(self, reader):
+        try:
+            while True:
+                reply = await reader.readexactly(2)
+                if not self.Pending:
+                    raise YAPLCProtoError("YAPLC transaction error - unexpected reply!")
+                # checked before popping, so that _Reset fails this request too
+                if reply[0] != self.Pending[0][0].Command:
+                    raise YAPLCProtoError("YAPLC transaction error - controller did not ack order!")
+                transaction, future = self.Pending.popleft()
+                if transaction.HasData:
+                    lengthstr = await reader.readexactly(4)
+                    length = ctypes.c_uint32.from_buffer_copy(lengthstr).value
+                    reply += lengthstr + await reader.readexactly(length)
+                if not future.done():
+                    future.set_result(reply)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.ReaderTask = None
+            self._Reset(e)
+
+    def _Reset(self, reason):
+        if self.ReaderTask is not None:
+            self.ReaderTask.cancel()
+            self.ReaderTask = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        while self.Pending:
+            _transaction, future = self.Pending.popleft()
+            if not future.done():
+                future.set_exception(YAPLCProtoError(reason))
 
     async def HandleTransaction(self, transaction):
         transaction.SetPort(self)
-        # self.flush()
-        # send command, wait ack (timeout)
-        await            transaction.SendCommand()
+        await self.Open()
+        await transaction.SendCommand()
         if transaction.Data:
             await transaction.SendData(transaction.Data)
-        self.Write(bytes(transaction.txbuf))
-        transaction.rxbuf = self.Read(1024)
+        future = asyncio.get_running_loop().create_future()
+        # queued and written without yielding, to keep replies order
+        self.Pending.append((transaction, future))
+        self.writer.write(bytes(transaction.txbuf))
+        try:
+            await self.writer.drain()
+            transaction.rxbuf = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._Reset("timeout")
+            raise YAPLCProtoError("YAPLC transaction error - no reply from controller!")
         current_plc_status = await transaction.GetCommandAck()
         res = await transaction.GetData()
         return YAPLC_STATUS.get(current_plc_status, "Broken"), res
 
     def close(self):
-        self.tcp.close()
+        self._Reset("connection closed")
 
     def __del__(self):
         self.close()
-
-
-class YAPLCTransaction:
-
-    def __init__(self, command):
-        self.Command = command
-        self.tcp = None
-
-    def SetPort(self, tcp):
-        self.tcp = tcp
-
-    async def SendCommand(self):
-        # send command thread
-        # self.udp.send(bytes([self.Command, ]))
-        self.txbuf = [self.Command, ]
-        return True
-
-    async def GetCommandAck(self):
-        # self.udp.settimeout(2)
-        # res = self.udp.recv(2)
-        if not self.rxbuf: return None
-        res = self.rxbuf[0:2]
-        if res is None:
-            return None
-        if len(res) == 2:
-            comm_status, current_plc_status = res
-        else:
-            raise YAPLCProtoError("YAPLC transaction error - controller did not ack order!")
-        # LPC returns command itself as an ack for command
-        if comm_status == self.Command:
-            return current_plc_status
-        return None
-
-    async def SendData(self, Data):
-        # res = self.udp.send(Data)
-        self.txbuf += Data
-        return len(Data)
-
-    async def GetData(self):
-        # lengthstr = self.udp.recv(4)
-        if len(self.rxbuf) < 3:
-            return None
-        lengthstr = self.rxbuf[2:6]
-        if lengthstr is None:
-            raise YAPLCProtoError("YAPLC transaction error - can't read data length!")
-        else:
-            if len(lengthstr) != 4:
-                raise YAPLCProtoError("YAPLC transaction error - data length is invalid: " + str(len(lengthstr)) + " !")
-
-        # transform a byte string into length
-        length = ctypes.cast(
-            ctypes.c_char_p(lengthstr),
-            ctypes.POINTER(ctypes.c_uint32)
-        ).contents.value
-        if length > 0:
-            # data = b''
-            # t1 = time.time()
-            # while len(data) < length and time.time() - t1 < 1:
-            # data += self.udp.recv(length - len(data))
-            data = self.rxbuf[6:length + 6]
-            if data is None:
-                raise YAPLCProtoError("YAPLC transaction error - can't read data!")
-            else:
-                if len(lengthstr) == 0:
-                    raise YAPLCProtoError("YAPLC transaction error - data is invalid!")
-            return data
-        else:
-            return None
-
-    async def ExchangeData(self):
-        pass
@@ -78,6 +78,9 @@ def _TCPLINK_connector_factory(cls, uri, confnodesroot):
             global _SocketSession
             _SocketSession = YAPLCObject_TCP(confnodesroot, ip)
 
+        # explicitly declared so that log viewer can detect bulk retrieval
+        GetLogMessages = staticmethod(SocketSessionProcMapper("GetLogMessages"))
+
         def __getattr__(self, attrName):
             member = self.__dict__.get(attrName, None)
             if member is None:
@@ -2,11 +2,11 @@
 # -*- coding: utf-8 -*-
 # YAPLC connector, based on LPCObject.py and LPCAppObjet.py
 # from PLCManager
+import asyncio
 import ctypes
 import os
 import time
 import traceback
-from threading import Lock
 
 import tftpy
 
@@ -14,23 +14,33 @@ from connectors.UDPLINK.YAPLCProto import YAPLCProto, YAPLCProtoError, STARTTran
     BOOTTransaction, SETRTCTransaction, GET_LOGCOUNTSTransaction, GET_PLCIDTransaction, GET_PLCRTEVERTransaction, \
     GET_Thread_INFO, SETIPTransaction, SET_TRACE_RESETransaction, SET_TRACE_VARIABLETransaction, \
     SET_FORCE_VARIABLETransaction, GET_TRACE_VARIABLETransaction, RESET_LOGCOUNTSTransaction, GET_LOGMSGTransaction, \
-    TFTP_PLCBINTransaction
-from runtime.loglevels import LogLevelsCount
+    TFTP_PLCBINTransaction, SET_TRACE_DIFFTransaction, TraceIndexesHash
+from runtime.loglevels import LogLevelsCount, LogMessagesMaxBytes, LogMessageHeaderSize, PackLogMessages
 from runtime.typemapping import TypeTranslator
 from util.ProcessLogger import ProcessLogger
 from wxasync.src.wxasync import StartCoroutine
 
+# log messages requests kept in flight at once
+LOGMSG_PIPELINE_DEPTH = 16
+
 
 class YAPLCObject_UDP(object):
+    # GET_LOGMSG replies don't carry msgid, and datagrams can be lost or
+    # reordered : one log message request at a time
+    LogMsgPipelineDepth = 1
+
     def __init__(self, confnodesroot, comportstr):
 
-        self.TransactionLock = Lock()
+        self.TransactionLock = asyncio.Lock()
         self.PLCStatus = "Disconnected"
         self.confnodesroot = confnodesroot
         self.PLCprint = confnodesroot.logger.write
         self._Idxs = []
+        # trace indexes registered by diff, None if unknown
+        self._TraceIdxs = None
+        # whether target supports registration by diff, None if unknown
+        self.TraceDiffSupported = None
         self.ip = comportstr
-        self.TransactionLock.acquire()
         try:
             self.Connection = YAPLCProto(comportstr, 8888, 1)
         except Exception as e:
@@ -38,7 +48,6 @@ class YAPLCObject_UDP(object):
             self.Connection = None
             self.PLCStatus = None  # ProjectController is responsible to set "Disconnected" status
             StartCoroutine(self.confnodesroot._SetConnector(None), self.confnodesroot.AppFrame)
-        self.TransactionLock.release()
         self.errCount = 0
         self.lasttime = 0
 
@@ -47,7 +56,10 @@ class YAPLCObject_UDP(object):
 
     async def ready(self):
         if self.Connection:
-            return await self.Connection.ready()
+            try:
+                return await self.Connection.ready()
+            except (OSError, asyncio.TimeoutError):
+                self.PLCStatus = None  # ProjectController is responsible to set "Disconnected" status
         return False
 
     async def _HandleSerialTransaction(self, transaction, must_do_lock):
@@ -91,20 +103,17 @@ class YAPLCObject_UDP(object):
         return res
 
     async def StartPLC(self):
-        self.TransactionLock.acquire()
-        await self.HandleSerialTransaction(STARTTransaction())
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            await self.HandleSerialTransaction(STARTTransaction())
 
     async def StopPLC(self):
-        self.TransactionLock.acquire()
-        await self.HandleSerialTransaction(STOPTransaction())
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            await self.HandleSerialTransaction(STOPTransaction())
         return True
 
     async def restartPLC(self):
-        self.TransactionLock.acquire()
-        await self._HandleSerialTransaction(BOOTTransaction(), False)
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            await self._HandleSerialTransaction(BOOTTransaction(), False)
 
     async def NewPLC(self, md5sum, data, extrafiles):
         if self.MatchMD5(md5sum) == False:
@@ -115,43 +124,42 @@ class YAPLCObject_UDP(object):
 
             self.confnodesroot.logger.write_warning(
                 _("Will now upload firmware to PLC.\nThis may take some time, don't close the program.\n"))
-            self.TransactionLock.acquire()
-            # Will now boot target
-            res, failure = await self._HandleSerialTransaction(BOOTTransaction(), False)
-            time.sleep(3)
-            # Close connection
-            self.Connection.Close()
-            # bootloader command
-            # data contains full command line except serial port string which is passed to % operator
-            # cmd = data % self.Connection.port
-            cmd = [token % {"serial_port": self.Connection.port} for token in data]
-            # wrapper to run command in separate window
-            cmdhead = []
-            cmdtail = []
-            if os.name in ("nt", "ce"):
-                # cmdwrap = "start \"Loading PLC, please wait...\" /wait %s \r"
-                cmdhead.append("cmd")
-                cmdhead.append("/c")
-                cmdhead.append("start")
-                cmdhead.append("Loading PLC, please wait...")
-                cmdhead.append("/wait")
-            else:
-                # cmdwrap = "xterm -e %s \r"
-                cmdhead.append("xterm")
-                cmdhead.append("-e")
-                # Load a program
-                # try:
-                # os.system( cmdwrap % command )
-            # except Exception,e:
-            #    failure = str(e)
-            command = cmdhead + cmd + cmdtail;
-            status, result, err_result = ProcessLogger(self.confnodesroot.logger, command).spin()
-            """
-                    TODO: Process output?
-            """
-            # Reopen connection
-            self.Connection.Open()
-            self.TransactionLock.release()
+            async with self.TransactionLock:
+                # Will now boot target
+                res, failure = await self._HandleSerialTransaction(BOOTTransaction(), False)
+                time.sleep(3)
+                # Close connection
+                self.Connection.close()
+                # bootloader command
+                # data contains full command line except serial port string which is passed to % operator
+                # cmd = data % self.Connection.port
+                cmd = [token % {"serial_port": self.Connection.port} for token in data]
+                # wrapper to run command in separate window
+                cmdhead = []
+                cmdtail = []
+                if os.name in ("nt", "ce"):
+                    # cmdwrap = "start \"Loading PLC, please wait...\" /wait %s \r"
+                    cmdhead.append("cmd")
+                    cmdhead.append("/c")
+                    cmdhead.append("start")
+                    cmdhead.append("Loading PLC, please wait...")
+                    cmdhead.append("/wait")
+                else:
+                    # cmdwrap = "xterm -e %s \r"
+                    cmdhead.append("xterm")
+                    cmdhead.append("-e")
+                    # Load a program
+                    # try:
+                    # os.system( cmdwrap % command )
+                # except Exception,e:
+                #    failure = str(e)
+                command = cmdhead + cmd + cmdtail;
+                status, result, err_result = ProcessLogger(self.confnodesroot.logger, command).spin()
+                """
+                        TODO: Process output?
+                """
+                # Reopen connection
+                await self.Connection.Open()
 
             if failure is not None:
                 self.confnodesroot.logger.write_warning(failure + "\n")
@@ -166,9 +174,7 @@ class YAPLCObject_UDP(object):
     async def GetPLCstatus(self):
         counts = [0, 0, 0, 0]
         for n in range(5):
-            self.TransactionLock.acquire()
             strcounts = await self.HandleSerialTransaction(GET_LOGCOUNTSTransaction())
-            self.TransactionLock.release()
             if strcounts is not None and len(strcounts) == LogLevelsCount * 4:
                 cstrcounts = ctypes.create_string_buffer(strcounts)
                 ccounts = ctypes.cast(cstrcounts, ctypes.POINTER(ctypes.c_uint32))
@@ -180,10 +186,9 @@ class YAPLCObject_UDP(object):
 
     async def MatchMD5(self, MD5):
         self.MatchSwitch = False
-        self.TransactionLock.acquire()
-        data = await self.HandleSerialTransaction(GET_PLCIDTransaction())
-        self.MatchSwitch = True
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            data = await self.HandleSerialTransaction(GET_PLCIDTransaction())
+            self.MatchSwitch = True
         if data is not None:
             data = data.decode()
             if data[:32] == MD5[:32]:
@@ -193,21 +198,18 @@ class YAPLCObject_UDP(object):
         return False
 
     async def GetRteVer(self):
-        self.TransactionLock.acquire()
-        data = await self.HandleSerialTransaction(GET_PLCRTEVERTransaction())
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            data = await self.HandleSerialTransaction(GET_PLCRTEVERTransaction())
         return data
 
     async def GetThreadInfo(self):
-        self.TransactionLock.acquire()
-        data = await self.HandleSerialTransaction(GET_Thread_INFO())
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            data = await self.HandleSerialTransaction(GET_Thread_INFO())
         return data
 
     async def SetIP(self, data):
-        self.TransactionLock.acquire()
-        await self.HandleSerialTransaction(SETIPTransaction(data))
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            await self.HandleSerialTransaction(SETIPTransaction(data))
 
     async def SetTraceVariablesList(self, idxs):
         """
@@ -215,29 +217,61 @@ class YAPLCObject_UDP(object):
         these indexes to registred variables in PLC debugger
         """
         buff = b""
-        self.TransactionLock.acquire()
-        if idxs:
-            # keep a copy of requested idx
-            await self.HandleSerialTransaction(SET_TRACE_RESETransaction())
-            self._Idxs = idxs[:]
-            inx = 0
-            for idx, iectype in idxs:
-                inx += 1
-                idxstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(idx)), 4)
-                buff += idxstr + bytes([0, ])
-                if len(buff) > 150:
+        async with self.TransactionLock:
+            if self.TraceDiffSupported is not False and \
+               await self._SetTraceVariablesDiff(idxs):
+                return
+            self._TraceIdxs = None
+            if idxs:
+                # keep a copy of requested idx
+                await self.HandleSerialTransaction(SET_TRACE_RESETransaction())
+                self._Idxs = idxs[:]
+                inx = 0
+                for idx, iectype in idxs:
+                    inx += 1
+                    idxstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(idx)), 4)
+                    buff += idxstr + bytes([0, ])
+                    if len(buff) > 150:
+                        await self.HandleSerialTransaction(SET_TRACE_VARIABLETransaction(buff))
+                        buff = b''
+                    self.confnodesroot.ShowPLCProgress(status=(_('Setting Monitor Variable %d/%d') % (inx, len(idxs))),
+                                                       progress=inx * 100 / len(idxs))
+                if buff:
                     await self.HandleSerialTransaction(SET_TRACE_VARIABLETransaction(buff))
-                    buff = b''
-                self.confnodesroot.ShowPLCProgress(status=(_('Setting Monitor Variable %d/%d') % (inx, len(idxs))),
-                                                   progress=inx * 100 / len(idxs))
-            if buff:
+                self.confnodesroot.HidePLCProgress()
+            else:
+                buff = b""
+                self._Idxs = []
                 await self.HandleSerialTransaction(SET_TRACE_VARIABLETransaction(buff))
-            self.confnodesroot.HidePLCProgress()
-        else:
-            buff = b""
-            self._Idxs = []
-            await self.HandleSerialTransaction(SET_TRACE_VARIABLETransaction(buff))
-        self.TransactionLock.release()
+
+    async def _SetTraceVariablesDiff(self, idxs):
+        """
+        Register trace indexes by sending only difference with previously
+        registered ones, or whole set if target doesn't know them.
+        Return True if target acknowledged expected set.
+        """
+        new = sorted(set(idx for idx, _iectype in idxs))
+        new_hash = TraceIndexesHash(new)
+        bases = [[]]
+        if self._TraceIdxs:
+            bases.insert(0, self._TraceIdxs)
+        for base in bases:
+            base_set = set(base)
+            removed = sorted(base_set.difference(new))
+            added = sorted(set(new).difference(base_set))
+            strbuf = await self.HandleSerialTransaction(
+                SET_TRACE_DIFFTransaction(TraceIndexesHash(base), removed, added))
+            if strbuf is None:
+                # older targets don't answer
+                if self.TraceDiffSupported is None:
+                    self.TraceDiffSupported = False
+                return False
+            self.TraceDiffSupported = True
+            if len(strbuf) == 4 and ctypes.c_uint32.from_buffer_copy(strbuf).value == new_hash:
+                self._TraceIdxs = new
+                self._Idxs = idxs[:]
+                return True
+        return False
 
     async def SetForceVariablesList(self, idxs):
         """
@@ -245,35 +279,32 @@ class YAPLCObject_UDP(object):
         these indexes to registred variables in PLC debugger
         """
         buff = b""
-        self.TransactionLock.acquire()
-        self._Idxs = idxs[:]
-        inx = 0
-        for idx, iectype, force in idxs:
-            inx += 1
-            idxstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(idx)), 4)
-            if force != None:
-                c_type, unpack_func, pack_func = TypeTranslator.get(iectype, (None, None, None))
-                forced_type_size = ctypes.sizeof(c_type) \
-                    if iectype != "STRING" else len(force) + 1
-                forced_type_size_str = bytes([forced_type_size, ])
-                forcestr = ctypes.string_at(
-                    ctypes.pointer(
-                        pack_func(c_type, force)),
-                    forced_type_size)
-                buff += idxstr + forced_type_size_str + forcestr
-            else:
-                buff += idxstr + bytes([0, ])
-        if buff:
-            await self.HandleSerialTransaction(SET_FORCE_VARIABLETransaction(buff))
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            self._Idxs = idxs[:]
+            inx = 0
+            for idx, iectype, force in idxs:
+                inx += 1
+                idxstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(idx)), 4)
+                if force != None:
+                    c_type, unpack_func, pack_func = TypeTranslator.get(iectype, (None, None, None))
+                    forced_type_size = ctypes.sizeof(c_type) \
+                        if iectype != "STRING" else len(force) + 1
+                    forced_type_size_str = bytes([forced_type_size, ])
+                    forcestr = ctypes.string_at(
+                        ctypes.pointer(
+                            pack_func(c_type, force)),
+                        forced_type_size)
+                    buff += idxstr + forced_type_size_str + forcestr
+                else:
+                    buff += idxstr + bytes([0, ])
+            if buff:
+                await self.HandleSerialTransaction(SET_FORCE_VARIABLETransaction(buff))
 
     async def GetTraceVariables(self):
         """
         Return a list of variables, corresponding to the list of required idx
         """
-        self.TransactionLock.acquire()
         strbuf = await self.HandleSerialTransaction(GET_TRACE_VARIABLETransaction())
-        self.TransactionLock.release()
         TraceVariables = []
         if strbuf is not None and len(strbuf) >= 4:
             size = len(strbuf) - 4
@@ -288,14 +319,41 @@ class YAPLCObject_UDP(object):
         return self.PLCStatus, TraceVariables
 
     async def ResetLogCount(self):
-        self.TransactionLock.acquire()
-        await self.HandleSerialTransaction(RESET_LOGCOUNTSTransaction())
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            await self.HandleSerialTransaction(RESET_LOGCOUNTSTransaction())
 
     async def GetLogMessage(self, level, msgid):
-        self.TransactionLock.acquire()
         strbuf = await self.HandleSerialTransaction(GET_LOGMSGTransaction(level, msgid))
-        self.TransactionLock.release()
+        return self._DecodeLogMessage(strbuf)
+
+    async def GetLogMessages(self, level, first, count, max_bytes=LogMessagesMaxBytes):
+        """
+        Same as PLCObject.GetLogMessages. Target has no ranged request, so
+        messages are requested by batches of LogMsgPipelineDepth requests
+        in flight.
+        """
+        messages = []
+        size = 0
+        depth = self.LogMsgPipelineDepth
+        for start in range(first, first + count, depth):
+            msgids = range(start, min(start + depth, first + count))
+            strbufs = await asyncio.gather(*[
+                self.HandleSerialTransaction(GET_LOGMSGTransaction(level, msgid))
+                for msgid in msgids])
+            for msgid, strbuf in zip(msgids, strbufs):
+                if strbuf is None:
+                    # transaction failed, don't insist
+                    return PackLogMessages(messages)
+                message = self._DecodeLogMessage(strbuf)
+                if message is None:
+                    continue
+                size += LogMessageHeaderSize + len(message[0])
+                if messages and size > max_bytes:
+                    return PackLogMessages(messages)
+                messages.append([msgid] + message)
+        return PackLogMessages(messages)
+
+    def _DecodeLogMessage(self, strbuf):
         if strbuf is not None and len(strbuf) > 12:
             cbuf = ctypes.cast(
                 ctypes.c_char_p(strbuf[:12]),
@@ -336,26 +394,25 @@ class YAPLCObject_UDP(object):
             self.inx += 1
             self.confnodesroot.ShowPLCProgress(status=(_('Downloading')), progress=self.inx * 100 / self.pktsize)
 
-        self.TransactionLock.acquire()
-        cnt = 0
-        await self.HandleSerialTransaction(SETRTCTransaction())
-        await self.HandleSerialTransaction(TFTP_PLCBINTransaction())
-        while True:
-            try:
-                self.inx = 0
-                t = tftpy.TftpClient(self.ip, options={'blksize': 512})
-                res = True
-                t.upload(destname, src, packethook=hook, timeout=2)
-                break
-            except Exception as ex:
-                if self.confnodesroot:
-                    self.confnodesroot.logger.write_error(str(ex))
-                    self.confnodesroot.logger.write_error("正在重试 %d / 10..." % (cnt + 1))
-                    # self.confnodesroot.logger.write_error(traceback.format_exc())
-                res = None
-            cnt += 1
-            if cnt == 10: break
-        self.TransactionLock.release()
+        async with self.TransactionLock:
+            cnt = 0
+            await self.HandleSerialTransaction(SETRTCTransaction())
+            await self.HandleSerialTransaction(TFTP_PLCBINTransaction())
+            while True:
+                try:
+                    self.inx = 0
+                    t = tftpy.TftpClient(self.ip, options={'blksize': 512})
+                    res = True
+                    t.upload(destname, src, packethook=hook, timeout=2)
+                    break
+                except Exception as ex:
+                    if self.confnodesroot:
+                        self.confnodesroot.logger.write_error(str(ex))
+                        self.confnodesroot.logger.write_error("正在重试 %d / 10..." % (cnt + 1))
+                        # self.confnodesroot.logger.write_error(traceback.format_exc())
+                    res = None
+                cnt += 1
+                if cnt == 10: break
         if self.confnodesroot:
             self.confnodesroot.HidePLCProgress()
         return res
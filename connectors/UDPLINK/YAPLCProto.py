@@ -3,16 +3,61 @@
 
 # YAPLC connector, based on LPCProto.py and LPCAppProto.py
 # from PLCManager
+import asyncio
 import ctypes
 import datetime
-import logging
 import socket
+import zlib
 
 YAPLC_STATUS = {0xaa: "Started",
                 0x5a: "Empty",
                 0x55: "Stopped"}
 
 
+def _EncodeVarUInt(value):
+    """
+    Encode unsigned integer as LEB128 varint
+    """
+    res = bytearray()
+    while value > 0x7f:
+        res.append((value & 0x7f) | 0x80)
+        value >>= 7
+    res.append(value)
+    return bytes(res)
+
+
+def EncodeIndexRanges(idxs):
+    """
+    Encode sorted debug indexes as a range list : number of ranges, then
+    for each range its gap from previous range end and its length, all
+    as varints. Consecutive indexes, usual for variables of a same
+    POU, take a couple of bytes per range.
+    @param idxs: sorted list of distinct indexes
+    @return: encoded range list
+    """
+    ranges = []
+    for idx in idxs:
+        if ranges and ranges[-1][1] == idx:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([idx, idx + 1])
+    res = [_EncodeVarUInt(len(ranges))]
+    end = 0
+    for start, stop in ranges:
+        res.append(_EncodeVarUInt(start - end))
+        res.append(_EncodeVarUInt(stop - start))
+        end = stop
+    return b"".join(res)
+
+
+def TraceIndexesHash(idxs):
+    """
+    Hash of registered trace indexes, as acknowledged by target : CRC32
+    of sorted indexes as 32 bits integers. Empty set hashes to 0.
+    """
+    return zlib.crc32(bytes((ctypes.c_uint32 * len(idxs))(*idxs)))
+
+
 class YAPLCProtoError(Exception):
     """Exception class"""
 
@@ -23,67 +68,109 @@ class YAPLCProtoError(Exception):
         return "Exception in PLC protocol : " + str(self.msg)
 
 
+class _YAPLCDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, proto):
+        self.proto = proto
+
+    def datagram_received(self, data, addr):
+        self.proto._ReplyReceived(data)
+
+    def error_received(self, exc):
+        self.proto._FailPending(exc)
+
+
 class YAPLCProto:
+    """
+    YAPLC protocol over UDP, on asyncio datagram transport.
+    A reply is a whole datagram, so requests of different commands can
+    be in flight at once. As protocol has no request tag, replies are
+    dispatched to pending requests by echoed command byte, and only one
+    request per command is in flight. After a timeout, command stays
+    locked for another timeout, so that a late reply is dropped rather
+    than taken as reply to next request of the same command.
+    """
 
     def __init__(self, ip, port, timeout):
-        # serialize access lock
         self.port = port
         self.ip = ip
         self.timeout = timeout
-        # open serial port
-        self.udp = None
-        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # bufsize = self.udp.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
-        # self.udp.connect((ip, port))
-        self.udp.settimeout(timeout)
-        # timeout = self.udp.gettimeout()
-        # self.udp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        # StartCoroutine(self.Open(), self)
+        self.transport = None
+        # command -> future of pending request
+        self.Pending = {}
+        # command -> lock serializing requests of that command
+        self.CommandLocks = {}
+        self.OpenLock = asyncio.Lock()
+
+    async def Open(self):
+        async with self.OpenLock:
+            if self.transport is None:
+                loop = asyncio.get_running_loop()
+                self.transport, _protocol = await loop.create_datagram_endpoint(
+                    lambda: _YAPLCDatagramProtocol(self), family=socket.AF_INET)
 
     def flush(self):
-        try:
-            self.udp.settimeout(0)
-            self.udp.recv(1024)
-        except:
-            pass
+        # late replies to failed requests are dropped by HandleTransaction
+        pass
 
     async def ready(self):
+        await self.Open()
         return True
 
-    def Write(self, bv):
-        logging.debug(bv)
-        if bv == b'l':
-            logging.debug(bv)
-
-        return self.udp.sendto(bv, (self.ip, self.port))
-
-    def Read(self, nbytes):
-        return self.udp.recv(nbytes)
+    def _ReplyReceived(self, data):
+        if not data:
+            return
+        future = self.Pending.pop(data[0], None)
+        if future is not None and not future.done():
+            future.set_result(data)
 
-    def settimeout(self, val):
-        self.udp.settimeout(val)
+    def _FailPending(self, exc):
+        pending, self.Pending = self.Pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(YAPLCProtoError(exc))
 
     async def HandleTransaction(self, transaction):
         transaction.SetPort(self)
-        # self.flush()
-        # send command, wait ack (timeout)
-        await            transaction.SendCommand()
+        await self.Open()
+        await transaction.SendCommand()
         if transaction.Data:
             await transaction.SendData(transaction.Data)
-        self.Write(bytes(transaction.txbuf))
-        transaction.rxbuf = self.Read(1024)
+        lock = self.CommandLocks.setdefault(transaction.Command, asyncio.Lock())
+        async with lock:
+            future = asyncio.get_running_loop().create_future()
+            self.Pending[transaction.Command] = future
+            try:
+                self.transport.sendto(bytes(transaction.txbuf), (self.ip, self.port))
+                transaction.rxbuf = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                # wait for late reply, to drop it
+                try:
+                    await asyncio.wait_for(future, self.timeout)
+                except (asyncio.TimeoutError, YAPLCProtoError):
+                    pass
+                raise YAPLCProtoError("YAPLC transaction error - no reply from controller!")
+            finally:
+                if self.Pending.get(transaction.Command) is future:
+                    self.Pending.pop(transaction.Command)
         current_plc_status = await transaction.GetCommandAck()
         res = await transaction.GetData()
         return YAPLC_STATUS.get(current_plc_status, "Broken"), res
 
     def close(self):
-        self.udp.close()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._FailPending("connection closed")
 
     def __del__(self):
         self.close()
 
 
 class YAPLCTransaction:
+    # reply carries length prefixed data after ack,
+    # needed to frame replies on stream links
+    HasData = False
 
     def __init__(self, command):
         self.Command = command
@@ -196,6 +283,27 @@ class SET_TRACE_VARIABLETransaction(YAPLCTransaction):
         await self.SendData(self.Data)
 
 
+class SET_TRACE_DIFFTransaction(YAPLCTransaction):
+    """
+    Update registered trace indexes by difference with set known by
+    target. Target applies it only if hash of its registered set matches
+    base_hash, hash 0 meaning registration from scratch. Target keeps
+    indexes sorted, and replies hash of its registered set.
+    """
+    HasData = True
+
+    def __init__(self, base_hash, removed, added):
+        YAPLCTransaction.__init__(self, 0x74)
+        data = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(base_hash)), 4) + \
+            EncodeIndexRanges(removed) + EncodeIndexRanges(added)
+        lengthstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(len(data))), 4)
+        self.Data = lengthstr + data
+
+    async def ExchangeData(self):
+        await self.SendData(self.Data)
+        return await self.GetData()
+
+
 class SET_FORCE_VARIABLETransaction(YAPLCTransaction):
     def __init__(self, data):
         YAPLCTransaction.__init__(self, 0x72)
@@ -210,6 +318,8 @@ class SET_FORCE_VARIABLETransaction(YAPLCTransaction):
 
 
 class GET_TRACE_VARIABLETransaction(YAPLCTransaction):
+    HasData = True
+
     def __init__(self):
         YAPLCTransaction.__init__(self, 0x65)
 
@@ -217,6 +327,8 @@ class GET_TRACE_VARIABLETransaction(YAPLCTransaction):
 
 
 class GET_PLCIDTransaction(YAPLCTransaction):
+    HasData = True
+
     def __init__(self):
         YAPLCTransaction.__init__(self, 0x66)
 
@@ -224,6 +336,8 @@ class GET_PLCIDTransaction(YAPLCTransaction):
 
 
 class GET_LOGCOUNTSTransaction(YAPLCTransaction):
+    HasData = True
+
     def __init__(self):
         YAPLCTransaction.__init__(self, 0x67)
 
@@ -231,6 +345,8 @@ class GET_LOGCOUNTSTransaction(YAPLCTransaction):
 
 
 class GET_LOGMSGTransaction(YAPLCTransaction):
+    HasData = True
+
     def __init__(self, level, msgid):
         YAPLCTransaction.__init__(self, 0x68)
         msgidstr = ctypes.string_at(ctypes.pointer(ctypes.c_int(msgid)), 4)
@@ -287,6 +403,8 @@ class SETIPTransaction(YAPLCTransaction):
 
 
 class GET_PLCRTEVERTransaction(YAPLCTransaction):
+    HasData = True
+
     def __init__(self):
         YAPLCTransaction.__init__(self, 0x70)
 
@@ -294,6 +412,8 @@ class GET_PLCRTEVERTransaction(YAPLCTransaction):
 
 
 class GET_Thread_INFO(YAPLCTransaction):
+    HasData = True
+
     def __init__(self):
         YAPLCTransaction.__init__(self, 0x71)
 
@@ -301,6 +421,8 @@ class GET_Thread_INFO(YAPLCTransaction):
 
 
 class GET_MEM(YAPLCTransaction):
+    HasData = True
+
     def __init__(self, addr, length):
         YAPLCTransaction.__init__(self, 0x73)
         addrstr = ctypes.string_at(ctypes.pointer(ctypes.c_uint32(addr)), 4)
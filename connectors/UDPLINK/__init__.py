@@ -79,6 +79,9 @@ def _UDPLINK_connector_factory(cls, uri, confnodesroot):
             global _SocketSession
             _SocketSession = YAPLCObject_UDP(confnodesroot, ip)
 
+        # explicitly declared so that log viewer can detect bulk retrieval
+        GetLogMessages = staticmethod(SocketSessionProcMapper("GetLogMessages"))
+
         def __getattr__(self, attrName):
             member = self.__dict__.get(attrName, None)
             if member is None:
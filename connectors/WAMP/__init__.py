@@ -143,6 +143,9 @@ def WAMP_connector_factory(uri, confnodesroot):
             #
             # reactor.stop()
 
+        # explicitly declared so that log viewer can detect bulk retrieval
+        GetLogMessages = staticmethod(WampSessionProcMapper("GetLogMessages"))
+
         def __getattr__(self, attrName):
             member = self.__dict__.get(attrName, None)
             if member is None:
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Beremiz, a Integrated Development Environment for
+# programming IEC 61131-3 automates supporting plcopen standard and CanFestival.
+#
+# See COPYING file for copyrights details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import numpy
+
+# -------------------------------------------------------------------------------
+#                          Samples retention policy
+# -------------------------------------------------------------------------------
+
+# Maximum number of samples kept per debugged variable (None: unbounded)
+SAMPLES_MAX = 1 << 18
+# When maximum is reached, older half of samples is downsampled by 2 if
+# True, dropped if False
+SAMPLES_DOWNSAMPLE = True
+
+SAMPLES_INITIAL_CAPACITY = 256
+
+# Number of samples, or of lower level blocks, summarized by a block of
+# envelope pyramid
+ENVELOPE_BLOCK_SIZE = 8
+
+# Envelope block columns: minimum value and index of its sample, maximum
+# value and index of its sample
+ENVELOPE_COLUMNS = 4
+
+# -------------------------------------------------------------------------------
+#                          Debug Sample Store Class
+# -------------------------------------------------------------------------------
+
+
+class DebugSampleStore(object):
+    """
+    Class that stores debug samples as rows of a numpy table, first column
+    being tick. Table capacity is doubled when full, so that appending
+    samples is amortized O(1), and samples kept are always contiguous.
+    Ticks are expected to be increasing, so that tick lookup is O(log n).
+
+    When oldest samples are dropped, samples kept are a window sliding over
+    table, so that dropping is O(1). Table is then twice as big as maximum
+    number of samples, and samples are moved back to its beginning only
+    once window reaches its end.
+
+    If an envelope column is given, a pyramid of min/max envelopes of this
+    column is maintained as samples are appended. Level k of pyramid is
+    made of blocks summarizing ENVELOPE_BLOCK_SIZE ** (k + 1) table rows.
+    Range of values of this column in samples kept is also maintained.
+    """
+
+    def __init__(self, columns, max_samples=SAMPLES_MAX, downsample=SAMPLES_DOWNSAMPLE,
+                 envelope_column=None):
+        """
+        Constructor
+        @param columns: Number of columns of a sample
+        @param max_samples: Maximum number of samples kept (None: unbounded)
+        @param downsample: Downsample older samples instead of dropping them
+        when maximum is reached
+        @param envelope_column: Column of sample which envelope is maintained
+        (default None, no envelope)
+        """
+        self.Columns = columns
+        self.MaxSamples = max_samples
+        self.Downsample = downsample
+        self.EnvelopeColumn = envelope_column
+        self.Reset()
+
+    def Reset(self):
+        """
+        Remove all samples
+        """
+        self.Table = numpy.empty((SAMPLES_INITIAL_CAPACITY, self.Columns))
+        # Samples kept are table rows [Start, Start + Count[
+        self.Start = 0
+        self.Count = 0
+        # List of DebugSampleStore of envelope blocks, one per level
+        self.Envelope = []
+        # Range of values in envelope column, stale if an extreme was dropped
+        self.MinValue = None
+        self.MaxValue = None
+        self.RangeStale = False
+
+    def __len__(self):
+        return self.Count
+
+    def GetData(self):
+        """
+        Return samples stored
+        @return: numpy.array view of samples, valid until next append
+        """
+        return self.Table[self.Start:self.Start + self.Count]
+
+    def GetTicks(self):
+        """
+        Return ticks of samples stored
+        @return: numpy.array view of ticks, valid until next append
+        """
+        return self.Table[self.Start:self.Start + self.Count, 0]
+
+    def GetValueRange(self):
+        """
+        Return range of values of envelope column in samples stored
+        @return: (minimum_value, maximum_value), (None, None) if store is
+        empty
+        """
+        return self.MinValue, self.MaxValue
+
+    def _Forget(self, samples):
+        """
+        Check if samples being removed reach value range, that will have to
+        be computed again
+        @param samples: numpy.array of samples removed
+        """
+        if self.EnvelopeColumn is not None and len(samples) > 0:
+            values = samples[:, self.EnvelopeColumn]
+            if values.min() <= self.MinValue or values.max() >= self.MaxValue:
+                self.RangeStale = True
+
+    def _MakeRoom(self, size):
+        """
+        Apply retention policy to keep room for size new samples
+        @param size: Number of new samples
+        """
+        count = self.Count
+        if self.Downsample:
+            # Keep one sample out of two in older half
+            data = self.GetData()
+            half = count // 2
+            self._Forget(data[1:half:2])
+            older = data[:half:2].copy()
+            kept = len(older)
+            self.Table[kept:kept + count - half] = data[half:count]
+            self.Table[:kept] = older
+            self.Start = 0
+            count = kept + count - half
+            # Samples moved, envelope will be rebuilt
+            self.Envelope = []
+        # Drop oldest samples still exceeding maximum, by sliding window
+        drop = max(0, count + size - self.MaxSamples)
+        if drop > 0:
+            self._Forget(self.Table[self.Start:self.Start + drop])
+            self.Start += drop
+            count -= drop
+        self.Count = count
+
+    def Append(self, samples):
+        """
+        Add samples at end of store
+        @param samples: numpy.array or list of samples
+        """
+        samples = numpy.asarray(samples, dtype=float).reshape(-1, self.Columns)
+        if len(samples) == 0:
+            return
+        if self.MaxSamples is not None:
+            if len(samples) > self.MaxSamples:
+                self.Reset()
+                samples = samples[-self.MaxSamples:]
+            elif self.Count + len(samples) > self.MaxSamples:
+                self._MakeRoom(len(samples))
+        count = self.Count + len(samples)
+        capacity = len(self.Table)
+        if self.Start + count > capacity:
+            data = self.GetData()
+            if self.Start >= count:
+                # Window reached end of table, move it back to beginning
+                self.Table[:self.Count] = data
+            else:
+                # Table grows, up to twice maximum if window slides over it
+                while count > capacity or \
+                        self.Start > 0 and 2 * count > capacity:
+                    capacity *= 2
+                if self.MaxSamples is not None:
+                    capacity = max(count, min(capacity, self.MaxSamples * (
+                        1 if self.Downsample else 2)))
+                table = numpy.empty((capacity, self.Columns))
+                table[:self.Count] = data
+                self.Table = table
+            if self.Start > 0:
+                # Samples moved, envelope will be rebuilt
+                self.Start = 0
+                self.Envelope = []
+        end = self.Start + count
+        self.Table[end - len(samples):end] = samples
+        self.Count = count
+        if self.EnvelopeColumn is not None:
+            self._UpdateEnvelope()
+            self._UpdateRange(samples)
+
+    def _UpdateRange(self, samples):
+        """
+        Update value range with samples appended
+        @param samples: numpy.array of samples appended
+        """
+        if self.RangeStale:
+            self.MinValue, self.MaxValue = self._GetRange(
+                self.Start, self.Start + self.Count)
+            self.RangeStale = False
+        else:
+            values = samples[:, self.EnvelopeColumn]
+            min_value = float(values.min())
+            max_value = float(values.max())
+            self.MinValue = (min(self.MinValue, min_value)
+                             if self.MinValue is not None
+                             else min_value)
+            self.MaxValue = (max(self.MaxValue, max_value)
+                             if self.MaxValue is not None
+                             else max_value)
+
+    def _UpdateEnvelope(self):
+        """
+        Add envelope blocks completed by samples appended to each level
+        """
+        size = ENVELOPE_BLOCK_SIZE
+        # Level 0 blocks are computed from samples
+        lower = self.Table[:self.Start + self.Count, self.EnvelopeColumn]
+        lower_mins = lower_maxs = lower
+        lower_mins_idx = lower_maxs_idx = None
+        level_idx = 0
+        while len(lower) >= size:
+            if level_idx == len(self.Envelope):
+                self.Envelope.append(
+                    DebugSampleStore(ENVELOPE_COLUMNS, max_samples=None))
+            level = self.Envelope[level_idx]
+            first, last = len(level), len(lower) // size
+            if last > first:
+                blocks = numpy.empty((last - first, ENVELOPE_COLUMNS))
+                for values, values_idx, arg, column in [
+                        (lower_mins, lower_mins_idx, numpy.argmin, 0),
+                        (lower_maxs, lower_maxs_idx, numpy.argmax, 2)]:
+                    values = values[first * size:last * size].reshape(-1, size)
+                    pos = arg(values, axis=1)
+                    rows = numpy.arange(len(values))
+                    blocks[:, column] = values[rows, pos]
+                    # Index of sample reached, in samples or in lower level
+                    idx = (first + rows) * size + pos
+                    blocks[:, column + 1] = (
+                        idx if values_idx is None else values_idx[idx])
+                level.Append(blocks)
+            lower = level.GetData()
+            lower_mins, lower_mins_idx = lower[:, 0], lower[:, 1]
+            lower_maxs, lower_maxs_idx = lower[:, 2], lower[:, 3]
+            level_idx += 1
+
+    def _GetRange(self, start, end):
+        """
+        Return range of values of envelope column in given index range,
+        using coarsest envelope blocks in range
+        @param start: Index of first sample in table
+        @param end: Index following last sample in table
+        @return: (minimum_value, maximum_value)
+        """
+        parts = [(start, end)]
+        mins = []
+        maxs = []
+        block = ENVELOPE_BLOCK_SIZE ** len(self.Envelope)
+        for level in reversed(self.Envelope):
+            blocks = level.GetData()
+            remaining = []
+            for part_start, part_end in parts:
+                first = -(-part_start // block)
+                last = max(min(part_end // block, len(blocks)), first)
+                if last > first:
+                    mins.append(blocks[first:last, 0].min())
+                    maxs.append(blocks[first:last, 2].max())
+                    remaining.extend([(part_start, first * block),
+                                      (last * block, part_end)])
+                else:
+                    remaining.append((part_start, part_end))
+            parts = [(part_start, part_end)
+                     for part_start, part_end in remaining
+                     if part_end > part_start]
+            block //= ENVELOPE_BLOCK_SIZE
+
+        # Samples out of envelope blocks in range are summarized directly
+        for part_start, part_end in parts:
+            values = self.Table[part_start:part_end, self.EnvelopeColumn]
+            mins.append(values.min())
+            maxs.append(values.max())
+        return float(min(mins)), float(max(maxs))
+
+    def _GetEnvelopeIndexes(self, start, end, points):
+        """
+        Return indexes of samples making min/max envelope of samples in
+        given index range
+        @param start: Index of first sample in table
+        @param end: Index following last sample in table
+        @param points: Maximum number of min/max pairs
+        @return: numpy.array of samples indexes in table, sorted
+        """
+        # Use coarsest level with at least one block per pair
+        level_idx = -1
+        block = 1
+        while level_idx + 1 < len(self.Envelope) and \
+                (end - start) // (block * ENVELOPE_BLOCK_SIZE) >= points:
+            level_idx += 1
+            block *= ENVELOPE_BLOCK_SIZE
+        indexes = []
+        if level_idx < 0:
+            # Samples are their own block
+            values = self.Table[start:end, self.EnvelopeColumn]
+            values_idx = numpy.arange(start, end)
+            blocks = numpy.column_stack([values, values_idx, values, values_idx])
+
+        else:
+            level = self.Envelope[level_idx].GetData()
+
+            # Samples out of level blocks in range are summarized directly
+            first = min(-(-start // block), len(level))
+            last = max(min(end // block, len(level)), first)
+            values = self.Table[:, self.EnvelopeColumn]
+            for part_start, part_end in [(start, first * block), (last * block, end)]:
+                if part_end > part_start:
+                    part = values[part_start:part_end]
+                    indexes.extend([part_start + numpy.argmin(part),
+                                    part_start + numpy.argmax(part)])
+            blocks = level[first:last]
+
+        # Blocks in range are merged in at most points groups
+        group = -(-len(blocks) // points)
+        if len(blocks) > 0:
+            padding = -len(blocks) % group
+            for column, arg, pad in [(0, numpy.argmin, numpy.inf),
+                                     (2, numpy.argmax, -numpy.inf)]:
+                values = numpy.append(blocks[:, column], [pad] * padding)
+                values = values.reshape(-1, group)
+                pos = numpy.arange(len(values)) * group + arg(values, axis=1)
+                indexes.append(blocks[pos, column + 1].astype(int))
+
+        return numpy.unique(numpy.hstack([numpy.asarray(idx, dtype=int).ravel()
+                                          for idx in indexes]))
+
+    def GetEnvelope(self, start, end, points):
+        """
+        Return samples in given index range, reduced to their min/max
+        envelope if more than twice given number of points
+        @param start: Index of first sample
+        @param end: Index following last sample
+        @param points: Number of min/max pairs wanted (i.e. pixel columns)
+        @return: numpy.array of samples, in tick order
+        """
+        points = max(1, points)
+        if self.EnvelopeColumn is None or end - start <= 2 * points:
+            return self.GetData()[start:end]
+        return self.Table[self._GetEnvelopeIndexes(
+            self.Start + start, self.Start + end, points)]
+
+    def GetNearestIndex(self, tick, adjust):
+        """
+        Return index of nearest sample from tick given
+        @param tick: Tick where find nearest sample
+        @param adjust: Constraint for sample position from tick
+                       -1: older than tick
+                       1:  newer than tick
+                       0:  doesn't matter
+        @return: Index of nearest sample, None if store is empty
+        """
+        if self.Count == 0:
+            return None
+        ticks = self.GetTicks()
+
+        # Get first nearest sample from tick
+        idx = numpy.searchsorted(ticks, tick)
+        if idx == len(ticks) or \
+           idx > 0 and tick - ticks[idx - 1] <= ticks[idx] - tick:
+            idx = numpy.searchsorted(ticks, ticks[idx - 1])
+
+        # Adjust sample index according to constraint
+        if adjust < 0 and ticks[idx] > tick and idx > 0 or \
+           adjust > 0 and ticks[idx] < tick and idx < len(ticks):
+            idx += adjust
+
+        return idx
+
+
+if __name__ == "__main__":
+    import timeit
+
+    store = DebugSampleStore(3, max_samples=None)
+    store.Append([[float(i), float(i % 7), 0.] for i in range(0, 2000, 2)])
+    reference = store.GetData().copy()
+    for tick in [-5, 0, 1, 3, 777, 1998, 2500]:
+        for adjust in [-1, 0, 1]:
+            # same as former linear search
+            idx = numpy.argmin(abs(reference[:, 0] - tick))
+            if adjust < 0 and reference[idx, 0] > tick and idx > 0 or \
+               adjust > 0 and reference[idx, 0] < tick and idx < len(reference):
+                idx += adjust
+            assert store.GetNearestIndex(tick, adjust) == idx
+
+    store = DebugSampleStore(3, max_samples=1000)
+    for i in range(100):
+        store.Append([[float(i * 10 + j), 0., 0.] for j in range(10)])
+    ticks = store.GetTicks()
+    assert len(store) <= 1000 and ticks[-1] == 999. and (numpy.diff(ticks) > 0).all()
+    store = DebugSampleStore(3, max_samples=1000, downsample=False)
+    for i in range(100):
+        store.Append([[float(i * 10 + j), 0., 0.] for j in range(10)])
+    assert (store.GetTicks() == numpy.arange(0., 1000.)).all()
+    store.Append(numpy.zeros((1500, 3)))
+    assert len(store) == 1000
+
+    # value range and envelope only cover samples kept
+    values = numpy.random.RandomState(1).normal(size=20000)
+    values[500] = 100.
+    values[2500] = -100.
+    for downsample in [False, True]:
+        store = DebugSampleStore(3, max_samples=1000, downsample=downsample,
+                                 envelope_column=1)
+        for i in range(0, 20000, 10):
+            store.Append(numpy.column_stack([numpy.arange(i, i + 10),
+                                             values[i:i + 10],
+                                             numpy.zeros(10)]))
+            data = store.GetData()
+            assert (numpy.diff(data[:, 0]) > 0).all() and data[-1, 0] == i + 9
+            assert store.GetValueRange() == (data[:, 1].min(), data[:, 1].max())
+            if not downsample:
+                assert (data[:, 0] == numpy.arange(max(0, i - 990), i + 10)).all()
+            if i % 970 == 0:
+                envelope = store.GetEnvelope(3, len(store) - 5, 50)
+                assert envelope[:, 1].min() == data[3:-5, 1].min()
+                assert envelope[:, 1].max() == data[3:-5, 1].max()
+
+    store = DebugSampleStore(3, max_samples=None, envelope_column=1)
+    values = numpy.random.RandomState(0).normal(size=100000)
+    values[12345] = 100.
+    values[54321] = -100.
+    for i in range(0, 100000, 1000):
+        store.Append(numpy.column_stack([numpy.arange(i, i + 1000),
+                                         values[i:i + 1000],
+                                         numpy.zeros(1000)]))
+    for start, end, points in [(0, 100000, 500), (7, 99991, 300), (12000, 60000, 1000), (10, 500, 200)]:
+        envelope = store.GetEnvelope(start, end, points)
+        ticks = envelope[:, 0]
+        assert len(envelope) <= 2 * points + 4 and (numpy.diff(ticks) > 0).all()
+        assert ticks[0] >= start and ticks[-1] < end
+        assert envelope[:, 1].min() == values[start:end].min()
+        assert envelope[:, 1].max() == values[start:end].max()
+
+    # benchmark : 10 minutes of samples of one variable, received in
+    # batches of 10 samples each 100 ms, appended to numpy table
+    # versus store
+    batch = [[float(i), float(i), 0.] for i in range(10)]
+
+    def use_numpy_append():
+        data = numpy.array([]).reshape(0, 3)
+        for i in range(6000):
+            data = numpy.append(data, batch, axis=0)
+
+    def use_store():
+        store = DebugSampleStore(3)
+        for i in range(6000):
+            store.Append(batch)
+
+    # same batches, kept in a window of 10000 samples dropping oldest ones
+    def use_store_window():
+        store = DebugSampleStore(3, max_samples=10000, downsample=False,
+                                 envelope_column=1)
+        for i in range(6000):
+            store.Append(batch)
+
+    for name, func in [("numpy.append", use_numpy_append), ("store", use_store),
+                       ("window", use_store_window)]:
+        print("%-12s : %.0f ms" % (name, min(timeit.repeat(func, number=1, repeat=3)) * 1000))
+
+    # benchmark : redraw latency of a plot 1000 pixels wide against
+    # capture length, with all samples and with min/max envelope
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot
+    except ImportError:
+        matplotlib = None
+    if matplotlib is not None:
+        figure = matplotlib.pyplot.figure(figsize=(10, 2), dpi=100)
+        axes = figure.add_axes([0., 0., 1., 1.])
+        plot = axes.plot([], [])[0]
+    for length in [10000, 100000, 1000000]:
+        store = DebugSampleStore(3, max_samples=None, envelope_column=1)
+        for i in range(0, length, 10000):
+            store.Append(numpy.column_stack([numpy.arange(i, i + 10000),
+                                             numpy.sin(numpy.arange(i, i + 10000) / 1000.),
+                                             numpy.zeros(10000)]))
+        for name, get_data in [
+                ("all samples", lambda: store.GetData()),
+                ("envelope", lambda: store.GetEnvelope(0, len(store), 1000))]:
+
+            def redraw():
+                data = get_data()
+                if matplotlib is not None:
+                    plot.set_data(data[:, 0], data[:, 1])
+                    axes.set_xlim(0, length)
+                    axes.set_ylim(-1, 1)
+                    figure.canvas.draw()
+
+            print("%7d samples, %-11s : %.1f ms" % (
+                length, name, min(timeit.repeat(redraw, number=1, repeat=3)) * 1000))
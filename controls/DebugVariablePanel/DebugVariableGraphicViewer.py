@@ -1139,10 +1139,14 @@ class DebugVariableGraphicViewer(DebugVariableViewer, FigureCanvas):
                 # Init list of data range for each variable displayed
                 ranges = []
 
+                # Data is reduced to its min/max envelope, one pair of
+                # points per pixel column
+                points = int(self.Axes.bbox.width)
+
                 # Get data and range for each variable displayed
                 for idx, item in enumerate(self.Items):
                     data, min_value, max_value = item.GetDataAndValueRange(
-                        start_tick, end_tick, not self.ZoomFit)
+                        start_tick, end_tick, not self.ZoomFit, points)
 
                     # Check that data is not empty
                     if data is not None:
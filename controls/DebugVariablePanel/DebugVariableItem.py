@@ -30,6 +30,7 @@ from datetime import timedelta
 import numpy
 
 from graphics.DebugDataConsumer import DebugDataConsumer, TYPE_TRANSLATOR
+from controls.DebugVariablePanel.DebugSampleStore import DebugSampleStore
 
 # -------------------------------------------------------------------------------
 #                 Constant for calculate CRC for string variables
@@ -136,16 +137,23 @@ class DebugVariableItem(DebugDataConsumer):
         """
         return self.VariableType
 
-    def GetData(self, start_tick=None, end_tick=None):
+    def GetData(self, start_tick=None, end_tick=None, points=None):
         """
         Return data stored contained in given range
         @param start_tick: Start tick of given range (default None, first data)
         @param end_tick: end tick of given range (default None, last data)
+        @param points: Number of min/max pairs data can be reduced to, keeping
+        its envelope (default None, all data)
         @return: Data as numpy.array([(tick, value, forced),...])
         """
-        # Return immediately if data empty or none
-        if self.Data is None or len(self.Data) == 0:
-            return self.Data
+        # Return immediately if data none
+        if self.Data is None:
+            return None
+
+        # Return immediately if data empty
+        data = self.Data.GetData()
+        if len(data) == 0:
+            return data
 
         # Find nearest data outside given range indexes
         start_idx = (self.GetNearestData(start_tick, -1)
@@ -153,10 +161,12 @@ class DebugVariableItem(DebugDataConsumer):
                      else 0)
         end_idx = (self.GetNearestData(end_tick, 1)
                    if end_tick is not None
-                   else len(self.Data))
+                   else len(data))
 
         # Return data between indexes
-        return self.Data[start_idx:end_idx]
+        if points is not None:
+            return self.Data.GetEnvelope(start_idx, end_idx, points)
+        return data[start_idx:end_idx]
 
     def GetRawValue(self, index):
         """
@@ -175,18 +185,20 @@ class DebugVariableItem(DebugDataConsumer):
         """
         return self.MinValue, self.MaxValue
 
-    def GetDataAndValueRange(self, start_tick, end_tick, full_range=True):
+    def GetDataAndValueRange(self, start_tick, end_tick, full_range=True, points=None):
         """
         Return variable data and value range for a given tick range
         @param start_tick: Start tick of given range (default None, first data)
         @param end_tick: end tick of given range (default None, last data)
         @param full_range: Value range is calculated on whole data (False: only
         calculated on data in given range)
+        @param points: Number of min/max pairs data can be reduced to, keeping
+        its envelope and thus its value range (default None, all data)
         @return: (numpy.array([(tick, value, forced),...]),
                   min_value, max_value)
         """
         # Get data in given tick range
-        data = self.GetData(start_tick, end_tick)
+        data = self.GetData(start_tick, end_tick, points)
 
         # Value range is calculated on whole data
         if full_range:
@@ -209,7 +221,7 @@ class DebugVariableItem(DebugDataConsumer):
         """
         if self.StoreData and self.IsNumVariable():
             # Init table storing data
-            self.Data = numpy.array([]).reshape(0, 3)
+            self.Data = DebugSampleStore(3, envelope_column=1)
 
             # Init table storing raw data if variable is strin
             self.RawData = ([]
@@ -253,50 +265,44 @@ class DebugVariableItem(DebugDataConsumer):
                                  if len(self.RawData) > 0 else None)
                 last_raw_data_idx = len(self.RawData) - 1
 
-            data_values = []
-            for tick, (value, forced) in list(zip(ticks, values)):
-                # Translate forced flag to float for storing in Data table
-                forced_value = float(forced)
-
-                if self.VariableType in ["STRING", "WSTRING"]:
+                num_values = []
+                extra_values = []
+                for value, forced in values:
                     # String data value is CRC
-                    num_value = (binascii.crc32(value) & STRING_CRC_MASK)
-                elif self.VariableType in ["TIME", "TOD", "DT", "DATE"]:
-                    # Numeric value of time type variables
-                    # is represented in seconds
-                    num_value = float(value.total_seconds())
-                else:
-                    num_value = float(value)
-
-                # Update variable range values
-                self.MinValue = (min(self.MinValue, num_value)
-                                 if self.MinValue is not None
-                                 else num_value)
-                self.MaxValue = (max(self.MaxValue, num_value)
-                                 if self.MaxValue is not None
-                                 else num_value)
-
-                # In the case of string variables, we store raw string value and
-                # forced flag in raw data table. Only changes in this two values
-                # are stored. Index to the corresponding raw value is stored in
-                # data third column
-                if self.VariableType in ["STRING", "WSTRING"]:
-                    raw_data = (value, forced_value)
+                    num_values.append(binascii.crc32(value) & STRING_CRC_MASK)
+
+                    # In the case of string variables, we store raw string value and
+                    # forced flag in raw data table. Only changes in this two values
+                    # are stored. Index to the corresponding raw value is stored in
+                    # data third column
+                    raw_data = (value, float(forced))
                     if len(self.RawData) == 0 or last_raw_data != raw_data:
                         last_raw_data_idx += 1
                         last_raw_data = raw_data
                         self.RawData.append(raw_data)
-                    extra_value = last_raw_data_idx
+                    extra_values.append(last_raw_data_idx)
 
-                # In other case, data third column is forced flag
+            else:
+                if self.VariableType in ["TIME", "TOD", "DT", "DATE"]:
+                    # Numeric value of time type variables
+                    # is represented in seconds
+                    num_values = [value.total_seconds() for value, _forced in values]
                 else:
-                    extra_value = forced_value
+                    num_values = [value for value, _forced in values]
+
+                # In other case, data third column is forced flag
+                extra_values = [forced for _value, forced in values]
 
-                data_values.append(
-                    [float(tick), num_value, extra_value])
+            data_values = numpy.empty((len(ticks), 3))
+            data_values[:, 0] = ticks
+            data_values[:, 1] = num_values
+            data_values[:, 2] = extra_values
 
             # Add New data to stored data table
-            self.Data = numpy.append(self.Data, data_values, axis=0)
+            self.Data.Append(data_values)
+
+            # Update variable range values, that only covers data kept
+            self.MinValue, self.MaxValue = self.Data.GetValueRange()
 
             # Signal to debug variable panel to refresh
             self.Parent.HasNewData = True
@@ -346,10 +352,11 @@ class DebugVariableItem(DebugDataConsumer):
             idx = self.GetNearestData(tick, 0)
 
             # Get value and forced flag at given index
+            data = self.Data.GetData()
             value, forced = \
-                self.RawData[int(self.Data[idx, 2])] \
+                self.RawData[int(data[idx, 2])] \
                 if self.VariableType in ["STRING", "WSTRING"] \
-                else self.Data[idx, 1:3]
+                else data[idx, 1:3]
 
             if self.VariableType in ["TIME", "TOD", "DT", "DATE"]:
                 value = timedelta(seconds=value)
@@ -381,15 +388,4 @@ class DebugVariableItem(DebugDataConsumer):
         if self.Data is None:
             return None
 
-        # Extract data ticks
-        ticks = self.Data[:, 0]
-
-        # Get nearest data from tick
-        idx = numpy.argmin(abs(ticks - tick))
-
-        # Adjust data index according to constraint
-        if adjust < 0 and ticks[idx] > tick and idx > 0 or \
-           adjust > 0 and ticks[idx] < tick and idx < len(ticks):
-            idx += adjust
-
-        return idx
+        return self.Data.GetNearestIndex(tick, adjust)
@@ -36,6 +36,7 @@ matplotlib.use('WX')  # noqa
 from editors.DebugViewer import DebugViewer
 from util.BitmapLibrary import GetBitmap
 
+from controls.DebugVariablePanel.DebugSampleStore import DebugSampleStore
 from controls.DebugVariablePanel.DebugVariableItem import DebugVariableItem
 from controls.DebugVariablePanel.DebugVariableTextViewer import DebugVariableTextViewer
 from controls.DebugVariablePanel.DebugVariableGraphicViewer import *
@@ -202,7 +203,8 @@ class DebugVariablePanel(wx.Panel, DebugViewer):
 
         main_sizer = wx.BoxSizer(wx.VERTICAL)
 
-        self.Ticks = numpy.array([])  # List of tick received
+        self.TicksStore = DebugSampleStore(1)  # Store of tick received
+        self.Ticks = self.TicksStore.GetTicks()  # List of tick received
         self.StartTick = 0  # Tick starting range of data displayed
         self.Fixed = False  # Flag that range of data is fixed
         self.CursorTick = None  # Tick of cursor for displaying values
@@ -347,7 +349,8 @@ class DebugVariablePanel(wx.Panel, DebugViewer):
                 self.StartTick = ticks[0]
 
             # Add tick to list of ticks received
-            self.Ticks = numpy.append(self.Ticks, ticks)
+            self.TicksStore.Append(ticks)
+            self.Ticks = self.TicksStore.GetTicks()
 
             # Update start tick for range if range follow ticks received
             if not self.Fixed or tick < self.StartTick + self.CurrentRange:
@@ -935,7 +938,8 @@ class DebugVariablePanel(wx.Panel, DebugViewer):
         self.ForceRefresh()
 
     def ResetGraphicsValues(self):
-        self.Ticks = numpy.array([])
+        self.TicksStore.Reset()
+        self.Ticks = self.TicksStore.GetTicks()
         self.StartTick = 0
         for panel in self.GraphicPanels:
             panel.ResetItemsData()
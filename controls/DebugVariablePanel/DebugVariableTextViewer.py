@@ -171,6 +171,7 @@ class DebugVariableTextViewer(DebugVariableViewer, wx.Panel):
         self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
         self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
         self.Bind(wx.EVT_LEFT_DCLICK, self.OnLeftDClick)
+        self.Bind(wx.EVT_RIGHT_UP, self.OnRightUp)
         self.Bind(wx.EVT_ENTER_WINDOW, self.OnEnter)
         self.Bind(wx.EVT_LEAVE_WINDOW, self.OnLeave)
         self.Bind(wx.EVT_SIZE, self.OnResize)
@@ -284,6 +285,24 @@ class DebugVariableTextViewer(DebugVariableViewer, wx.Panel):
         if list(self.ItemsDict.values())[0].IsNumVariable():
             self.ParentWindow.ToggleViewerType(self)
 
+    def OnRightUp(self, event):
+        """
+        Function called when mouse right button is released
+        @param event: wx.MouseEvent
+        """
+        item = list(self.ItemsDict.values())[0]
+        # Only floating point variables have a deadband
+        if self.ParentWindow.GetDataType(item.GetVariable()) in ["REAL", "LREAL"]:
+            menu = wx.Menu(title='')
+
+            new_id = wx.NewIdRef()
+            menu.Append(helpString='', id=new_id, kind=wx.ITEM_NORMAL, text=_("Set deadband..."))
+            self.Bind(wx.EVT_MENU, lambda evt: self.SetDeadband(item), id=new_id)
+
+            self.PopupMenu(menu)
+            menu.Destroy()
+        event.Skip()
+
     def OnPaint(self, event):
         """
         Function called when redrawing Viewer content is needed
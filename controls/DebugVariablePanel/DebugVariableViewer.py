@@ -434,3 +434,28 @@ class DebugVariableViewer(object):
         """
         self.ParentWindow.ReleaseDataValue(
             item.GetVariable().upper())
+
+    def SetDeadband(self, item):
+        """
+        Set deadband of item given, value changes within deadband
+        aren't transferred from PLC
+        @param item: Item to set deadband
+        """
+        iec_path = item.GetVariable().upper()
+        deadband = self.ParentWindow.GetDataDeadband(iec_path)
+        dialog = wx.TextEntryDialog(
+            self, _("Deadband (empty to disable)"), _("Set deadband"),
+            "" if deadband is None else str(deadband))
+        if dialog.ShowModal() == wx.ID_OK:
+            value = dialog.GetValue().strip()
+            try:
+                deadband = abs(float(value)) if value else None
+            except ValueError:
+                message = wx.MessageDialog(
+                    self, _("Invalid value \"%s\" for deadband") % value,
+                    _("Error"), wx.OK | wx.ICON_ERROR)
+                message.ShowModal()
+                message.Destroy()
+            else:
+                self.ParentWindow.SetDataDeadband(iec_path, deadband)
+        dialog.Destroy()
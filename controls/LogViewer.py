@@ -22,6 +22,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import operator
+from array import array
 from datetime import datetime
 from time import time as gettime
 from weakref import proxy
@@ -32,7 +33,7 @@ import wx
 from controls.CustomToolTip import CustomToolTip, TOOLTIP_WAIT_PERIOD
 from editors.DebugViewer import DebugViewer, REFRESH_PERIOD
 
-from runtime.loglevels import LogLevels, LogLevelsCount
+from runtime.loglevels import LogLevels, LogLevelsCount, LogMessagesMaxBytes, UnpackLogMessages
 from util.BitmapLibrary import GetBitmap
 
 THUMB_SIZE_RATIO = 1. / 8.
@@ -364,6 +365,7 @@ class LogViewer(DebugViewer, wx.Panel):
 
         self.MessageFilter.SetSelection(0)
         self.LogSource = None
+        self.BulkLogSource = False
         self.ResetLogMessages()
         self.ParentWindow = window
 
@@ -389,12 +391,14 @@ class LogViewer(DebugViewer, wx.Panel):
         self.ResetLogCounters()
         self.OldestMessages = []
         self.LogMessages = []
-        self.LogMessagesTimestamp = numpy.array([])
+        # amortized growth, numpy view taken when searching
+        self.LogMessagesTimestamp = array('d')
         self.CurrentMessage = None
         self.HasNewData = False
 
     def SetLogSource(self, log_source):
         self.LogSource = proxy(log_source) if log_source is not None else None
+        self.BulkLogSource = hasattr(type(log_source), "GetLogMessages")
         self.CleanButton.Enable(self.LogSource is not None)
         if log_source is not None:
             self.ResetLogMessages()
@@ -408,6 +412,34 @@ class LogViewer(DebugViewer, wx.Panel):
                 return LogMessage(tv_sec, tv_nsec, level, self.LevelIcons[level], msg)
         return None
 
+    async def GetLogMessagesFromSource(self, first, end, level):
+        """
+        Get messages from first to end - 1 still available in source,
+        in batches if source supports it
+        @return: dict of messages by index
+        """
+        messages = {}
+        if self.LogSource is None:
+            return messages
+        if not self.BulkLogSource:
+            # newest first, older messages are missing once one is
+            for msgidx in range(end - 1, first - 1, -1):
+                message = await self.GetLogMessageFromSource(msgidx, level)
+                if message is None:
+                    break
+                messages[msgidx] = message
+            return messages
+        while first < end:
+            packed = await self.LogSource.GetLogMessages(
+                level, first, end - first, LogMessagesMaxBytes)
+            batch = UnpackLogMessages(packed) if packed else []
+            if len(batch) == 0:
+                break
+            for msgidx, msg, _tick, tv_sec, tv_nsec in batch:
+                messages[msgidx] = LogMessage(tv_sec, tv_nsec, level, self.LevelIcons[level], msg)
+            first = batch[-1][0] + 1
+        return messages
+
     def ResetLogCounters(self):
         self.previous_log_count = [None] * LogLevelsCount
 
@@ -415,27 +447,18 @@ class LogViewer(DebugViewer, wx.Panel):
         new_messages = []
         for level, count, prev in list(zip(range(LogLevelsCount), log_count, self.previous_log_count)):
             if count is not None and prev != count:
-                if prev is None:
-                    dump_end = max(-1, count - 10)
-                    oldest_message = (-1, None)
-                else:
-                    dump_end = prev - 1
-                for msgidx in range(count - 1, dump_end, -1):
-                    new_message = await self.GetLogMessageFromSource(msgidx, level)
-                    if new_message is None:
-                        if prev is None:
-                            oldest_message = (-1, None)
-                        break
-                    if prev is None:
-                        oldest_message = (msgidx, new_message)
-                        if len(new_messages) == 0:
-                            new_messages = [new_message]
-                        else:
-                            new_messages.insert(0, new_message)
-                    else:
-                        new_messages.insert(0, new_message)
+                first = max(0, count - 9) if prev is None else prev
+                messages = await self.GetLogMessagesFromSource(first, count, level)
+                # keep newest messages, up to first one missing
+                msgidx = count - 1
+                while msgidx >= first and msgidx in messages:
+                    msgidx -= 1
+                level_messages = [messages[idx] for idx in range(msgidx + 1, count)]
+                new_messages = level_messages + new_messages
                 if prev is None and len(self.OldestMessages) <= level:
-                    self.OldestMessages.append(oldest_message)
+                    self.OldestMessages.append(
+                        (msgidx + 1, level_messages[0])
+                        if len(level_messages) > 0 else (-1, None))
                 self.previous_log_count[level] = count
         # new_messages.sort()
         if len(new_messages) > 0:
@@ -444,9 +467,9 @@ class LogViewer(DebugViewer, wx.Panel):
                 current_is_last = self.GetNextMessage(self.CurrentMessage)[0] is None
             else:
                 current_is_last = True
-            for new_message in new_messages:
-                self.LogMessages.append(new_message)
-                self.LogMessagesTimestamp = numpy.append(self.LogMessagesTimestamp, [new_message.Timestamp])
+            self.LogMessages.extend(new_messages)
+            self.LogMessagesTimestamp.extend(
+                [new_message.Timestamp for new_message in new_messages])
             if current_is_last:
                 self.ScrollToLast(False)
                 self.ResetMessageToolTip()
@@ -461,7 +484,7 @@ class LogViewer(DebugViewer, wx.Panel):
 
     def GetMessageByTimestamp(self, timestamp):
         if self.CurrentMessage is not None:
-            msgidx = numpy.argmin(abs(self.LogMessagesTimestamp - timestamp))
+            msgidx = numpy.argmin(abs(numpy.frombuffer(self.LogMessagesTimestamp) - timestamp))
             message = self.LogMessages[msgidx]
             if self.FilterLogMessage(message) and message.Timestamp > timestamp:
                 return self.GetPreviousMessage(msgidx, timestamp)
@@ -510,10 +533,7 @@ class LogViewer(DebugViewer, wx.Panel):
                     else:
                         current_message = message
                     self.LogMessages.insert(message_idx, message)
-                    self.LogMessagesTimestamp = numpy.insert(
-                        self.LogMessagesTimestamp,
-                        [message_idx],
-                        [message.Timestamp])
+                    self.LogMessagesTimestamp.insert(message_idx, message.Timestamp)
                     self.CurrentMessage = self.LogMessages.index(current_message)
                     if message_idx == 0 and self.FilterLogMessage(message, timestamp):
                         return message, 0
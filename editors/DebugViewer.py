@@ -248,6 +248,25 @@ class DebugViewer(object):
         if self.DataProducer is not None:
             self.DataProducer.ReleaseDebugIECVariable(iec_path)
 
+    def GetDataDeadband(self, iec_path):
+        """
+        Return deadband of PLC variable
+        @param iec_path: Path in PLC of variable
+        @return: deadband (None if not set)
+        """
+        if self.DataProducer is not None:
+            return self.DataProducer.GetDebugIECVariableDeadband(iec_path)
+        return None
+
+    def SetDataDeadband(self, iec_path, deadband):
+        """
+        Set deadband of PLC variable
+        @param iec_path: Path in PLC of variable
+        @param deadband: Deadband value (None to disable)
+        """
+        if self.DataProducer is not None:
+            self.DataProducer.SetDebugIECVariableDeadband(iec_path, deadband)
+
     def NewDataAvailable(self, ticks):
         """
         Called by DataProducer for each tick captured
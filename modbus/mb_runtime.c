@@ -189,21 +189,24 @@ int __cleanup_%(locstr)s()
 	int index, close;
 	int res = 0;
 
-		/* kill thread and close connections of each modbus client node */
+		/* kill threads of all modbus client nodes at once, so that a node
+		 * stuck on a silent server doesn't delay the others */
+		close = 0;
 		for (index = 0; index < NUMBER_OF_CLIENT_NODES; index++)
 		{
-			close = 0;
 			if (client_nodes[index].init_state >= 2)
 			{
 				// thread was launched, so we try to cancel it!
 				client_nodes[index].init_state = 0xaa;
-				plc_rte->delay(1100);
-				close = 0;
-				 if (close < 0)
-				Log(LOG_CRITICAL, "Modbus plugin: Error closing thread for modbus client %%s\n", client_nodes[index].location);
+				close = 1;
 			}
-			res |= close;
+		}
+		if (close)
+			plc_rte->delay(1100);
 
+		/* close connections of each modbus client node */
+		for (index = 0; index < NUMBER_OF_CLIENT_NODES; index++)
+		{
 			close = 0;
 			if (client_nodes[index].init_state >= 1)
 			{
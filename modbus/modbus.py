@@ -784,7 +784,6 @@ class RootClass(object):
                         ("ModbusTCPserver", _ModbusTCPserverPlug, "Modbus TCP Server"),
                         ("ModbusRTUclient", _ModbusRTUclientPlug, "Modbus RTU Client"),
                         ("ModbusRTUslave", _ModbusRTUslavePlug, "Modbus RTU Slave")]
-    mems = []
 
     # Return the number of (modbus library) nodes this specific instance of the modbus plugin will need
     #   return type: (tcp nodes, rtu nodes, ascii nodes)
@@ -807,15 +806,10 @@ class RootClass(object):
         return IPServer_port_numbers
 
     def checkRanger(self, name, type, start_address, length):
-        for i in self.mems:
-            if (type == i['type']) and ((start_address >= i['start'] and start_address <= i['start'] + i[
-                'length'] - 1) or (start_address + length - 1 >= i['start'] and start_address + length - 1 <= i[
-                'start'] + \
-                                   i['length'] - 1)):
-                raise Exception(_("Modbus MemoryArea Conflict: {name} & {iname} ! build cancel!\n").format(name=name,
-                                                                                                           iname=i[
-                                                                                                               'name']))
-        self.mems.append({'name': name, 'type': type, 'start': start_address, 'length': length})
+        iname = self.mems.Add(name, type, start_address, length)
+        if iname is not None:
+            raise Exception(_("Modbus MemoryArea Conflict: {name} & {iname} ! build cancel!\n").format(name=name,
+                                                                                                       iname=iname))
 
     def CTNGenerate_C(self, buildpath, locations):
         # print "#############"
@@ -826,7 +820,7 @@ class RootClass(object):
         # print "type(self.CTNType) >>>"
         # print type(self.CTNType)
         # print "#############"
-        self.mems.clear()
+        self.mems = MemoryAreaMap()
         loc_dict = {"locstr": "_".join(map(str, self.GetCurrentLocation()))}
 
         # Determine the number of (modbus library) nodes ALL instances of the modbus plugin will need
@@ -853,18 +847,19 @@ class RootClass(object):
         # ..but first define a lambda function to convert a tuple with the config tree location to a nice looking string
         #   for e.g., convert the tuple (0, 3, 4) to "0.3.4"
 
-        for i in range(0, len(IPServer_port_numbers) - 1):
-            for j in range(i + 1, len(IPServer_port_numbers)):
-                if IPServer_port_numbers[i][1] == IPServer_port_numbers[j][1]:
-                    self.GetCTRoot().logger.write_warning(
-                        _("Error: Modbus/IP Servers %{a1}.x and %{a2}.x use the same port number {a3}.\n").
-                            format(
-                            a1=_lt_to_str(IPServer_port_numbers[i][0]),
-                            a2=_lt_to_str(IPServer_port_numbers[j][0]),
-                            a3=IPServer_port_numbers[j][1]))
-                    raise Exception
-                    # TODO: return an error code instead of raising an
-                    # exception
+        used_port_numbers = {}
+        for location, port_number in IPServer_port_numbers:
+            if port_number in used_port_numbers:
+                self.GetCTRoot().logger.write_warning(
+                    _("Error: Modbus/IP Servers %{a1}.x and %{a2}.x use the same port number {a3}.\n").
+                        format(
+                        a1=_lt_to_str(used_port_numbers[port_number]),
+                        a2=_lt_to_str(location),
+                        a3=port_number))
+                raise Exception
+                # TODO: return an error code instead of raising an
+                # exception
+            used_port_numbers[port_number] = location
 
         # Determine the current location in Beremiz's project configuration
         # tree
@@ -891,21 +886,28 @@ class RootClass(object):
         client_nodeid = 0
         client_requestid = 0
         server_id = 0
-        buffer = ''
-        server_mem_robits_t = ''
-        server_mem_rwbits_t = ''
-        server_mem_rowords_t = ''
-        server_mem_words_t = ''
+        buffer = []
+        # memory type -> server_mem_*_t initializers
+        server_mems = {'ro_bits': [], 'rw_bits': [], 'ro_words': [], 'rw_words': []}
         server_node_list = []
         client_node_list = []
         client_request_list = []
         client_request_buffer = []
+        # (host, port) -> location of TCP client node connected to it
+        tcpclient_remotes = {}
         server_memarea_list = []
         loc_vars = []
         init = []
         publish = []
         retrieve = []
-        loc_vars_list = []  # list of variables already declared in C code!
+        loc_vars_set = set()  # variables already declared in C code!
+        # located variables indexed once, by memory area or request
+        # location, and by node channel for node parameters
+        locations = self.GetLocations()
+        area_locations = GroupLocations(locations, lambda iecvar: tuple(iecvar["LOC"][:3]))
+        param_locations = GroupLocations(
+            [iecvar for iecvar in locations if len(iecvar["LOC"]) == 5],
+            lambda iecvar: iecvar["LOC"][1])
         _publish = []
         _retrieve = []
         _globl = ['int inwrite=0;']
@@ -948,33 +950,28 @@ class RootClass(object):
                     memarea = modbus_memtype_dict[function][1] + str(inx)
                     m = subchild.MemoryArea
                     Nr_of_Channels = int(m.get('Nr_of_Channels', 1))
-                    buffer += '\tuint16_t %s[%d];\n' % (memarea, Nr_of_Channels)
+                    buffer.append('\tuint16_t %s[%d];\n' % (memarea, Nr_of_Channels))
                     start_address = int(GetCTVal(subchild, 2))
                     name = subchild.BaseParams.getName()
                     self.checkRanger(name, function[1], start_address, Nr_of_Channels)
-                    if modbus_memtype_dict[function][1] == 'ro_bits':
-                        server_mem_robits_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'rw_bits':
-                        server_mem_rwbits_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'ro_words':
-                        server_mem_rowords_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'rw_words':
-                        server_mem_words_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
+                    server_mems[modbus_memtype_dict[function][1]].append(
+                        '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea))
                     inx += 1
-                    for iecvar in subchild.GetLocations():
+                    count = int(GetCTVal(subchild, 1))
+                    for iecvar in area_locations.get(tuple(subchild.GetCurrentLocation()), []):
                         # print repr(iecvar)
                         absloute_address = iecvar["LOC"][3]
                         relative_addr = absloute_address - start_address
                         # test if relative address in request specified range
-                        if relative_addr in range(int(GetCTVal(subchild, 1))) and len(iecvar['LOC']) == 4:
-                            if str(iecvar["NAME"]) not in loc_vars_list:
+                        if 0 <= relative_addr < count and len(iecvar['LOC']) == 4:
+                            if str(iecvar["NAME"]) not in loc_vars_set:
                                 method = {'lit-4321': "s4321", 'lar-2143': "s2143", 'lit-3412': "s3412",
                                           "default-1234": "s1234"}
                                 if endian == "default-1234" or iecvar['SIZE'] in ['X', 'B']:
                                     loc_vars.append(
                                         str(iecvar["IEC_TYPE"]) + " *" + str(iecvar["NAME"]) + " =(%s *) &%s[%d];" % (
                                             str(iecvar["IEC_TYPE"]), memarea, relative_addr))
-                                    loc_vars_list.append(str(iecvar["NAME"]))
+                                    loc_vars_set.add(str(iecvar["NAME"]))
                                     modbus_memtype_dict[function][2] = modbus_memtype_dict[function][2] + 1
                                 else:
                                     if iecvar["DIR"] in ["I", "M"]:
@@ -987,7 +984,7 @@ class RootClass(object):
                                     if iecvar["DIR"] in ["Q", "M"]:
                                         _publish.append("%s_%s((const char *)%s,(char *)&%s[%d]);" % (
                                             method[endian], iecvar['SIZE'], iecvar["NAME"], memarea, relative_addr))
-                                    loc_vars_list.append(str(iecvar["NAME"]))
+                                    loc_vars_set.add(str(iecvar["NAME"]))
                                     modbus_memtype_dict[function][2] = modbus_memtype_dict[function][2] + 1
                             else:
                                 self.GetCTRoot().logger.write_warning(
@@ -996,16 +993,13 @@ class RootClass(object):
                         # else:
                         #     self.GetCTRoot().logger.write_error(
                         #         _("Error: Variable Illigl %s ,%s \n") % (iecvar["LOC"], str(iecvar["NAME"])))
-                for iecvar in self.GetLocations():
-                    absloute_address = iecvar["LOC"][3]
-                    relative_addr = absloute_address - start_address
-                    # test if relative address in request specified range
-                    if iecvar['LOC'][1] == IEC_Channel and len(iecvar['LOC']) == 5 and params.get(iecvar['LOC'][4]):
+                for iecvar in param_locations.get(IEC_Channel, []):
+                    if params.get(iecvar['LOC'][4]):
                         # loc_vars.append("extern %s *%s;" % (IEC_C[iecvar['IEC_TYPE']], str(iecvar["NAME"])))
                         # loc_vars.append(
                         #     "%s *" % params[iecvar['LOC'][4]]['type'] + str(iecvar["NAME"]) + " = &%s;" % (
                         #         params[iecvar['LOC'][4]]['name']))
-                        loc_vars_list.append(str(iecvar["NAME"]))
+                        loc_vars_set.add(str(iecvar["NAME"]))
                         if iecvar["DIR"] in ["I", "M"]:
                             retrieve.append("*%s = %s;" % (iecvar["NAME"], params[iecvar['LOC'][4]]['name']))
                             init.append("%s = *%s;" % (params[iecvar['LOC'][4]]['name'], iecvar["NAME"]))
@@ -1056,26 +1050,21 @@ class RootClass(object):
                     memarea = modbus_memtype_dict[function][1] + str(IEC_Channel) + str(inx)
                     m = subchild.MemoryArea
                     Nr_of_Channels = int(m.get('Nr_of_Channels', 1))
-                    buffer += '\tuint16_t %s[%d];\n' % (memarea, Nr_of_Channels)
+                    buffer.append('\tuint16_t %s[%d];\n' % (memarea, Nr_of_Channels))
                     start_address = int(GetCTVal(subchild, 2))
                     name = subchild.BaseParams.getName()
                     self.checkRanger(name, function[1], start_address, Nr_of_Channels)
-                    if modbus_memtype_dict[function][1] == 'ro_bits':
-                        server_mem_robits_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'rw_bits':
-                        server_mem_rwbits_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'ro_words':
-                        server_mem_rowords_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
-                    elif modbus_memtype_dict[function][1] == 'rw_words':
-                        server_mem_words_t += '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea)
+                    server_mems[modbus_memtype_dict[function][1]].append(
+                        '{%d, %d, %s},\n' % (start_address, Nr_of_Channels, memarea))
                     inx += 1
-                    for iecvar in subchild.GetLocations():
+                    count = int(GetCTVal(subchild, 1))
+                    for iecvar in area_locations.get(tuple(subchild.GetCurrentLocation()), []):
                         # print repr(iecvar)
                         absloute_address = iecvar["LOC"][3]
                         relative_addr = absloute_address - start_address
                         # test if relative address in request specified range
-                        if relative_addr in range(int(GetCTVal(subchild, 1))) and len(iecvar['LOC']) == 4:
-                            if str(iecvar["NAME"]) not in loc_vars_list:
+                        if 0 <= relative_addr < count and len(iecvar['LOC']) == 4:
+                            if str(iecvar["NAME"]) not in loc_vars_set:
                                 method = {'lit-4321': "s4321", 'lar-2143': "s2143", 'lit-3412': "s3412",
                                           "default-1234": "s1234"}
                                 if iecvar["DIR"] in ["I", "M"]:
@@ -1088,7 +1077,7 @@ class RootClass(object):
                                 if iecvar["DIR"] in ["Q", "M"]:
                                     _publish.append("%s_%s((const char *)%s,(char *)&%s[%d]);" % (
                                         method[endian], iecvar['SIZE'], iecvar["NAME"], memarea, relative_addr))
-                                loc_vars_list.append(str(iecvar["NAME"]))
+                                loc_vars_set.add(str(iecvar["NAME"]))
                                 modbus_memtype_dict[function][2] = modbus_memtype_dict[function][2] + 1
                             else:
                                 self.GetCTRoot().logger.write_warning(
@@ -1097,16 +1086,13 @@ class RootClass(object):
                         # else:
                         #     self.GetCTRoot().logger.write_error(
                         #         _("Error: Variable Illigl %s ,%s \n") % (iecvar["LOC"], str(iecvar["NAME"])))
-                for iecvar in self.GetLocations():
-                    absloute_address = iecvar["LOC"][3]
-                    relative_addr = absloute_address - start_address
-                    # test if relative address in request specified range
-                    if iecvar['LOC'][1] == IEC_Channel and len(iecvar['LOC']) == 5 and params.get(iecvar['LOC'][4]):
+                for iecvar in param_locations.get(IEC_Channel, []):
+                    if params.get(iecvar['LOC'][4]):
                         # loc_vars.append("extern %s *%s;" % (IEC_C[iecvar['IEC_TYPE']], str(iecvar["NAME"])))
                         # loc_vars.append(
                         #     "%s *" % params[iecvar['LOC'][4]]['type'] + str(iecvar["NAME"]) + " = &%s;" % (
                         #         params[iecvar['LOC'][4]]['name']))
-                        loc_vars_list.append(str(iecvar["NAME"]))
+                        loc_vars_set.add(str(iecvar["NAME"]))
                         if iecvar["DIR"] in ["I", "M"]:
                             retrieve.append("*%s = %s;" % (iecvar["NAME"], params[iecvar['LOC'][4]]['name']))
                             init.append("%s = *%s;" % (params[iecvar['LOC'][4]]['name'], iecvar["NAME"]))
@@ -1118,6 +1104,17 @@ class RootClass(object):
                 server_id += 1
             #
             if child.PlugType == "ModbusTCPclient":
+                # each client node polls its requests on its own thread and
+                # connection, nodes to a same remote don't share them
+                remote = tuple(GetCTVals(child, range(2)))
+                if remote in tcpclient_remotes:
+                    self.GetCTRoot().logger.write_warning(
+                        _("Warning: Modbus/TCP Clients %{a1}.x and %{a2}.x connect to the same server {a3}:{a4}, "
+                          "using one connection each.\n").format(
+                            a1=_lt_to_str(tcpclient_remotes[remote]),
+                            a2=_lt_to_str(child.GetCurrentLocation()),
+                            a3=remote[0], a4=remote[1]))
+                tcpclient_remotes[remote] = child.GetCurrentLocation()
                 tcpclient_reqs_count += len(child.IECSortedChildren())
                 new_node = GetTCPClientNodePrinted(self, child)
                 if new_node is None:
@@ -1131,59 +1128,84 @@ class RootClass(object):
                         return [], "", False, []
                     client_request_list.append(new_req)
                     client_request_buffer.append(buf)
-                    for iecvar in subchild.GetLocations():
+                    start_address = int(GetCTVal(subchild, 3))
+                    count = int(GetCTVal(subchild, 6))
+                    for iecvar in area_locations.get(tuple(subchild.GetCurrentLocation()), []):
                         # absloute address - start address
-                        relative_addr = iecvar["LOC"][3] - int(GetCTVal(subchild, 3))
+                        relative_addr = iecvar["LOC"][3] - start_address
                         # test if relative address in request specified range
-                        if relative_addr in range(int(GetCTVal(subchild, 6))):
-                            if str(iecvar["NAME"]) not in loc_vars_list:
+                        if 0 <= relative_addr < count:
+                            if str(iecvar["NAME"]) not in loc_vars_set:
                                 # loc_vars.append("extern %s *%s;" % (IEC_C[iecvar['IEC_TYPE']], str(iecvar["NAME"])))
                                 loc_vars.append(
                                     "uint16_t *" + str(iecvar["NAME"]) + " = &client_requests[%d].plcv_buffer[%d];" % (
                                         client_requestid, relative_addr))
-                                loc_vars_list.append(str(iecvar["NAME"]))
+                                loc_vars_set.add(str(iecvar["NAME"]))
                     client_requestid += 1
                 tcpclient_node_count += 1
                 client_nodeid += 1
             #
             if child.PlugType == "ModbusRTUclient":
                 IEC_Channel = child.BaseParams.getIEC_Channel()
-                rtuclient_reqs_count += len(child.IECSortedChildren())
                 new_node = GetRTUClientNodePrinted(self, child)
                 if new_node is None:
                     return [], "", False, []
                 client_node_list.append(new_node)
+                requests = []
                 for subchild in child.IECSortedChildren():
-                    new_req, buf = GetClientRequestPrinted(self, subchild, client_nodeid)
-                    if new_req is None:
+                    request_dict = GetClientRequestDict(self, subchild, client_nodeid)
+                    if request_dict is None:
                         return [], "", False, []
+                    request_dict["subchild"] = subchild
+                    # requests whose parameters are bound to variables keep
+                    # their own request, for their own status and settings
+                    request_dict["mergeable"] = not any(
+                        len(iecvar['LOC']) == 5
+                        for iecvar in area_locations.get(tuple(subchild.GetCurrentLocation()), []))
+                    requests.append(request_dict)
+                # contiguous ranges of same slave and function are polled
+                # by a single request, sharing its buffer
+                for merged_dict, members in CoalesceClientRequests(requests):
+                    new_req, buf = PrintClientRequest(merged_dict)
                     client_request_list.append(new_req)
                     client_request_buffer.append(buf)
+                    for member_dict, offset in members:
+                        if member_dict["locreqstr"] != merged_dict["locreqstr"]:
+                            client_request_buffer.append(
+                                "#define plcv_buffer%s (plcv_buffer%s + %d)" % (
+                                    member_dict["locreqstr"], merged_dict["locreqstr"], offset))
+                        member_dict["request_id"] = client_requestid
+                    client_requestid += 1
+                    rtuclient_reqs_count += 1
+                for request_dict in requests:
+                    subchild = request_dict["subchild"]
+                    requestid = request_dict["request_id"]
                     endian = GetCTVal(subchild, 10)
                     start_address = int(GetCTVal(subchild, 7))
                     params = {
-                        1: {'type': 'uint8_t', 'name': 'client_requests[%d].slave_id' % client_requestid},
+                        1: {'type': 'uint8_t', 'name': 'client_requests[%d].slave_id' % requestid},
                         2: {'type': 'uint32_t',
-                            'name': 'client_requests[%d].node_address.addr.rtu.baud' % client_requestid},
+                            'name': 'client_requests[%d].node_address.addr.rtu.baud' % requestid},
                         3: {'type': 'uint8_t',
-                            'name': 'client_requests[%d].node_address.addr.rtu.data_bits' % client_requestid},
+                            'name': 'client_requests[%d].node_address.addr.rtu.data_bits' % requestid},
                         4: {'type': 'uint8_t',
-                            'name': 'client_requests[%d].node_address.addr.rtu.stop_bits' % client_requestid},
+                            'name': 'client_requests[%d].node_address.addr.rtu.stop_bits' % requestid},
                         5: {'type': 'uint8_t',
-                            'name': 'client_requests[%d].node_address.addr.rtu.parity' % client_requestid},
-                        6: {'type': 'uint32_t', 'name': 'client_requests[%d].period' % client_requestid},
-                        7: {'type': 'int16_t', 'name': 'client_requests[%d].prev_error' % client_requestid},
-                        8: {'type': 'uint32_t', 'name': 'client_requests[%d].okcount' % client_requestid},
-                        9: {'type': 'uint32_t', 'name': 'client_requests[%d].errcount' % client_requestid},
-                        10: {'type': 'uint8_t', 'name': 'client_requests[%d].enable' % client_requestid},
+                            'name': 'client_requests[%d].node_address.addr.rtu.parity' % requestid},
+                        6: {'type': 'uint32_t', 'name': 'client_requests[%d].period' % requestid},
+                        7: {'type': 'int16_t', 'name': 'client_requests[%d].prev_error' % requestid},
+                        8: {'type': 'uint32_t', 'name': 'client_requests[%d].okcount' % requestid},
+                        9: {'type': 'uint32_t', 'name': 'client_requests[%d].errcount' % requestid},
+                        10: {'type': 'uint8_t', 'name': 'client_requests[%d].enable' % requestid},
                     }
-                    for iecvar in subchild.GetLocations():
+                    count = int(GetCTVal(subchild, 6))
+                    for iecvar in area_locations.get(tuple(subchild.GetCurrentLocation()), []):
                         # print repr(iecvar)
                         absloute_address = iecvar["LOC"][3]
                         relative_addr = absloute_address - start_address
                         # test if relative address in request specified range
-                        if relative_addr in range(int(GetCTVal(subchild, 1))) and len(iecvar['LOC']) == 4:
-                            if str(iecvar["NAME"]) not in loc_vars_list:
+                        if 0 <= relative_addr < count and len(iecvar['LOC']) == 4:
+                            if str(iecvar["NAME"]) not in loc_vars_set:
                                 method = {'lit-4321': "s4321", 'lar-2143': "s2143", 'lit-3412': "s3412",
                                           "default-1234": "s1234"}
                                 if iecvar["DIR"] in ["I", "M"]:
@@ -1202,7 +1224,7 @@ class RootClass(object):
                                         method[endian], iecvar['SIZE'], iecvar["NAME"],
                                         'plcv_buffer%d_%d_%d' % (iecvar["LOC"][0], iecvar["LOC"][1], iecvar["LOC"][2]),
                                         relative_addr))
-                                loc_vars_list.append(str(iecvar["NAME"]))
+                                loc_vars_set.add(str(iecvar["NAME"]))
                             else:
                                 self.GetCTRoot().logger.write_warning(
                                     _("Waring: Variable Dup {loc} ,{name} \n").format(loc=iecvar["LOC"],
@@ -1212,14 +1234,13 @@ class RootClass(object):
                             # loc_vars.append(
                             #     "%s *" % params[iecvar['LOC'][4]]['type'] + str(iecvar["NAME"]) + " = &%s;" % (
                             #         params[iecvar['LOC'][4]]['name']))
-                            loc_vars_list.append(str(iecvar["NAME"]))
+                            loc_vars_set.add(str(iecvar["NAME"]))
                             if iecvar["DIR"] in ["I", "M"]:
                                 retrieve.append("*%s = %s;" % (iecvar["NAME"], params[iecvar['LOC'][4]]['name']))
                                 init.append("%s = *%s;" % (params[iecvar['LOC'][4]]['name'], iecvar["NAME"]))
 
                             if iecvar["DIR"] in ["Q", "M"]:
                                 publish.append("%s = *%s;" % (params[iecvar['LOC'][4]]['name'], iecvar["NAME"]))
-                    client_requestid += 1
                 rtuclient_node_count += 1
                 client_nodeid += 1
             nodeid += 1
@@ -1253,11 +1274,11 @@ class RootClass(object):
         loc_dict["total_rtunode_count"] = str(total_node_count[1])
         loc_dict["total_ascnode_count"] = str(total_node_count[2])
         loc_dict["max_remote_tcpclient"] = int(self.GetParamsAttributes()[0]["children"][0]["value"])
-        loc_dict["buffer"] = buffer
-        loc_dict["server_mem_robits_t"] = server_mem_robits_t
-        loc_dict["server_mem_rwbits_t"] = server_mem_rwbits_t
-        loc_dict["server_mem_rowords_t"] = server_mem_rowords_t
-        loc_dict["server_mem_words_t"] = server_mem_words_t
+        loc_dict["buffer"] = "".join(buffer)
+        loc_dict["server_mem_robits_t"] = "".join(server_mems['ro_bits'])
+        loc_dict["server_mem_rwbits_t"] = "".join(server_mems['rw_bits'])
+        loc_dict["server_mem_rowords_t"] = "".join(server_mems['ro_words'])
+        loc_dict["server_mem_words_t"] = "".join(server_mems['rw_words'])
         loc_dict["init"] = "\n".join(init)
         loc_dict["publish"] = "\n".join(publish)
         loc_dict["retrieve"] = "\n".join(retrieve)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This file is part of Beremiz.
+# See COPYING file for copyrights details.
+
+import re
+
+from plcopen.plcopen import PLCOpenParser, TestTextElement
+
+# Containers of project state chunks, in ProjectSnapshotStore order,
+# with kind of element used by search filter
+IndexedContainers = [
+    (("dataTypes", "types"), lambda element: "datatype"),
+    (("pous", "types"), lambda element: element.getpouType()),
+    (("configurations", "instances"), lambda element: "configuration")]
+
+# Searched texts fields that don't refer to identifiers
+NonIdentifierFields = set([
+    "content", "documentation", "constant", "location", "interval",
+    "priority", "qualifier", "duration"])
+
+# Comments and string literals in code, ignored when looking for identifiers
+CodeIgnoredRE = re.compile(
+    r"\(\*.*?\*\)|/\*.*?\*/|//[^\n]*|'[^']*'|\"[^\"]*\"", re.DOTALL)
+
+# Identifiers, not prefix of typed literals (i.e. T#1s, INT#5, 16#FF)
+IdentifierRE = re.compile(r"(?<![\w#%])[A-Za-z_]\w*(?![\w#])")
+
+WordRE = re.compile(r"\w+")
+
+
+def _MaskIgnoredCode(text):
+    """
+    Replace comments and string literals in text by blanks, keeping
+    positions of everything else
+    """
+    return CodeIgnoredRE.sub(
+        lambda result: re.sub(r"[^\n]", " ", result.group()), text)
+
+
+def _IsIdentifierField(infos):
+    """
+    Return if searched text of given infos may refer to identifiers
+    """
+    fields = [info for info in infos[1:] if isinstance(info, str)]
+    return fields[-1] not in NonIdentifierFields
+
+
+class _MaskedPattern(object):
+    """
+    Stands for a compiled pattern in search criteria, ignoring matches in
+    comments and string literals
+    """
+
+    def __init__(self, pattern):
+        self.Pattern = pattern
+        self.Text = None
+        self.Masked = None
+
+    def search(self, text, pos=0):
+        if text is not self.Text:
+            self.Text = text
+            self.Masked = _MaskIgnoredCode(text)
+        return self.Pattern.search(self.Masked, pos)
+
+
+class _RecordedMatch(object):
+    """
+    Match spanning whole text, so that TestTextElement returns one
+    result per searched text
+    """
+
+    def __init__(self, text):
+        self._end = len(text)
+
+    def start(self):
+        return 0
+
+    def end(self):
+        return self._end
+
+    def span(self):
+        return 0, self._end
+
+
+class _TextRecorder(object):
+    """
+    Stands for a compiled pattern in search criteria, recording all texts
+    an element Search method tests, in order.
+    """
+
+    def __init__(self):
+        self.Texts = []
+
+    def search(self, text, pos=0):
+        if pos > 0:
+            return None
+        self.Texts.append(text)
+        return _RecordedMatch(text)
+
+
+class _IndexedElement(object):
+    """
+    Searchable texts of a project element (data type, POU or configuration)
+    """
+
+    def __init__(self, element, kind):
+        self.Kind = kind
+        recorder = _TextRecorder()
+        results = element.Search({"filter": "all", "pattern": recorder}, [])
+        # some results are emitted more than once for a single searched
+        # text (i.e. task name for each of its instances), so results
+        # are bound to texts by their whole text match, not by order
+        texts = {}
+        for text in recorder.Texts:
+            key = TestTextElement(text, {"pattern": _TextRecorder()})[0]
+            texts.setdefault(key, text)
+        self.Entries = [(result[0], texts[result[1:]]) for result in results]
+        self.Text = "\n".join([text for _infos, text in self.Entries]).upper()
+        # all words, for prefiltering searches
+        self.Words = set(WordRE.findall(self.Text))
+        # identifier -> tagnames of element parts referring to it
+        self.References = {}
+        for infos, text in self.Entries:
+            if _IsIdentifierField(infos):
+                for identifier in IdentifierRE.findall(_MaskIgnoredCode(text)):
+                    tagnames = self.References.setdefault(identifier.upper(), [])
+                    if infos[0] not in tagnames:
+                        tagnames.append(infos[0])
+
+
+class ProjectSearchIndex(object):
+    """
+    Index of searchable texts of project elements, keyed by element
+    digest in ProjectSnapshotStore, so that unchanged elements are only
+    indexed once. Element are indexed from their stored chunk, thus
+    lazy bodies of live project are left untouched.
+
+    Inverted indexes give elements containing a word, to prefilter
+    searches, and elements referring to an identifier, outside of
+    comments, to find references. Identifiers are case insensitive, as
+    in IEC 61131-3, and words are indexed upper case.
+    """
+
+    def __init__(self, snapshots):
+        self.Snapshots = snapshots
+        self.Elements = {}
+        # word -> digests of elements containing it
+        self.Words = {}
+        # identifier -> digests of elements referring to it
+        self.Identifiers = {}
+        self.State = None
+
+    def _Index(self, digest, container):
+        indexed = self.Elements.get(digest)
+        if indexed is None:
+            # parse element in its container, for right element class
+            parent = PLCOpenParser.CreateElement(*container)
+            parent.append(self.Snapshots.Load(digest))
+            element = parent[0]
+            indexed = _IndexedElement(element, self.GetKind(container, element))
+            self.Elements[digest] = indexed
+            for word in indexed.Words:
+                self.Words.setdefault(word, set()).add(digest)
+            for identifier in indexed.References:
+                self.Identifiers.setdefault(identifier, set()).add(digest)
+        return indexed
+
+    def _Forget(self, digest):
+        indexed = self.Elements.pop(digest)
+        for inverted, keys in [(self.Words, indexed.Words),
+                               (self.Identifiers, indexed.References)]:
+            for key in keys:
+                digests = inverted[key]
+                digests.discard(digest)
+                if not digests:
+                    inverted.pop(key)
+
+    def GetKind(self, container, element):
+        for indexed_container, kind in IndexedContainers:
+            if indexed_container == container:
+                return kind(element)
+        return None
+
+    def _IterElements(self, state, digests=None):
+        """
+        Iterate over elements of state, indexing them if needed
+        @param digests: Only iterate over elements with these digests
+        (default None, all elements)
+        """
+        _skeleton, containers_digests = state
+        for (container, _kind), container_digests in zip(IndexedContainers, containers_digests):
+            for digest in container_digests:
+                if digests is None or digest in digests:
+                    yield self._Index(digest, container)
+
+    def _UpdateState(self, state):
+        """
+        Follow given state if any, and index all elements of current state
+        @return: current state, None if index has no state
+        """
+        if state is not None:
+            self.Update(state)
+        if self.State is not None:
+            for _indexed in self._IterElements(self.State):
+                pass
+        return self.State
+
+    def _GetWordsDigests(self, text):
+        """
+        Return digests of elements that may contain text. Each word of
+        text is part of a single word of element, thus longest one is
+        looked for in indexed words.
+        @return: Set of digests, None if text has no word
+        """
+        words = WordRE.findall(text.upper())
+        if not words:
+            return None
+        longest = max(words, key=len)
+        digests = set()
+        for word, word_digests in self.Words.items():
+            if longest in word:
+                digests.update(word_digests)
+        return digests
+
+    def Update(self, state):
+        """
+        Follow project state. Elements that changed are indexed right
+        away if index is in use, and elements not in state are forgotten.
+        """
+        if self.State is not None:
+            for _indexed in self._IterElements(state):
+                pass
+        used = set()
+        for digests in state[1]:
+            used.update(digests)
+        for digest in list(self.Elements.keys()):
+            if digest not in used:
+                self._Forget(digest)
+        self.State = state
+
+    def Search(self, criteria, state=None):
+        """
+        Same as project Search, in given state or current one
+        """
+        state = self._UpdateState(state)
+        if state is None:
+            return []
+        filter = criteria["filter"]
+        literal = None
+        digests = None
+        if not criteria["regular_expression"]:
+            literal = criteria["find_pattern"].upper()
+            digests = self._GetWordsDigests(literal)
+        search_result = []
+        for indexed in self._IterElements(state, digests):
+            if filter != "all" and indexed.Kind not in filter:
+                continue
+            # quickly skip elements that can't match
+            if literal is not None and literal not in indexed.Text:
+                continue
+            for infos, text in indexed.Entries:
+                for result in TestTextElement(text, criteria):
+                    search_result.append((infos,) + result)
+        return search_result
+
+    def FindReferences(self, name, state=None):
+        """
+        Return tagnames of project element parts (POUs, actions,
+        transitions, data types, configurations and resources) referring
+        to an identifier, in given state or current one
+        """
+        state = self._UpdateState(state)
+        if state is None:
+            return []
+        digests = self.Identifiers.get(name.upper(), set())
+        tagnames = []
+        for indexed in self._IterElements(state, digests):
+            tagnames.extend(indexed.References[name.upper()])
+        return tagnames
+
+    def GetRenameImpact(self, name, state=None):
+        """
+        Return occurrences of an identifier that renaming it would change,
+        in given state or current one, as search results
+        """
+        state = self._UpdateState(state)
+        if state is None:
+            return []
+        criteria = {"pattern": _MaskedPattern(
+            re.compile(r"\b%s\b" % re.escape(name), re.IGNORECASE))}
+        digests = self.Identifiers.get(name.upper(), set())
+        search_result = []
+        for indexed in self._IterElements(state, digests):
+            for infos, text in indexed.Entries:
+                if _IsIdentifierField(infos):
+                    for result in TestTextElement(text, criteria):
+                        search_result.append((infos,) + result)
+        return search_result
+
+
+if __name__ == "__main__":
+    import timeit
+    from copy import deepcopy
+    from plcopen.plcopen import LoadProject, CompilePattern
+    from plcopen.ProjectSnapshot import ProjectSnapshotStore
+    from util import paths
+
+    # benchmark : synthetic project made of 1000 POUs copied from
+    # first_steps POUs, searched directly and through index, first
+    # search and after editing one POU
+    source = paths.AbsNeighbourFile(
+        __file__, "..", "tests", "first_steps", "plc.xml")
+    project, _error = LoadProject(source)
+    pous = project.getpous()
+    pous_node = pous[0].getparent()
+    for i in range(1000 // len(pous)):
+        for pou in pous:
+            new_pou = deepcopy(pou)
+            new_pou.setname("%s_%d" % (pou.getname(), i))
+            pous_node.append(new_pou)
+
+    snapshots = ProjectSnapshotStore()
+    index = ProjectSearchIndex(snapshots)
+    state = snapshots.Snapshot(project)
+    for find_pattern, regular_expression in [
+            ("Counter", False), ("counter", False), ("c.*r", True), ("zzz", False)]:
+        criteria = {"find_pattern": find_pattern, "case_sensitive": False,
+                    "regular_expression": regular_expression, "filter": "all"}
+        CompilePattern(criteria)
+        assert index.Search(criteria, state) == project.Search(criteria)
+    assert "P::CounterST" in index.FindReferences("counterst")
+
+    criteria = {"find_pattern": "Reset", "case_sensitive": False,
+                "regular_expression": False, "filter": "all"}
+    CompilePattern(criteria)
+
+    def edit_and_search():
+        pou = project.getpou(pous[0].getname())
+        pou.setdescription(pou.getdescription() + "x")
+        index.Update(snapshots.Snapshot(project))
+        return index.Search(criteria)
+
+    for name, func in [
+            ("project search", lambda: project.Search(criteria)),
+            ("first index search", lambda: ProjectSearchIndex(snapshots).Search(criteria, state)),
+            ("index search", lambda: index.Search(criteria)),
+            ("edit, index search", edit_and_search),
+            ("find references", lambda: index.FindReferences("ResetCounterValue")),
+            ("rename impact", lambda: index.GetRenameImpact("ResetCounterValue"))]:
+        print("%-19s: %.1f ms" % (name, min(timeit.repeat(func, number=1, repeat=3)) * 1000))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This file is part of Beremiz.
+# See COPYING file for copyrights details.
+
+import hashlib
+import zlib
+from copy import deepcopy
+
+from lxml import etree
+
+from plcopen.plcopen import PLCOpenParser, PLCOpen_XPath, GetModificationStamp, \
+    MaterializeLazyBodies
+
+# Containers whose children are stored as separate chunks.
+# Everything else (headers, addData, ...) goes to project skeleton.
+SnapshotContainersXPath = [
+    PLCOpen_XPath("ppx:types/ppx:dataTypes"),
+    PLCOpen_XPath("ppx:types/ppx:pous"),
+    PLCOpen_XPath("ppx:instances/ppx:configurations")]
+
+
+class ProjectSnapshotStore(object):
+    """
+    Content addressed store of project states for undo buffer.
+    A project state is split into a skeleton and one chunk per
+    data type, POU and configuration. Chunks are compressed and shared
+    between states, so that unchanged elements are stored only once,
+    and restoring a state only parses elements that differ.
+    Digest of each element is kept along with its modification stamp, so
+    only elements marked modified (see plcopen.MarkModified) since
+    previous snapshot are serialized and hashed again.
+    """
+
+    def __init__(self):
+        self.Chunks = {}
+        # id of chunked element -> (element, modification stamp, digest)
+        self.Digests = {}
+
+    def _GetContainers(self, project):
+        containers = []
+        for xpath in SnapshotContainersXPath:
+            result = xpath(project)
+            containers.append(result[0] if result else None)
+        return containers
+
+    def _Serialize(self, project):
+        """
+        Return skeleton digest and a list of (digest, element) for each
+        container
+        """
+        containers = self._GetContainers(project)
+        children = [list(container) if container is not None else []
+                    for container in containers]
+        digests = {}
+        chunks = [[(self._ElementDigest(element, digests), element)
+                   for element in elements]
+                  for elements in children]
+        # elements not in project anymore are forgotten
+        self.Digests = digests
+        # skeleton is dumped from a copy of project without chunked
+        # elements, as detaching them from project walks whole tree
+        ancestors = set()
+        for container in containers:
+            while container is not None:
+                ancestors.add(container)
+                container = container.getparent()
+        skeleton = etree.tostring(
+            self._CopySkeleton(project, containers, ancestors),
+            encoding='utf-8')
+        return self._Store(skeleton), chunks
+
+    def _CopySkeleton(self, element, containers, ancestors, parent=None):
+        """
+        Copy element, without children of containers
+        """
+        if parent is None:
+            # default namespace declared first, or lxml would prefix copied
+            # elements when project also declares a prefix for it
+            nsmap = dict(sorted(element.nsmap.items(),
+                                key=lambda item: item[0] is not None))
+            copy = etree.Element(element.tag, dict(element.attrib), nsmap)
+        else:
+            copy = etree.SubElement(parent, element.tag, dict(element.attrib))
+        copy.text = element.text
+        copy.tail = element.tail
+        if element not in containers:
+            for child in element:
+                if child in ancestors:
+                    self._CopySkeleton(child, containers, ancestors, copy)
+                else:
+                    copy.append(deepcopy(child))
+        return copy
+
+    def _ElementDigest(self, element, digests):
+        """
+        Return digest of element, stored again only if it was marked
+        modified since it was last stored
+        """
+        stamp = GetModificationStamp(element)
+        known = self.Digests.get(id(element))
+        if known is not None and known[0] is element and known[1] == stamp:
+            digest = known[2]
+        else:
+            digest = self._Store(etree.tostring(element, encoding='utf-8'))
+        digests[id(element)] = (element, stamp, digest)
+        return digest
+
+    def _Digest(self, chunk):
+        return hashlib.sha1(chunk).digest()
+
+    def _Store(self, chunk):
+        digest = self._Digest(chunk)
+        if digest not in self.Chunks:
+            self.Chunks[digest] = zlib.compress(chunk, 1)
+        return digest
+
+    def Load(self, digest):
+        """
+        Parse stored chunk back to an element
+        """
+        return PLCOpenParser.Loads(zlib.decompress(self.Chunks[digest]))
+
+    def Snapshot(self, project):
+        """
+        Store project state and return an opaque key to restore it
+        """
+        skeleton_digest, chunks = self._Serialize(project)
+        return (skeleton_digest,
+                tuple([tuple([digest for digest, _element in elements])
+                       for elements in chunks]))
+
+    def Restore(self, project, state):
+        """
+        Patch project to match given state, and return patched project.
+        Elements that didn't change are kept as is, others are
+        parsed back from store. A new project root is returned only
+        if skeleton changed. Elements may have been stored with bodies
+        left unparsed by lazy project loading, these are parsed when put
+        back in project.
+        """
+        skeleton_digest, containers_digests = state
+        live_skeleton_digest, chunks = self._Serialize(project)
+        live = {}
+        for elements in chunks:
+            for digest, element in elements:
+                live.setdefault(digest, []).append(element)
+
+        if live_skeleton_digest != skeleton_digest:
+            project = self.Load(skeleton_digest)
+
+        for container, digests in zip(self._GetContainers(project),
+                                      containers_digests):
+            if container is None:
+                continue
+            elements = []
+            for digest in digests:
+                candidates = live.get(digest)
+                if candidates:
+                    elements.append(candidates.pop(0))
+                else:
+                    element = self.Load(digest)
+                    MaterializeLazyBodies(element)
+                    elements.append(element)
+            for element in list(container):
+                container.remove(element)
+            container.extend(elements)
+            # keep digests of restored elements
+            for element, digest in zip(elements, digests):
+                self.Digests[id(element)] = (
+                    element, GetModificationStamp(element), digest)
+        return project
+
+    def Purge(self, states):
+        """
+        Forget chunks not referenced by any of given states
+        """
+        used = set()
+        for state in states:
+            if state is not None:
+                skeleton_digest, containers_digests = state
+                used.add(skeleton_digest)
+                for digests in containers_digests:
+                    used.update(digests)
+        for digest in list(self.Chunks.keys()):
+            if digest not in used:
+                self.Chunks.pop(digest)
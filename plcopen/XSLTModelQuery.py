@@ -7,6 +7,7 @@
 import os
 
 from XSLTransform import XSLTransform
+from plcopen.plcopen import MaterializeLazyBodies
 from plcopen.structures import StdBlckLibs
 from util import paths
 
@@ -39,6 +40,8 @@ class XSLTModelQuery(XSLTransform):
 
     def _process_xslt(self, root, debug, **kwargs):
         self.debug = debug
+        # XSLT reads lxml tree, bypassing lazy bodies parsing on access
+        MaterializeLazyBodies(root)
         return self.transform(root, **kwargs)
         # print(self.xslt.error_log)
 
@@ -25,7 +25,11 @@
 
 
 
+import base64
+import itertools
 import re
+import weakref
+import zlib
 from collections import OrderedDict
 
 from lxml import etree
@@ -298,13 +302,306 @@ def LoadProjectXML(project_xml):
         return None, str(e)
 
 
-def LoadProject(filepath):
+# Size of chunks read from project file when streaming
+LOAD_PROJECT_CHUNK_SIZE = 1 << 20
+
+# Processing instruction target holding a graphical body not parsed yet
+LAZY_BODY_PI = "beremiz-lazy-body"
+
+
+class ProjectStreamFixer(object):
+    """
+    Apply LoadProjectXML namespace and CDATA fixes on a project file
+    read by chunks. A match is only replaced once the bytes following
+    it are known, bytes already emitted are kept for lookbehind.
+    """
+    Fixes = {
+        b"<![CDATA[": (b"<xhtml:p>", None, b"<xhtml:p><![CDATA["),
+        b"]]>": (None, b"</xhtml:p>", b"]]></xhtml:p>"),
+        b"http://www.plcopen.org/xml/tc6.xsd": (
+            None, None, b"http://www.plcopen.org/xml/tc6_0201")}
+    # longer than any match with its lookahead
+    Margin = 64
+    # longer than lookbehind
+    Context = 16
+
+    def __init__(self):
+        self.Buffer = b""
+        self.Start = 0
+
+    def _Matches(self, buff, pos, end):
+        matches = []
+        for needle, (before, after, replacement) in self.Fixes.items():
+            idx = buff.find(needle, pos, end)
+            while idx != -1:
+                next_idx = idx + len(needle)
+                if (before is None or buff[idx - len(before):idx] != before) and \
+                   (after is None or buff[next_idx:next_idx + len(after)] != after):
+                    matches.append((idx, next_idx, replacement))
+                idx = buff.find(needle, next_idx, end)
+        matches.sort()
+        return matches
+
+    def feed(self, data, final=False):
+        buff = self.Buffer + data
+        end = len(buff) if final else max(self.Start, len(buff) - self.Margin)
+        output = []
+        pos = self.Start
+        # matches may only start before end, and then end before buffer end
+        for start, match_end, replacement in self._Matches(buff, pos, end + self.Margin):
+            if start >= end:
+                break
+            output.append(buff[pos:start])
+            output.append(replacement)
+            pos = match_end
+        if pos < end:
+            output.append(buff[pos:end])
+            pos = end
+        keep = max(0, pos - self.Context)
+        self.Buffer = buff[keep:]
+        self.Start = pos - keep
+        return b"".join(output)
+
+    def close(self):
+        return self.feed(b"", True)
+
+
+class LazyBodyCutter(object):
+    """
+    Replace content of graphical bodies found in project stream by a
+    processing instruction holding it compressed, so that project tree
+    can be parsed and validated without them.
+    See MaterializeLazyBodies.
+    """
+    BodyStartRE = re.compile(rb"<body>\s*<(FBD|LD|SFC)>")
+    TokensRE = re.compile(rb"<!\[CDATA\[|<!--|<(/?)(FBD|LD|SFC)(?=[\s/>])")
+    TokensEnd = {b"<![CDATA[": b"]]>", b"<!--": b"-->"}
+    # longer than any body start
+    Margin = 256
+
+    def __init__(self):
+        self.Buffer = b""
+        # graphical body tag being cut, if any
+        self.Tag = None
+        self.Depth = 0
+        self.Pos = 0
+
+    def _Placeholder(self, content):
+        return (b"<?" + LAZY_BODY_PI.encode() + b" " +
+                base64.b64encode(zlib.compress(content, 1)) + b"?>")
+
+    def _FindEnd(self, buff, start):
+        """
+        Return position of closing tag of body being cut, that started
+        at start in buff, or None if more data is needed
+        """
+        # fast path : no CDATA, comment or nested body before closing tag
+        end = buff.find(b"</" + self.Tag + b">", self.Pos)
+        if end == -1:
+            return None
+        if self.Depth == 1 and self.Pos == start and \
+           buff.find(b"<![CDATA[", start, end) == -1 and \
+           buff.find(b"<!--", start, end) == -1 and \
+           buff.find(b"<" + self.Tag, start, end) == -1:
+            return end
+
+        while True:
+            match = self.TokensRE.search(buff, self.Pos)
+            if match is None:
+                # keep possibly truncated token
+                self.Pos = max(self.Pos, len(buff) - 16)
+                return None
+            token_end = self.TokensEnd.get(match.group(0), b">")
+            end = buff.find(token_end, match.end())
+            if end == -1:
+                self.Pos = match.start()
+                return None
+            end += len(token_end)
+            self.Pos = end
+            if match.group(2) != self.Tag:
+                continue
+            if match.group(1):
+                self.Depth -= 1
+            elif buff[end - 2:end - 1] != b"/":
+                self.Depth += 1
+            if self.Depth == 0:
+                return match.start()
+
+    def feed(self, data, final=False):
+        buff = self.Buffer + data
+        output = []
+        pos = 0
+        while True:
+            if self.Tag is None:
+                match = self.BodyStartRE.search(buff, pos)
+                if match is None:
+                    end = len(buff) if final else max(pos, len(buff) - self.Margin)
+                    output.append(buff[pos:end])
+                    pos = end
+                    break
+                output.append(buff[pos:match.end()])
+                pos = match.end()
+                self.Tag = match.group(1)
+                self.Depth = 1
+                self.Pos = pos
+            else:
+                end = self._FindEnd(buff, pos)
+                if end is None:
+                    break
+                output.append(self._Placeholder(buff[pos:end]))
+                pos = end
+                self.Tag = None
+        if final and self.Tag is not None:
+            # unterminated body, let parser report error
+            output.append(buff[pos:])
+            pos = len(buff)
+        # scanning position is relative to kept buffer
+        self.Pos -= pos
+        self.Buffer = buff[pos:]
+        return b"".join(output)
+
+    def close(self):
+        return self.feed(b"", True)
+
+
+def LoadProject(filepath, lazy=False):
+    """
+    Load project from file. File is parsed by chunks, without loading
+    whole file in memory first.
+    If lazy, graphical bodies (FBD, LD, SFC) are kept unparsed and
+    only materialized on first access to body of their POU, action
+    or transition.
+    """
+    if lazy:
+        fixer = ProjectStreamFixer()
+        cutter = LazyBodyCutter()
+        parser = PLCOpenParser
+        try:
+            with open(filepath, 'rb') as project_file:
+                while True:
+                    data = project_file.read(LOAD_PROJECT_CHUNK_SIZE)
+                    if not data:
+                        break
+                    parser.feed(cutter.feed(fixer.feed(data)))
+            parser.feed(cutter.feed(fixer.close()) + cutter.close())
+            tree = parser.close()
+            if PLCOpenParser.XSDSchema.validate(tree):
+                return tree, None
+        except Exception:
+            try:
+                parser.close()
+            except Exception:
+                pass
+        # fall back to full load to fix old projects and report errors
+
     project_file = open(filepath, encoding='utf-8')
     project_xml = project_file.read()
     project_file.close()
     return LoadProjectXML(project_xml)
 
 
+# namespaces used in cut bodies, whatever declared in project file
+LAZY_BODY_NSMAP = {
+    None: "http://www.plcopen.org/xml/tc6_0201",
+    "xhtml": "http://www.w3.org/1999/xhtml"}
+
+lazy_bodies_xpath = etree.XPath(
+    ".//processing-instruction('%s')" % LAZY_BODY_PI)
+lazy_bodies_child_xpath = etree.XPath(
+    "*/*/processing-instruction('%s')" % LAZY_BODY_PI)
+
+
+def _MaterializeLazyBody(pi):
+    content = pi.getparent()
+    # body may have been copied out of project, where prefixes of file
+    # it was cut from aren't in scope anymore
+    nsmap = dict(LAZY_BODY_NSMAP)
+    nsmap.update(content.nsmap)
+    nsdecl = " ".join([
+        'xmlns="%s"' % uri if prefix is None else 'xmlns:%s="%s"' % (prefix, uri)
+        for prefix, uri in nsmap.items()])
+    tag = etree.QName(content.tag).localname
+    body = PLCOpenParser.Loads(
+        ('<body %s><%s>' % (nsdecl, tag)).encode() +
+        zlib.decompress(base64.b64decode(pi.text)) +
+        ('</%s></body>' % tag).encode())
+    content.getparent().replace(content, body[0])
+
+
+# elements whose own bodies are known to be parsed. Weak, as lxml proxies
+# of elements are recreated, and then checked again, once not referenced.
+# Not kept for whole trees, as undo can put back elements saved while
+# their bodies were unparsed anywhere in tree.
+_materialized_bodies = weakref.WeakSet()
+
+
+def MaterializeLazyBodies(element):
+    """
+    Parse all bodies left unparsed by lazy LoadProject in element
+    """
+    for pi in lazy_bodies_xpath(element):
+        _MaterializeLazyBody(pi)
+
+
+# modification stamps of data types, POUs and configurations, weak as
+# for lazy bodies. A recreated proxy was not referenced by any snapshot
+# store, so it is serialized anyway.
+_modification_stamps = weakref.WeakKeyDictionary()
+_modification_counter = itertools.count(1)
+
+
+def MarkModified(element):
+    """
+    Mark a data type, POU or configuration as possibly modified, so that
+    ProjectSnapshotStore serializes it again at next snapshot. Elements
+    are marked by any change made in them through project classes (see
+    _updateModificationTrackingClass), and project accessors of these
+    elements also mark the one they return.
+    """
+    _modification_stamps[element] = next(_modification_counter)
+
+
+def GetModificationStamp(element):
+    return _modification_stamps.get(element, 0)
+
+
+# tags of elements whose modification is tracked
+_modification_tracked_tags = set([
+    "{http://www.plcopen.org/xml/tc6_0201}%s" % tag
+    for tag in ["dataType", "pou", "configuration"]])
+
+
+def _MarkAncestorModified(element):
+    """
+    Mark data type, POU or configuration containing element as modified
+    """
+    while element is not None:
+        if element.tag in _modification_tracked_tags:
+            MarkModified(element)
+            return
+        element = element.getparent()
+
+
+def _updateLazyBodiesClass(cls):
+    getattr_method = cls.__getattr__
+
+    def __getattr__(self, name):
+        if name == "body" and self not in _materialized_bodies:
+            # only look at bodies of this element, not whole subtree
+            for pi in lazy_bodies_child_xpath(self):
+                _MaterializeLazyBody(pi)
+            _materialized_bodies.add(self)
+        return getattr_method(self, name)
+
+    setattr(cls, "__getattr__", __getattr__)
+
+    def tostring(self):
+        MaterializeLazyBodies(self)
+        return DefaultElementClass.tostring(self)
+
+    setattr(cls, "tostring", tostring)
+
+
 project_pou_xpath = PLCOpen_XPath("/ppx:project/ppx:types/ppx:pous/ppx:pou")
 
 
@@ -326,6 +623,7 @@ def LoadPouInstances(xml_string, body_type):
 
 
 def SaveProject(project, filepath):
+    MaterializeLazyBodies(project)
     content = etree.tostring(
         project,
         pretty_print=True,
@@ -463,6 +761,7 @@ def _updateProjectClass(cls):
         def gettypeElement(self, name):
             elements = elements_xpath(self, name=name)
             if len(elements) == 1:
+                MarkModified(elements[0])
                 return elements[0]
             return None
 
@@ -541,6 +840,7 @@ def _updateProjectClass(cls):
     def getconfiguration(self, name):
         configurations = configuration_xpath(self, name=name)
         if len(configurations) == 1:
+            MarkModified(configurations[0])
             return configurations[0]
         return None
 
@@ -569,6 +869,7 @@ def _updateProjectClass(cls):
     def getconfigurationResource(self, config_name, name):
         resources = resources_xpath(self, configname=config_name, name=name)
         if len(resources) == 1:
+            MarkModified(resources[0].getparent())
             return resources[0]
         return None
 
@@ -603,7 +904,14 @@ def _updateProjectClass(cls):
 
     setattr(cls, "removeconfigurationResource", removeconfigurationResource)
 
+    def _markAllModified(self):
+        for element in self.getdataTypes() + self.getpous() + self.getconfigurations():
+            MarkModified(element)
+
+    setattr(cls, "_markAllModified", _markAllModified)
+
     def updateElementName(self, old_name, new_name):
+        self._markAllModified()
         for datatype in self.getdataTypes():
             datatype.updateElementName(old_name, new_name)
         for pou in self.getpous():
@@ -614,6 +922,7 @@ def _updateProjectClass(cls):
     setattr(cls, "updateElementName", updateElementName)
 
     def updateElementAddress(self, old_leading, new_leading):
+        self._markAllModified()
         address_model = re.compile(FILTER_ADDRESS_MODEL % old_leading)
         for pou in self.getpous():
             pou.updateElementAddress(address_model, new_leading)
@@ -623,6 +932,7 @@ def _updateProjectClass(cls):
     setattr(cls, "updateElementAddress", updateElementAddress)
 
     def removeVariableByAddress(self, address):
+        self._markAllModified()
         for pou in self.getpous():
             pou.removeVariableByAddress(address)
         for configuration in self.getconfigurations():
@@ -631,6 +941,7 @@ def _updateProjectClass(cls):
     setattr(cls, "removeVariableByAddress", removeVariableByAddress)
 
     def removeVariableByFilter(self, leading):
+        self._markAllModified()
         address_model = re.compile(FILTER_ADDRESS_MODEL % leading)
         for pou in self.getpous():
             pou.removeVariableByFilter(address_model)
@@ -1383,8 +1694,10 @@ def _updatePouPousClass(cls):
     setattr(cls, "setbodyType", setbodyType)
 
     def getbodyType(self):
-        if len(self.body) > 0:
-            return self.body[0].getcontent().getLocalTag()
+        # don't materialize lazy body, only its type is needed
+        body = self.find(PLCOpenParser.DefaultNamespaceFormat % "body")
+        if body is not None:
+            return body.getcontent().getLocalTag()
 
     setattr(cls, "getbodyType", getbodyType)
 
@@ -1804,6 +2117,7 @@ if cls:
     block_outputs_xpath = PLCOpen_XPath(
         "ppx:interface/*[self::ppx:outputVars or self::ppx:inOutVars]/ppx:variable")
     _updatePouPousClass(cls)
+    _updateLazyBodiesClass(cls)
 
 
 # ----------------------------------------------------------------------
@@ -1917,6 +2231,7 @@ def _updateTransitionTransitionsClass(cls):
 cls = PLCOpenParser.GetElementClass("transition", "transitions")
 if cls:
     _updateTransitionTransitionsClass(cls)
+    _updateLazyBodiesClass(cls)
 
 
 # ----------------------------------------------------------------------
@@ -1954,6 +2269,7 @@ def _updateActionActionsClass(cls):
 cls = PLCOpenParser.GetElementClass("action", "actions")
 if cls:
     _updateActionActionsClass(cls)
+    _updateLazyBodiesClass(cls)
 
 
 # ----------------------------------------------------------------------
@@ -3135,3 +3451,84 @@ cls = PLCOpenParser.GetElementClass("structValue", "value")
 if cls:
     structValue_model = re.compile("(.*):=(.*)")
     _updateStructValueValueClass(cls)
+
+
+# lxml methods, and attribute setter of project classes, modifying element
+_modifying_methods = [
+    "__setattr__", "__setitem__", "__delitem__", "append", "extend",
+    "insert", "remove", "replace", "set", "clear", "addnext", "addprevious"]
+
+
+def _ModifyingMethod(method):
+    def modifying_method(self, *args, **kwargs):
+        _MarkAncestorModified(self)
+        return method(self, *args, **kwargs)
+
+    modifying_method.modification_tracking = True
+    return modifying_method
+
+
+def _updateModificationTrackingClass(cls):
+    for name in _modifying_methods:
+        method = getattr(cls, name)
+        # skip methods already wrapped in parent class
+        if not getattr(method, "modification_tracking", False):
+            setattr(cls, name, _ModifyingMethod(method))
+
+
+def _GetElementClasses():
+    classes = set()
+    for lookup in PLCOpenParser.ClassLookup.LookUpClasses.values():
+        candidates = (list(lookup.values()) if isinstance(lookup, dict)
+                      else [lookup[0]])
+        for candidate in candidates:
+            # default class is shared with other parsers
+            if isinstance(candidate, type) and candidate is not DefaultElementClass:
+                classes.add(candidate)
+    return classes
+
+
+for cls in _GetElementClasses():
+    _updateModificationTrackingClass(cls)
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import timeit
+    from copy import deepcopy
+
+    # benchmark : synthetic project made of 1000 POUs copied from
+    # first_steps FBD POUs, loaded eagerly and lazily
+    source = paths.AbsNeighbourFile(
+        __file__, "..", "tests", "first_steps", "plc.xml")
+    project, _error = LoadProject(source)
+    pous = [pou for pou in project.getpous() if pou.getbodyType() == "FBD"]
+    pous_node = pous[0].getparent()
+    for i in range(1000 // len(pous)):
+        for pou in pous:
+            new_pou = deepcopy(pou)
+            new_pou.setname("%s_%d" % (pou.getname(), i))
+            pous_node.append(new_pou)
+    fd, filepath = tempfile.mkstemp(suffix=".xml")
+    os.close(fd)
+    SaveProject(project, filepath)
+    print("%d POUs, %d kB" % (len(project.getpous()), os.path.getsize(filepath) // 1024))
+
+    eager, _error = LoadProject(filepath)
+    lazy, _error = LoadProject(filepath, lazy=True)
+    assert [pou.getbodyType() for pou in lazy.getpous()] == \
+        [pou.getbodyType() for pou in eager.getpous()]
+    MaterializeLazyBodies(lazy)
+    assert etree.tostring(lazy, method="c14n") == etree.tostring(eager, method="c14n")
+
+    for name, func in [
+            ("eager load", lambda: LoadProject(filepath)),
+            ("lazy load", lambda: LoadProject(filepath, lazy=True)),
+            ("lazy load, tree infos", lambda: [
+                (pou.getname(), pou.getbodyType())
+                for pou in LoadProject(filepath, lazy=True)[0].getpous()]),
+            ("lazy load, all bodies", lambda: MaterializeLazyBodies(
+                LoadProject(filepath, lazy=True)[0]))]:
+        print("%-22s: %.0f ms" % (name, min(timeit.repeat(func, number=1, repeat=3)) * 1000))
+    os.remove(filepath)
@@ -121,6 +121,9 @@ class PythonFileCTNMixin(CodeFile):
                 "pyextname": pyextname
             },
             self.CodeFile.variables.variable))
+        # index of variable in bulk access mask
+        for index, varinfo in enumerate(varinfos):
+            varinfo["index"] = index
         # python side PLC global variables access stub
         globalstubs = "\n".join([
             """\
@@ -140,6 +143,30 @@ _%(pyextname)sGlobalsDesc.append((
     %(opts)s))
 """ % varinfo for varinfo in varinfos])
 
+        # python side bulk access to all variables, in one call
+        if varinfos:
+            globalstubs += """
+class _%(pyextname)sGlobs_ctype(ctypes.Structure):
+    _fields_ = [
+%(fields)s]
+_PySafeGetPLCGlobs_%(pyextname)s = PLCBinary.__SafeGetPLCGlobs_%(location_str)s
+_PySafeGetPLCGlobs_%(pyextname)s.restype = None
+_PySafeGetPLCGlobs_%(pyextname)s.argtypes = [ctypes.POINTER(_%(pyextname)sGlobs_ctype), ctypes.c_char_p]
+_PySafeSetPLCGlobs_%(pyextname)s = PLCBinary.__SafeSetPLCGlobs_%(location_str)s
+_PySafeSetPLCGlobs_%(pyextname)s.restype = None
+_PySafeSetPLCGlobs_%(pyextname)s.argtypes = [ctypes.POINTER(_%(pyextname)sGlobs_ctype), ctypes.c_char_p]
+PLCGlobalsBulk.append((
+    "%(pyextname)s",
+    _%(pyextname)sGlobs_ctype,
+    _PySafeGetPLCGlobs_%(pyextname)s,
+    _PySafeSetPLCGlobs_%(pyextname)s,
+    %(IECtypes)s))
+""" % {"pyextname": pyextname,
+                "location_str": location_str,
+                "fields": "\n".join([
+                    '        ("%(name)s", _%(name)s_ctype),' % varinfo for varinfo in varinfos]),
+                "IECtypes": repr([varinfo["IECtype"] for varinfo in varinfos])}
+
         # Runtime calls (start, stop, init, and cleanup)
         rtcalls = ""
         for section in self.SECTIONS_NAMES:
@@ -217,6 +244,38 @@ void __SafeSetPLCGlob_%(name)s(IEC_%(IECtype)s *value){
 
         vardeconchangefmt = """\
 PYTHON_POLL* __%(name)s_notifier;
+"""
+
+        # bulk access, variables being selected by mask, one byte per
+        # variable in declaration order, or NULL for all variables
+        bulkfieldfmt = """\
+    IEC_%(IECtype)s %(name)s;"""
+
+        bulkgetfmt = """\
+    if(!mask || mask[%(index)d]){
+        while(AtomicCompareExchange(&__%(name)s_rlock, 0, 1));
+        pvalues->%(name)s = __%(name)s_rbuffer;
+        AtomicCompareExchange((long*)&__%(name)s_rlock, 1, 0);
+    }"""
+
+        bulksetfmt = """\
+    if(!mask || mask[%(index)d]){
+        while(AtomicCompareExchange(&__%(name)s_wlock, 0, 1));
+        __%(name)s_wbuffer = values->%(name)s;
+        __%(name)s_wbuffer_written = 1;
+        AtomicCompareExchange((long*)&__%(name)s_wlock, 1, 0);
+    }"""
+
+        bulkdecfmt = """\
+typedef struct {
+%(bulkfields)s
+} __PyExtGlobs_%(location_str)s_t;
+void __SafeGetPLCGlobs_%(location_str)s(__PyExtGlobs_%(location_str)s_t *pvalues, const char *mask){
+%(bulkget)s
+}
+void __SafeSetPLCGlobs_%(location_str)s(__PyExtGlobs_%(location_str)s_t *values, const char *mask){
+%(bulkset)s
+}
 """
 
         varretfmt = """\
@@ -260,6 +319,12 @@ PYTHON_POLL* __%(name)s_notifier;
         varinit = "\n".join([varinitonchangefmt %
                              dict(onchangelen=len(varinfo["onchangecode"]), **varinfo)
                              for varinfo in varinfos if varinfo["onchange"]])
+        if varinfos:
+            vardec += "\n" + bulkdecfmt % {
+                "location_str": location_str,
+                "bulkfields": "\n".join([bulkfieldfmt % varinfo for varinfo in varinfos]),
+                "bulkget": "\n".join([bulkgetfmt % varinfo for varinfo in varinfos]),
+                "bulkset": "\n".join([bulksetfmt % varinfo for varinfo in varinfos])}
 
         loc_dict = {
             "vardec": vardec,
@@ -12,6 +12,11 @@
  * python_eval interface. We use those local variables as buffer and state
  * flags.
  *
+ * PythonIterator answers FBs in fifo order. PythonTakeCommand and
+ * PythonGiveResult let python thread hand commands to a pool of workers
+ * and answer FBs in any order : fifo cell is released as soon as command
+ * is taken, and FB stays in PROCESSING state until answered.
+ *
  * */
 
 #include "iec_types_all.h"
@@ -88,6 +93,29 @@ void __publish_py_ext()
 }
 
 
+/* Store result in FB buffer, and mark it as answered.
+ * Must be called with python mutex held */
+static void __PythonSetResult(PYTHON_EVAL* data__, char* result)
+{
+	/* If result not None */
+	if(result){
+		/* Get results len */
+	    __SET_VAR(data__->, BUFFER, .len, strlen(result));
+		/* prevent results overrun */
+		if(__GET_VAR(data__->BUFFER, .len) > STR_MAX_LEN)
+		{
+		    __SET_VAR(data__->, BUFFER, .len, STR_MAX_LEN);
+			/* TODO : signal error */
+		}
+		/* Copy results to buffer */
+		strncpy((char*)__GET_VAR(data__->BUFFER, .body), result, __GET_VAR(data__->BUFFER,.len));
+	}else{
+	    __SET_VAR(data__->, BUFFER, .len, 0);
+	}
+	/* Mark block as answered */
+	__SET_VAR(data__->, STATE,, PYTHON_FB_ANSWERED);
+}
+
 char* PythonIterator(char* result, void** id)
 {
 	char* next_command;
@@ -101,25 +129,9 @@ char* PythonIterator(char* result, void** id)
 	data__ = EvalFBs[Current_Python_EvalFB];
 	if(data__ && /* may be null at first run */
 	    __GET_VAR(data__->STATE) == PYTHON_FB_PROCESSING){ /* some answer awaited*/
-	   	/* If result not None */
-	   	if(result){
-			/* Get results len */
-	   	    __SET_VAR(data__->, BUFFER, .len, strlen(result));
-			/* prevent results overrun */
-			if(__GET_VAR(data__->BUFFER, .len) > STR_MAX_LEN)
-			{
-			    __SET_VAR(data__->, BUFFER, .len, STR_MAX_LEN);
-				/* TODO : signal error */
-			}
-			/* Copy results to buffer */
-			strncpy((char*)__GET_VAR(data__->BUFFER, .body), result, __GET_VAR(data__->BUFFER,.len));
-	   	}else{
-	   	    __SET_VAR(data__->, BUFFER, .len, 0);
-	   	}
+		__PythonSetResult(data__, result);
 		/* remove block from fifo*/
 		EvalFBs[Current_Python_EvalFB] = NULL;
-		/* Mark block as answered */
-		__SET_VAR(data__->, STATE,, PYTHON_FB_ANSWERED);
 		/* Get a new line */
 		Current_Python_EvalFB = (Current_Python_EvalFB + 1) %% %(python_eval_fb_count)d;
 		//printf("PythonIterator ++ Current_Python_EvalFB %%d\n", Current_Python_EvalFB);
@@ -151,6 +163,48 @@ char* PythonIterator(char* result, void** id)
 	return next_command;
 }
 
+char* PythonTakeCommand(void** id)
+{
+	char* next_command;
+	PYTHON_EVAL* data__;
+	/*emergency exit*/
+	if(PythonState & PYTHON_FINISHED) return NULL;
+	LockPython();
+	/* while next slot is empty or doesn't contain command */
+	while(((data__ = EvalFBs[Current_Python_EvalFB]) == NULL) ||
+	      __GET_VAR(data__->STATE) != PYTHON_FB_REQUESTED)
+	{
+		UnLockPython();
+		/* wait next FB to eval */
+		if(WaitPythonCommands()) return NULL;
+		/*emergency exit*/
+		if(PythonState & PYTHON_FINISHED) return NULL;
+		LockPython();
+	}
+	/* Mark block as processing, FB cannot be requested again until answered */
+	__SET_VAR(data__->, STATE,, PYTHON_FB_PROCESSING);
+	/* remove block from fifo, answer is given later by PythonGiveResult */
+	EvalFBs[Current_Python_EvalFB] = NULL;
+	Current_Python_EvalFB = (Current_Python_EvalFB + 1) %% %(python_eval_fb_count)d;
+	/* make BUFFER a null terminated string */
+	__SET_VAR(data__->, BUFFER, .body[__GET_VAR(data__->BUFFER, .len)], 0);
+	next_command = (char*)__GET_VAR(data__->BUFFER, .body);
+	*id=data__;
+	UnLockPython();
+	return next_command;
+}
+
+void PythonGiveResult(char* result, void* id)
+{
+	PYTHON_EVAL* data__ = (PYTHON_EVAL*)id;
+	/* PLC is being stopped, nobody waits for answer */
+	if(PythonState & PYTHON_FINISHED) return;
+	LockPython();
+	if(__GET_VAR(data__->STATE) == PYTHON_FB_PROCESSING)
+		__PythonSetResult(data__, result);
+	UnLockPython();
+}
+
 }
 
 /**
@@ -30,9 +30,10 @@ import os
 import shutil
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps, partial
 from tempfile import mkstemp
-from threading import Thread, Lock, Event, Condition
+from threading import Thread, Lock, Event, Condition, BoundedSemaphore
 from time import time
 
 import Pyro4
@@ -40,8 +41,10 @@ from past.builtins import execfile
 
 from runtime import PlcStatus, MainWorker, GetPLCObjectSingleton, CreatePLCObjectSingleton, default_evaluator
 from runtime.Stunnel import getPSKID
-from runtime.loglevels import LogLevelsCount, LogLevelsDefault
-from runtime.typemapping import TypeTranslator
+from runtime.loglevels import LogLevelsCount, LogLevelsDefault, LogMessagesMaxBytes, LogMessageHeaderSize, \
+    PackLogMessages
+from runtime.typemapping import TypeTranslator, PackTraces, DebugTraceLayout
+from runtime.TraceRingBuffer import TraceRingBuffer
 
 if os.name in ("nt", "ce"):
     dlopen = _ctypes.LoadLibrary
@@ -68,6 +71,78 @@ def PLCprint(message):
     sys.stdout.flush()
 
 
+class SchedStats(ctypes.Structure):
+    """
+    PLC cycles statistics, as sched_stats_t in target C code
+    """
+    _fields_ = [("cycles", ctypes.c_uint32),
+                ("overruns", ctypes.c_uint32),
+                ("exec_max", ctypes.c_uint64),
+                ("jitter_max", ctypes.c_uint64),
+                ("exec_hist", ctypes.c_uint32 * 32),
+                ("jitter_hist", ctypes.c_uint32 * 32)]
+
+
+class PLCGlobalsView(object):
+    """
+    Values of python extensions PLC global variables, all read or written
+    in one call per extension, as attributes of view :
+
+        view = PLCGlobalsView(["Speed", "Pos"])
+        view.Read()
+        view.Pos = view.Pos + view.Speed
+        view.Write()
+
+    Read and Write only access variables given at view creation (all if
+    None). AsArrays gives values as NumPy structured arrays sharing view
+    buffers, one per python extension.
+    """
+
+    def __init__(self, bulks, names=None):
+        self.__dict__["_bulks"] = []
+        self.__dict__["_fields"] = {}
+        for pyextname, struct_type, get, set, iectypes in bulks:
+            fields = [name for name, _ctype in struct_type._fields_]
+            mask = bytes([names is None or name in names for name in fields])
+            if not any(mask):
+                continue
+            values = struct_type()
+            self._bulks.append((pyextname, values, get, set, mask))
+            for name, iectype, selected in zip(fields, iectypes, mask):
+                if selected:
+                    ctype, unpack, pack = TypeTranslator[iectype]
+                    offset = getattr(struct_type, name).offset
+                    self._fields[name] = (ctype.from_buffer(values, offset), unpack, pack)
+
+    def Read(self):
+        for _pyextname, values, get, _set, mask in self._bulks:
+            get(ctypes.byref(values), mask)
+
+    def Write(self):
+        for _pyextname, values, _get, set, mask in self._bulks:
+            set(ctypes.byref(values), mask)
+
+    def AsArrays(self):
+        import numpy
+        return {pyextname: numpy.frombuffer(values, dtype=numpy.dtype(type(values)))
+                for pyextname, values, _get, _set, _mask in self._bulks}
+
+    def __getattr__(self, name):
+        try:
+            view, unpack, _pack = self._fields[name]
+        except KeyError:
+            raise AttributeError("Variable not in view : %s" % name)
+        return unpack(view)
+
+    def __setattr__(self, name, value):
+        try:
+            view, _unpack, pack = self._fields[name]
+        except KeyError:
+            raise AttributeError("Variable not in view : %s" % name)
+        packed = pack(type(view), value)
+        ctypes.memmove(ctypes.addressof(view), ctypes.addressof(packed), ctypes.sizeof(packed))
+
+
 def RunInMain(func):
     @wraps(func)
     def func_wrapper(*args, **kwargs):
@@ -96,10 +171,15 @@ class PLCObject(object):
         self._loading_error = None
         self.python_runtime_vars = None
         self.TraceThread = None
-        self.TraceLock = Lock()
-        self.Traces = []
+        self.Traces = TraceRingBuffer()
+        self.LastPackedTrace = None
+        self.TraceLayout = DebugTraceLayout([])
         self.DebugToken = 0
+        # path -> ((mtime, size), MD5 hex digest) of files held by runtime
+        self.FileDigests = {}
 
+        # uploads are written out of main thread, see WriteChunkToBlob
+        self.UploadsLock = Lock()
         self._init_blobs()
 
     # First task of worker -> no @RunInMain
@@ -152,6 +232,28 @@ class PLCObject(object):
 
     @RunInMain
     def GetLogMessage(self, level, msgid):
+        return self._ReadLogMessage(level, msgid)
+
+    @RunInMain
+    def GetLogMessages(self, level, first, count, max_bytes=LogMessagesMaxBytes):
+        """
+        Messages first to first + count - 1 of given level that are still
+        available, packed in one buffer (see loglevels.PackLogMessages).
+        Batch is cut once max_bytes is reached, but holds at least one message.
+        """
+        messages = []
+        size = 0
+        for msgid in range(first, first + count):
+            message = self._ReadLogMessage(level, msgid)
+            if message is None:
+                continue
+            size += LogMessageHeaderSize + len(message[0])
+            if messages and size > max_bytes:
+                break
+            messages.append((msgid,) + tuple(message))
+        return PackLogMessages(messages)
+
+    def _ReadLogMessage(self, level, msgid):
         tick = ctypes.c_uint32()
         tv_sec = ctypes.c_uint32()
         tv_nsec = ctypes.c_uint32()
@@ -206,6 +308,15 @@ class PLCObject(object):
                 self._PythonIterator.restype = ctypes.c_char_p
                 self._PythonIterator.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p)]
 
+                # only provided by python extensions answering FBs out of order
+                self._PythonTakeCommand = getattr(self.PLClibraryHandle, "PythonTakeCommand", None)
+                if self._PythonTakeCommand is not None:
+                    self._PythonTakeCommand.restype = ctypes.c_char_p
+                    self._PythonTakeCommand.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+                    self._PythonGiveResult = self.PLClibraryHandle.PythonGiveResult
+                    self._PythonGiveResult.restype = None
+                    self._PythonGiveResult.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+
                 self._stopPLC = self._stopPLC_real
             else:
                 # If python confnode is not enabled, we reuse _PythonIterator
@@ -265,6 +376,14 @@ class PLCObject(object):
                                             ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint32),
                                             ctypes.POINTER(ctypes.c_uint32)]
 
+            # only provided by targets keeping PLC cycles statistics
+            self._GetSchedStats = getattr(self.PLClibraryHandle, "GetSchedStats", None)
+            if self._GetSchedStats is not None:
+                self._GetSchedStats.restype = ctypes.c_int
+                self._GetSchedStats.argtypes = [ctypes.POINTER(SchedStats)]
+                self._ResetSchedStats = self.PLClibraryHandle.ResetSchedStats
+                self._ResetSchedStats.restype = None
+
             self._loading_error = None
 
         except Exception:
@@ -305,9 +424,13 @@ class PLCObject(object):
         self._suspendDebug = lambda x: -1
         self._resumeDebug = lambda: None
         self._PythonIterator = lambda: ""
+        self._PythonTakeCommand = None
+        self._PythonGiveResult = None
         self._GetLogCount = None
         self._LogMessage = None
         self._GetLogMessage = None
+        self._GetSchedStats = None
+        self._ResetSchedStats = lambda: None
         self._PLClibraryHandle = None
         self.PLClibraryHandle = None
 
@@ -376,7 +499,10 @@ class PLCObject(object):
             "WorkingDir": self.workingdir,
             "PLCObject": self,
             "PLCBinary": self.PLClibraryHandle,
-            "PLCGlobalsDesc": []})
+            "PLCGlobalsDesc": [],
+            "PLCGlobalsBulk": [],
+            "PLCGlobalsView": lambda names=None: PLCGlobalsView(
+                parent.python_runtime_vars["PLCGlobalsBulk"], names)})
 
         for methodname in MethodNames:
             self.python_runtime_vars["_runtime_%s" % methodname] = []
@@ -413,7 +539,38 @@ class PLCObject(object):
 
         self.python_runtime_vars = None
 
+    def _PythonEval(self, FBID, cmd, compile_cache, evaluator):
+        """
+        Evaluate one python_eval FB command
+        @param evaluator: PLCObject evaluator, or default_evaluator
+        @return: result to be given back to FB
+        """
+        try:
+            ccmd, AST = compile_cache.get(FBID, (None, None))
+            if ccmd is None or ccmd != cmd:
+                AST = compile(cmd, '<plc>', 'eval')
+                compile_cache[FBID] = (cmd, AST)
+            result, exp = evaluator(eval, AST, self.python_runtime_vars)
+            if exp is not None:
+                res = b"#EXCEPTION : " + str(exp[1]).encode()
+                self.LogMessage(1, ('PyEval@0x%x(Code="%s") Exception "%s"') % (
+                    FBID, cmd, '\n'.join(traceback.format_exception(*exp))))
+            else:
+                res = str(result).encode()
+        except Exception as e:
+            res = b"#EXCEPTION : " + str(e).encode()
+            self.LogMessage(1, ('PyEval@0x%x(Code="%s") Exception "%s"') % (FBID, cmd, str(e)))
+        return res
+
     def PythonThreadLoop(self):
+        # python extension code can set PythonEvalWorkers to evaluate
+        # python_eval FBs concurrently, see PythonPoolLoop
+        workers = self.python_runtime_vars.get("PythonEvalWorkers", 0)
+        if workers > 0 and self._PythonTakeCommand is not None:
+            depth = self.python_runtime_vars.get("PythonEvalQueueDepth", 2 * workers)
+            self.PythonPoolLoop(workers, max(depth, 1))
+            return
+
         res, cmd, blkid = b"None", b"None", ctypes.c_void_p()
         compile_cache = {}
         while True:
@@ -421,23 +578,68 @@ class PLCObject(object):
             FBID = blkid.value
             if cmd is None:
                 break
+            self.python_runtime_vars["FBID"] = FBID
+            res = self._PythonEval(FBID, cmd, compile_cache, self.evaluator)
+            self.python_runtime_vars["FBID"] = None
+
+    def PythonPoolLoop(self, workers, depth):
+        """
+        Dispatch python_eval FBs commands to a pool of worker threads, and
+        give each result back to its FB as soon as evaluated, so that a slow
+        command doesn't delay others. A FB cannot be triggered again before
+        being answered, hence commands of a same FB keep their order.
+        At most depth commands are taken from PLC at once, others wait in
+        PLC fifo. In that mode, commands are evaluated in worker threads
+        with default_evaluator rather than PLCObject evaluator, that may
+        serialize them in UI thread, and FBID isn't set in python runtime
+        globals.
+        Per FB latencies are logged when PLC stops.
+        @param workers: number of worker threads
+        @param depth: maximum number of commands taken and not yet answered
+        """
+        compile_cache = {}
+        # FBID -> [cmd, count, total latency, max latency, max queued time]
+        stats = {}
+        statslock = Lock()
+        slots = BoundedSemaphore(depth)
+        blkid = ctypes.c_void_p()
+        full = 0
+
+        def work(FBID, cmd, taken):
+            started = time()
             try:
-                self.python_runtime_vars["FBID"] = FBID
-                ccmd, AST = compile_cache.get(FBID, (None, None))
-                if ccmd is None or ccmd != cmd:
-                    AST = compile(cmd, '<plc>', 'eval')
-                    compile_cache[FBID] = (cmd, AST)
-                result, exp = self.evaluator(eval, AST, self.python_runtime_vars)
-                if exp is not None:
-                    res = b"#EXCEPTION : " + bytes([exp[1], ])
-                    self.LogMessage(1, ('PyEval@0x%x(Code="%s") Exception "%s"') % (
-                        FBID, cmd, '\n'.join(traceback.format_exception(*exp))))
-                else:
-                    res = str(result).encode()
-                self.python_runtime_vars["FBID"] = None
-            except Exception as e:
-                res = b"#EXCEPTION : " + bytes(e)
-                self.LogMessage(1, ('PyEval@0x%x(Code="%s") Exception "%s"') % (FBID, cmd, str(e)))
+                res = self._PythonEval(FBID, cmd, compile_cache, default_evaluator)
+                self._PythonGiveResult(res, FBID)
+            finally:
+                slots.release()
+            latency = time() - taken
+            with statslock:
+                st = stats.setdefault(FBID, [cmd, 0, 0., 0., 0.])
+                st[1] += 1
+                st[2] += latency
+                st[3] = max(st[3], latency)
+                st[4] = max(st[4], started - taken)
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="PLCPythonEval") as pool:
+            while True:
+                if not slots.acquire(blocking=False):
+                    if full == 0:
+                        self.LogMessage(1, "PyEval queue full (%d commands), "
+                                           "python_eval FBs are delayed" % depth)
+                    full += 1
+                    slots.acquire()
+                cmd = self._PythonTakeCommand(blkid)
+                if cmd is None:
+                    slots.release()
+                    break
+                pool.submit(work, blkid.value, cmd, time())
+
+        for FBID, (cmd, count, total, worst, queued) in sorted(stats.items()):
+            self.LogMessage(2, ('PyEval@0x%x(Code="%s") %d calls, latency avg %.3f ms, '
+                                'max %.3f ms, queued max %.3f ms') % (
+                FBID, cmd, count, 1000. * total / count, 1000. * worst, 1000. * queued))
+        if full:
+            self.LogMessage(1, "PyEval queue was full %d times" % full)
 
     def PythonThreadProc(self):
         while True:
@@ -485,6 +687,7 @@ class PLCObject(object):
         self.PreStartPLC()
         if self.CurrentPLCFilename is not None and self.PLCStatus == PlcStatus.Stopped:
             # c_argv = ctypes.c_char_p * len(self.argv)
+            self._ResetSchedStats()
             res = self._startPLC()
             if res == 0:
                 self.PLCStatus = PlcStatus.Started
@@ -523,6 +726,8 @@ class PLCObject(object):
 
     def _init_blobs(self):
         self.blobs = {}
+        # uploadID -> offset addressed blob upload, see OpenBlob
+        self.uploads = {}
         if os.path.exists(self.tmpdir):
             shutil.rmtree(self.tmpdir)
         os.mkdir(self.tmpdir)
@@ -550,11 +755,119 @@ class PLCObject(object):
         self.blobs[newBlobID] = blob
         return newBlobID
 
+    @RunInMain
+    def OpenBlob(self, seed, size, digest):
+        """
+        Open or resume upload of a blob, chunks being sent in any order by
+        WriteChunkToBlob. Content already held by runtime, as PLC or extra
+        file, is taken from it instead of being sent again.
+        @param seed: same as SeedBlob seed
+        @param size: size of blob content
+        @param digest: MD5 hex digest of blob content
+        @return: (uploadID, offset of first missing byte)
+        """
+        if isinstance(seed, str):
+            seed = seed.encode()
+        uploadID = hashlib.md5(seed + digest.encode()).hexdigest()
+        with self.UploadsLock:
+            upload = self.uploads.get(uploadID)
+            if upload is None:
+                fd, path = mkstemp(dir=self.tmpdir)
+                upload = {"fd": fd, "path": path, "size": size, "digest": digest,
+                          "acked": 0, "chunks": {},
+                          "content_md5": hashlib.md5(), "blob_md5": hashlib.md5(seed)}
+                self.uploads[uploadID] = upload
+                known = self._FindFileByDigest(size, digest)
+                if known is not None:
+                    with open(known, "rb") as f:
+                        for data in iter(partial(f.read, 1 << 20), b""):
+                            upload["chunks"][upload["acked"]] = data
+                            os.pwrite(fd, data, upload["acked"])
+                            self._AckBlobChunks(upload)
+            return uploadID, upload["acked"]
+
+    def _FindFileByDigest(self, size, digest):
+        try:
+            candidates = [fname.strip() for fname in open(self._extra_files_log_path(), "rt").readlines()]
+        except Exception:
+            candidates = []
+        if self.CurrentPLCFilename is not None:
+            candidates.append(self.CurrentPLCFilename)
+        for fname in candidates:
+            fpath = os.path.join(self.workingdir, fname)
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue
+            if stat.st_size != size:
+                continue
+            key = (stat.st_mtime, stat.st_size)
+            cached = self.FileDigests.get(fpath)
+            if cached is None or cached[0] != key:
+                md5sum = hashlib.md5()
+                with open(fpath, "rb") as f:
+                    for data in iter(partial(f.read, 1 << 20), b""):
+                        md5sum.update(data)
+                cached = (key, md5sum.hexdigest())
+                self.FileDigests[fpath] = cached
+            if cached[1] == digest:
+                return fpath
+        return None
+
+    def _AckBlobChunks(self, upload):
+        # hash contiguous chunks as they complete, so that blob is
+        # already checked when upload ends
+        chunks = upload["chunks"]
+        while upload["acked"] in chunks:
+            data = chunks.pop(upload["acked"])
+            upload["content_md5"].update(data)
+            upload["blob_md5"].update(data)
+            upload["acked"] += len(data)
+
+    def WriteChunkToBlob(self, uploadID, offset, data):
+        """
+        Write a chunk of blob opened with OpenBlob. Not run in main
+        thread, so that chunks can be received concurrently.
+        @return: offset of first missing byte, or None if upload is unknown
+        """
+        with self.UploadsLock:
+            upload = self.uploads.get(uploadID)
+            if upload is None or offset + len(data) > upload["size"]:
+                return None
+            if offset >= upload["acked"]:
+                os.pwrite(upload["fd"], data, offset)
+                upload["chunks"][offset] = data
+                self._AckBlobChunks(upload)
+            return upload["acked"]
+
+    @RunInMain
+    def CloseBlob(self, uploadID):
+        """
+        End blob upload
+        @return: blobID to be given to NewPLC, or None if blob is incomplete
+                 or corrupted
+        """
+        with self.UploadsLock:
+            upload = self.uploads.get(uploadID)
+            if upload is None or upload["acked"] != upload["size"]:
+                return None
+            self.uploads.pop(uploadID)
+            if upload["content_md5"].hexdigest() != upload["digest"]:
+                os.close(upload["fd"])
+                os.remove(upload["path"])
+                return None
+            blobID = upload["blob_md5"].digest()
+            self.blobs[blobID] = (upload["fd"], upload["path"], upload["blob_md5"])
+            return blobID
+
     @RunInMain
     def PurgeBlobs(self):
         for fd, _path, _md5sum in self.blobs.values():
             os.close(fd)
-        self._init_blobs()
+        with self.UploadsLock:
+            for upload in self.uploads.values():
+                os.close(upload["fd"])
+            self._init_blobs()
 
     def _BlobAsFile(self, blobID, newpath):
         blob = self.blobs.pop(blobID, None)
@@ -673,6 +986,8 @@ class PLCObject(object):
             if self._suspendDebug(False) == 0:
                 # keep a copy of requested idx
                 self._ResetDebugVariables()
+                self.TraceLayout = DebugTraceLayout(
+                    [iectype.decode() for _idx, _force, iectype in idxs])
                 for idx, force, iectype in idxs:
                     if force is not None:
                         c_type, _unpack_func, pack_func = \
@@ -681,22 +996,22 @@ class PLCObject(object):
                         force = ctypes.byref(pack_func(c_type, force))
                     self._RegisterDebugVariable(idx, force)
                 self._TracesSwap()
+                self.LastPackedTrace = None
                 self._resumeDebug()
                 return self.DebugToken
         else:
             self._suspendDebug(True)
         return None
 
-    def _TracesSwap(self):
+    def _TracesPolled(self):
         self.LastSwapTrace = time()
         if self.TraceThread is None and self.PLCStatus == PlcStatus.Started:
             self.TraceThread = Thread(target=self.TraceThreadProc, name="PLCTrace")
             self.TraceThread.start()
-        self.TraceLock.acquire()
-        Traces = self.Traces
-        self.Traces = []
-        self.TraceLock.release()
-        return Traces
+
+    def _TracesSwap(self):
+        self._TracesPolled()
+        return self.Traces.Snapshot()
 
     @RunInMain
     def GetTraceVariables(self, DebugToken):
@@ -704,6 +1019,76 @@ class PLCObject(object):
             return self.PLCStatus, self._TracesSwap()
         return PlcStatus.Broken, []
 
+    def _DecimateTraces(self, traces, tick_step, changes_only):
+        """
+        Keep at most one sample every tick_step ticks, and if changes_only,
+        only samples that differ from previously kept one. Most recent sample
+        is always kept, so that client can tell PLC is still running.
+        """
+        if not traces or (not tick_step and not changes_only):
+            return traces
+        last = self.LastPackedTrace
+        decimated = []
+        for tick, buff in traces[:-1]:
+            if last is not None:
+                if tick_step and tick - last[0] < tick_step:
+                    continue
+                if changes_only and buff == last[1]:
+                    continue
+            last = (tick, buff)
+            decimated.append(last)
+        decimated.append(traces[-1])
+        self.LastPackedTrace = traces[-1]
+        return decimated
+
+    @RunInMain
+    def GetTraceVariablesPacked(self, DebugToken, tick_step=0, changes_only=False):
+        """
+        Same as GetTraceVariables, but samples are packed in one buffer
+        (see typemapping.PackTraces) and can be decimated before transfer.
+        Packed buffer also carries number of trace samples overwritten
+        before being polled.
+        """
+        if DebugToken is not None and DebugToken == self.DebugToken:
+            if not tick_step and not changes_only:
+                self._TracesPolled()
+                return self.PLCStatus, self.Traces.SnapshotPacked()
+            traces = self._DecimateTraces(self._TracesSwap(), tick_step, changes_only)
+            return self.PLCStatus, PackTraces(traces, self.Traces.Dropped)
+        return PlcStatus.Broken, PackTraces([], self.Traces.Dropped)
+
+    @RunInMain
+    def GetTraceVariablesDelta(self, DebugToken, keyframe=False, deadbands=None, changes_only=False):
+        """
+        Same as GetTraceVariablesPacked, but samples only carry variables
+        that changed since previous call (see DebugTraceLayout.PackDelta).
+        Client asks for a keyframe when it lost track of previous samples.
+        """
+        if DebugToken is not None and DebugToken == self.DebugToken:
+            traces = self._DecimateTraces(self._TracesSwap(), 0, changes_only)
+            return self.PLCStatus, self.TraceLayout.PackDelta(
+                traces, keyframe, deadbands, self.Traces.Dropped)
+        return PlcStatus.Broken, PackTraces([], self.Traces.Dropped)
+
+    @RunInMain
+    def GetSchedStats(self):
+        """
+        PLC cycles statistics kept by target : number of cycles and
+        overruns, max execution time and jitter in ns, and their histograms,
+        bin n counting durations in [2^(n-1), 2^n[ microseconds
+        @return: dict of statistics, or None if target doesn't keep them
+        """
+        if self._GetSchedStats is None:
+            return None
+        stats = SchedStats()
+        self._GetSchedStats(ctypes.byref(stats))
+        return {"cycles": stats.cycles,
+                "overruns": stats.overruns,
+                "exec_max": stats.exec_max,
+                "jitter_max": stats.jitter_max,
+                "exec_hist": list(stats.exec_hist),
+                "jitter_hist": list(stats.jitter_hist)}
+
     def TraceThreadProc(self):
         """
         Return a list of traces, corresponding to the list of required idx
@@ -732,19 +1117,13 @@ class PLCObject(object):
                 break
 
             if TraceBuffer is not None:
-                self.TraceLock.acquire()
-                lT = len(self.Traces)
-                if lT != 0 and lT * len(self.Traces[0]) > 1024 * 1024:
-                    self.Traces.pop(0)
-                self.Traces.append((tick.value, TraceBuffer))
-                self.TraceLock.release()
+                # overwrites oldest samples if not polled fast enough
+                self.Traces.Push(tick.value, TraceBuffer)
 
             # TraceProc stops here if Traces not polled for 3 seconds
             traces_age = time() - self.LastSwapTrace
             if traces_age > 3:
-                self.TraceLock.acquire()
-                self.Traces = []
-                self.TraceLock.release()
+                self.Traces.Reset()
                 self._suspendDebug(True)  # Disable debugger
                 break
 
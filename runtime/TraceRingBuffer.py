@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Beremiz runtime.
+#
+# See COPYING.Runtime file for copyrights details.
+
+
+import struct
+from array import array
+
+# Default amount of trace samples data kept between two polls
+TRACES_MAX_SIZE = 1024 * 1024
+
+
+class _TraceSlots(object):
+    """
+    Preallocated storage for a given maximum sample size.
+    Head is only written by producer, Read only by consumer.
+    """
+
+    def __init__(self, slot_size, max_size):
+        self.SlotSize = slot_size
+        self.Count = max(1, max_size // slot_size)
+        self.Data = bytearray(self.Count * slot_size)
+        self.View = memoryview(self.Data)
+        self.Ticks = array('I', [0]) * self.Count
+        self.Sizes = array('I', [0]) * self.Count
+        self.Head = 0
+        self.Read = 0
+
+
+class TraceRingBuffer(object):
+    """
+    Fixed capacity ring of trace samples, for one producer (trace thread)
+    and one consumer (main worker), without lock.
+
+    Producer fills next slot and then publishes it by incrementing Head,
+    overwriting oldest samples when consumer doesn't keep up.
+    Consumer copies all published slots in bulk, then checks Head again
+    to discard slots that producer may have overwritten meanwhile.
+    Overwritten samples are accounted in Dropped.
+    """
+
+    def __init__(self, max_size=TRACES_MAX_SIZE):
+        self.MaxSize = max_size
+        self.Dropped = 0
+        self._Slots = None
+        self._ReadSlots = None
+
+    def _GetSlots(self, size):
+        slots = self._Slots
+        if slots is None or size > slots.SlotSize:
+            # samples grew (i.e. STRING), previous ones will be dropped
+            slots = _TraceSlots(max(size, 1), self.MaxSize)
+            self._Slots = slots
+        return slots
+
+    def Push(self, tick, buff):
+        """
+        Producer side: copy sample into next slot and publish it
+        """
+        size = len(buff)
+        slots = self._GetSlots(size)
+        index = slots.Head % slots.Count
+        offset = index * slots.SlotSize
+        slots.View[offset:offset + size] = buff
+        slots.Ticks[index] = tick
+        slots.Sizes[index] = size
+        slots.Head += 1
+
+    def Reset(self):
+        """
+        Forget all samples. Dropped count is kept.
+        """
+        self._Slots = None
+        self._ReadSlots = None
+
+    def _Copy(self, slots, first, last):
+        """
+        Copy slots [first, last[ out of ring, in at most two chunks
+        """
+        count = slots.Count
+        begin = first % count
+        end = begin + last - first
+        if end <= count:
+            parts = [(begin, end)]
+        else:
+            parts = [(begin, count), (0, end - count)]
+        size = slots.SlotSize
+        data = b"".join([slots.View[a * size:b * size] for a, b in parts])
+        ticks = array('I')
+        sizes = array('I')
+        for a, b in parts:
+            ticks.extend(slots.Ticks[a:b])
+            sizes.extend(slots.Sizes[a:b])
+        return ticks, sizes, data
+
+    def _Snapshot(self):
+        """
+        Consumer side: return (ticks, sizes, data, slot_size) of all
+        samples published since previous snapshot
+        """
+        slots = self._Slots
+        read_slots = self._ReadSlots
+        if read_slots is not slots:
+            if read_slots is not None:
+                self.Dropped += min(read_slots.Head - read_slots.Read,
+                                    read_slots.Count)
+            self._ReadSlots = slots
+        if slots is None:
+            return array('I'), array('I'), b"", 0
+
+        head = slots.Head
+        first = max(slots.Read, head - slots.Count)
+        self.Dropped += first - slots.Read
+        ticks, sizes, data = self._Copy(slots, first, head)
+
+        # slot being written by producer is the one of oldest sample
+        # once ring is full, anything older than that may be torn
+        torn = slots.Head - slots.Count + 1 - first
+        if torn > 0:
+            torn = min(torn, head - first)
+            self.Dropped += torn
+            del ticks[:torn]
+            del sizes[:torn]
+            data = data[torn * slots.SlotSize:]
+        slots.Read = head
+        return ticks, sizes, data, slots.SlotSize
+
+    def Snapshot(self):
+        """
+        Consumer side: return list of (tick, buffer) samples published
+        since previous snapshot
+        """
+        ticks, sizes, data, slot_size = self._Snapshot()
+        return [(tick, data[i * slot_size:i * slot_size + size])
+                for i, (tick, size) in enumerate(zip(ticks, sizes))]
+
+    def SnapshotPacked(self):
+        """
+        Same as Snapshot, but return samples packed as with
+        typemapping.PackTraces, without building intermediate list
+        when all samples have slot size
+        """
+        ticks, sizes, data, slot_size = self._Snapshot()
+        count = len(ticks)
+        if any(size != slot_size for size in sizes):
+            data = b"".join([data[i * slot_size:i * slot_size + size]
+                             for i, size in enumerate(sizes)])
+        return struct.pack("=II", count, self.Dropped) + \
+            ticks.tobytes() + sizes.tobytes() + data
+
+
+if __name__ == "__main__":
+    import ctypes
+    import timeit
+    from runtime.typemapping import PackTraces
+
+    ring = TraceRingBuffer(1024)
+    for i in range(10):
+        ring.Push(i, bytes([i]) * 100)
+    # only 10 slots of 100 bytes, oldest one is considered torn
+    assert ring.Snapshot() == [(i, bytes([i]) * 100) for i in range(1, 10)]
+    assert ring.Dropped == 1
+    assert ring.Snapshot() == []
+    for i in range(25):
+        ring.Push(i, bytes([i]) * 100)
+    expected = [(i, bytes([i]) * 100) for i in range(16, 25)]
+    assert ring.SnapshotPacked() == PackTraces(expected, 17)
+    assert ring.Dropped == 17
+    # bigger sample reallocates ring, pending samples are dropped
+    ring.Push(1, b"a" * 50)
+    ring.Push(2, b"b" * 200)
+    ring.Push(3, b"c" * 20)
+    assert ring.Snapshot() == [(2, b"b" * 200), (3, b"c" * 20)]
+    assert ring.Dropped == 18
+
+    # microbenchmark : 2000 samples of 1kB fetched from C memory,
+    # half of them overflowing buffer, then polled
+    from threading import Lock
+    sample = ctypes.create_string_buffer(bytes(range(256)) * 4, 1024)
+    address = ctypes.addressof(sample)
+
+    ring = TraceRingBuffer()
+
+    def use_ring():
+        for i in range(2000):
+            ring.Push(i, ctypes.string_at(address, 1024))
+        return ring.SnapshotPacked()
+
+    def use_list():
+        traces = []
+        lock = Lock()
+        for i in range(2000):
+            buff = ctypes.string_at(address, 1024)
+            lock.acquire()
+            if len(traces) * len(buff) > TRACES_MAX_SIZE:
+                traces.pop(0)
+            traces.append((i, buff))
+            lock.release()
+        return PackTraces(traces)
+
+    for name, func in [("list", use_list), ("ring", use_ring)]:
+        print("%-4s : %.2f ms" % (name, min(timeit.repeat(func, number=10, repeat=5)) * 100))
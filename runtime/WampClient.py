@@ -43,10 +43,17 @@ ExposedCalls = [
     "GetPLCstatus",
     "NewPLC",
     "MatchMD5",
+    "OpenBlob",
+    "WriteChunkToBlob",
+    "CloseBlob",
     "SetTraceVariablesList",
     "GetTraceVariables",
+    "GetTraceVariablesPacked",
+    "GetTraceVariablesDelta",
+    "GetSchedStats",
     "RemoteExec",
     "GetLogMessage",
+    "GetLogMessages",
     "ResetLogCount",
 ]
 
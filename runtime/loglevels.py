@@ -3,7 +3,45 @@
 
 # See COPYING.Runtime file for copyrights details.
 
+import struct
+
 LogLevels = ["CRITICAL", "WARNING", "INFO", "DEBUG"]
 LogLevelsCount = len(LogLevels)
 LogLevelsDict = dict(list(zip(LogLevels, range(LogLevelsCount))))
 LogLevelsDefault = LogLevelsDict["DEBUG"]
+
+# Default size limit of a batch of log messages
+LogMessagesMaxBytes = 64 * 1024
+
+# msgid, tick, tv_sec, tv_nsec, message size
+_LogMessageHeader = struct.Struct("=5I")
+LogMessageHeaderSize = _LogMessageHeader.size
+
+
+def PackLogMessages(messages):
+    """
+    Pack a list of (msgid, message, tick, tv_sec, tv_nsec) log messages
+    into one buffer : messages count, messages headers, then utf-8 encoded
+    messages
+    """
+    encoded = [msg.encode() for _msgid, msg, _tick, _tv_sec, _tv_nsec in messages]
+    header = [struct.pack("=I", len(messages))]
+    for (msgid, _msg, tick, tv_sec, tv_nsec), data in zip(messages, encoded):
+        header.append(_LogMessageHeader.pack(msgid, tick, tv_sec, tv_nsec, len(data)))
+    return b"".join(header + encoded)
+
+
+def UnpackLogMessages(packed):
+    """
+    Reverse of PackLogMessages, returns a list of
+    (msgid, message, tick, tv_sec, tv_nsec)
+    """
+    count, = struct.unpack_from("=I", packed)
+    offset = 4 + count * LogMessageHeaderSize
+    messages = []
+    for msgid, tick, tv_sec, tv_nsec, size in _LogMessageHeader.iter_unpack(
+            memoryview(packed)[4:offset]):
+        messages.append((msgid, packed[offset:offset + size].decode(),
+                         tick, tv_sec, tv_nsec))
+        offset += size
+    return messages
@@ -6,9 +6,16 @@
 
 
 import ctypes
+import struct
 from ctypes import *
 from datetime import timedelta as td
 
+try:
+    import numpy
+except ImportError:
+    # change only encoding falls back to per variable comparison
+    numpy = None
+
 ctypes.pythonapi.PyUnicode_AsUTF8.argtypes = (ctypes.c_void_p,)
 ctypes.pythonapi.PyUnicode_AsUTF8.restype = ctypes.POINTER(ctypes.c_char)
 
@@ -98,5 +105,410 @@ def UnpackDebugBuffer(buff, indexes):
     return None
 
 
+def PackTraces(traces, dropped=0):
+    """
+    Pack a list of (tick, buff) trace samples into one contiguous buffer :
+    samples count, dropped samples count, ticks array, samples sizes array,
+    then samples data
+    @param dropped: number of samples runtime lost since it started
+    """
+    count = len(traces)
+    ticks = [tick for tick, _buff in traces]
+    sizes = [len(buff) for _tick, buff in traces]
+    return struct.pack("=II%dI%dI" % (count, count), count, dropped, *(ticks + sizes)) + \
+        b"".join([buff for _tick, buff in traces])
+
+
+def _UnpackTracesHeader(packed):
+    count, = struct.unpack_from("=I", packed)
+    header = struct.Struct("=%dI%dI" % (count, count))
+    ticksandsizes = header.unpack_from(packed, 8)
+    return (ticksandsizes[:count], ticksandsizes[count:],
+            memoryview(packed)[8 + header.size:])
+
+
+def TracesDropCount(packed):
+    """
+    Dropped samples count of traces packed with PackTraces
+    """
+    return struct.unpack_from("=I", packed, 4)[0]
+
+
+def UnpackTraces(packed):
+    """
+    Reverse of PackTraces, returns a list of (tick, buff)
+    """
+    ticks, sizes, data = _UnpackTracesHeader(packed)
+    traces = []
+    offset = 0
+    for tick, size in zip(ticks, sizes):
+        traces.append((tick, data[offset:offset + size].tobytes()))
+        offset += size
+    return traces
+
+
+# struct codes of fixed size debugger types, as laid out in debug buffer
+# (packed, native byte order). TIME like types are (tv_sec, tv_nsec) pairs.
+_c_long_code = "q" if sizeof(c_long) == 8 else "i"
+DebugTypesStructCode = {
+    "BOOL":       "B",
+    "STEP":       "B",
+    "TRANSITION": "B",
+    "ACTION":     "B",
+    "SINT":       "b",
+    "USINT":      "B",
+    "BYTE":       "B",
+    "INT":        "h",
+    "UINT":       "H",
+    "WORD":       "H",
+    "DINT":       "i",
+    "UDINT":      "I",
+    "DWORD":      "I",
+    "LINT":       "q",
+    "ULINT":      "Q",
+    "LWORD":      "Q",
+    "REAL":       "f",
+    "LREAL":      "d",
+    "TIME":       _c_long_code * 2,
+    "TOD":        _c_long_code * 2,
+    "DATE":       _c_long_code * 2,
+    "DT":         _c_long_code * 2,
+    }
+
+
+# samples encoded as delta between two keyframes, at most
+TRACE_KEYFRAME_INTERVAL = 100
+
+# kind of samples encoded by DebugTraceLayout.PackDelta
+TRACE_KEYFRAME = b"\0"
+TRACE_DELTA = b"\1"
+
+
+class DebugTraceLayout(object):
+    """
+    Precompiled layout of debug buffer for a given list of traced IEC types.
+    Build it once when trace list changes, then decode whole batches
+    of samples at once with struct instead of walking ctypes pointers.
+    Falls back to UnpackDebugBuffer when record size isn't fixed (STRING).
+    """
+
+    def __init__(self, iectypes):
+        self.IECTypes = list(iectypes)
+        self.Struct = None
+        self._converters = []
+        self._identity = True
+        # (offset, size, struct code if REAL/LREAL) of each variable
+        self._fields = []
+        # change only encoding state, last sample known by both ends
+        self.DeltaBase = None
+        self.DeltaCount = 0
+        # variable position -> deadband
+        self.Deadbands = {}
+        # numpy arrays used to encode changes of whole samples at once
+        self._offsets = None
+        self._sizes = None
+        # (positions, offsets, deadbands, dtype) of REAL or LREAL
+        # variables given a deadband
+        self._deadbandFields = []
+        if not self.IECTypes:
+            return
+        codes = []
+        pos = 0
+        # no padding in "=" layouts, variables follow each other
+        offset = 0
+        for iectype in self.IECTypes:
+            code = DebugTypesStructCode.get(iectype)
+            if code is None:
+                # STRING or unsupported type, record size isn't fixed
+                return
+            codes.append(code)
+            size = struct.calcsize("=" + code)
+            self._fields.append((offset, size,
+                                 "=" + code if iectype in ("REAL", "LREAL") else None))
+            offset += size
+            if iectype == "BOOL":
+                self._converters.append((pos, lambda raw, p: raw[p] != 0))
+                self._identity = False
+            elif len(code) == 2:
+                self._converters.append(
+                    (pos, lambda raw, p: td(0, raw[p], raw[p + 1]/1000.0)))
+                self._identity = False
+            else:
+                self._converters.append((pos, None))
+            pos += len(code)
+        self.Struct = struct.Struct("=" + "".join(codes))
+        if numpy is not None:
+            self._offsets = numpy.array([offset for offset, _size, _code in self._fields])
+            self._sizes = numpy.array([size for _offset, size, _code in self._fields])
+
+    def IsFixedSize(self):
+        return self.Struct is not None
+
+    def _Convert(self, raw):
+        if self._identity:
+            return list(raw)
+        return [raw[p] if conv is None else conv(raw, p)
+                for p, conv in self._converters]
+
+    def Unpack(self, buff):
+        """
+        Same result as UnpackDebugBuffer(buff, self.IECTypes)
+        """
+        if self.Struct is None:
+            return UnpackDebugBuffer(buff, self.IECTypes)
+        if len(buff) != self.Struct.size:
+            return None
+        return self._Convert(self.Struct.unpack(buff))
+
+    def UnpackBatch(self, traces):
+        """
+        Decode a list of (tick, buff) samples
+        Returns a list of (tick, values), values being None
+        for each sample that doesn't match layout
+        """
+        if self.Struct is None:
+            return [(tick, UnpackDebugBuffer(buff, self.IECTypes))
+                    for tick, buff in traces]
+        size = self.Struct.size
+        if all(len(buff) == size for _tick, buff in traces):
+            samples = self.Struct.iter_unpack(b"".join(
+                [buff for _tick, buff in traces]))
+            return [(tick, self._Convert(raw))
+                    for (tick, _buff), raw in zip(traces, samples)]
+        return [(tick, self.Unpack(buff)) for tick, buff in traces]
+
+    def UnpackPacked(self, packed):
+        """
+        Same as UnpackBatch, for traces packed with PackTraces.
+        Samples are decoded in place when they all match layout.
+        """
+        ticks, sizes, data = _UnpackTracesHeader(packed)
+        if self.Struct is not None and \
+           len(data) == len(ticks) * self.Struct.size and \
+           all(size == self.Struct.size for size in sizes):
+            return [(tick, self._Convert(raw))
+                    for tick, raw in zip(ticks, self.Struct.iter_unpack(data))]
+        return self.UnpackBatch(UnpackTraces(packed))
+
+    def _SetDeadbands(self, deadbands):
+        self.Deadbands = dict(deadbands)
+        self._deadbandFields = []
+        if self._offsets is None:
+            return
+        for code, dtype in (("=f", numpy.float32), ("=d", numpy.float64)):
+            positions = sorted([position for position in self.Deadbands
+                                if position < len(self._fields) and
+                                self._fields[position][2] == code])
+            if positions:
+                positions = numpy.array(positions)
+                self._deadbandFields.append((
+                    positions,
+                    self._offsets[positions, None] + numpy.arange(numpy.dtype(dtype).itemsize),
+                    numpy.array([self.Deadbands[position] for position in positions]),
+                    dtype))
+
+    def _DeltaFields(self, buff, base):
+        """
+        Compare sample with base variable by variable
+        Returns (bitmap of changed variables, their values, new base)
+        """
+        bitmap = bytearray((len(self._fields) + 7) // 8)
+        changed = []
+        new_base = bytearray(base)
+        for position, (offset, size, code) in enumerate(self._fields):
+            value = buff[offset:offset + size]
+            if value == base[offset:offset + size]:
+                continue
+            deadband = self.Deadbands.get(position)
+            if deadband is not None and code is not None and \
+               abs(struct.unpack_from(code, buff, offset)[0] -
+                   struct.unpack_from(code, base, offset)[0]) <= deadband:
+                continue
+            bitmap[position >> 3] |= 1 << (position & 7)
+            new_base[offset:offset + size] = value
+            changed.append(value)
+        return bytes(bitmap), b"".join(changed), new_base
+
+    def _DeltaArrays(self, buff, base):
+        """
+        Same as _DeltaFields, comparing whole sample at once with numpy.
+        Deadbands are only checked on REAL and LREAL variables whose
+        bytes changed.
+        """
+        sample = numpy.frombuffer(buff, numpy.uint8)
+        new_base = bytearray(base)
+        previous = numpy.frombuffer(new_base, numpy.uint8)
+        # variables are contiguous, reduce changed bytes of each one
+        changed = numpy.logical_or.reduceat(sample != previous, self._offsets)
+        for positions, offsets, deadbands, dtype in self._deadbandFields:
+            moved = changed[positions]
+            if not moved.any():
+                continue
+            positions, offsets, deadbands = \
+                positions[moved], offsets[moved], deadbands[moved]
+            values = sample[offsets].view(dtype)[:, 0].astype(numpy.float64)
+            old_values = previous[offsets].view(dtype)[:, 0].astype(numpy.float64)
+            changed[positions[numpy.abs(values - old_values) <= deadbands]] = False
+        bytes_changed = numpy.repeat(changed, self._sizes)
+        values = sample[bytes_changed]
+        previous[bytes_changed] = values
+        return (numpy.packbits(changed, bitorder="little").tobytes(),
+                values.tobytes(), new_base)
+
+    def _EncodeDelta(self, buff, keyframe):
+        base = self.DeltaBase
+        if self.Struct is None or len(buff) != self.Struct.size:
+            self.DeltaBase = None
+            return TRACE_KEYFRAME + buff
+        if not keyframe and base is not None and \
+           self.DeltaCount < TRACE_KEYFRAME_INTERVAL:
+            if self._offsets is None:
+                bitmap, changed, new_base = self._DeltaFields(buff, base)
+            else:
+                bitmap, changed, new_base = self._DeltaArrays(buff, base)
+            delta = TRACE_DELTA + bitmap + changed
+            # when most variables changed, keyframe is cheaper
+            if len(delta) <= len(buff):
+                self.DeltaBase = new_base
+                self.DeltaCount += 1
+                return delta
+        self.DeltaBase = bytearray(buff)
+        self.DeltaCount = 0
+        return TRACE_KEYFRAME + buff
+
+    def PackDelta(self, traces, keyframe=False, deadbands=None, dropped=0):
+        """
+        Same as PackTraces, but samples only carry variables that changed
+        since last packed samples : a bitmap of changed variables then
+        their values. REAL and LREAL variables given a deadband are only
+        considered changed when they moved further than deadband.
+        Whole samples (keyframes) are sent first, when asked, every
+        TRACE_KEYFRAME_INTERVAL samples, and when delta is larger.
+        @param traces: list of (tick, buff) samples
+        @param keyframe: force first sample to be a keyframe
+        @param deadbands: dict of variable position -> deadband, kept
+        for next calls
+        @param dropped: same as PackTraces
+        """
+        if deadbands is not None:
+            self._SetDeadbands(deadbands)
+        encoded = []
+        for tick, buff in traces:
+            encoded.append((tick, self._EncodeDelta(buff, keyframe)))
+            keyframe = False
+        return PackTraces(encoded, dropped)
+
+    def _DecodeDelta(self, buff):
+        base = self.DeltaBase
+        pos = 1 + (len(self._fields) + 7) // 8
+        bitmap = buff[1:pos]
+        for position, (offset, size, _code) in enumerate(self._fields):
+            if bitmap[position >> 3] & (1 << (position & 7)):
+                base[offset:offset + size] = buff[pos:pos + size]
+                pos += size
+        if pos != len(buff):
+            # inconsistent delta, wait for next keyframe
+            self.DeltaBase = None
+            return None
+        return self._Convert(self.Struct.unpack(base))
+
+    def UnpackDelta(self, packed):
+        """
+        Reverse of PackDelta, returns a list of (tick, values), values
+        being None for samples that can't be decoded until next keyframe.
+        DeltaBase is None when a keyframe is needed.
+        """
+        samples = []
+        for tick, buff in UnpackTraces(packed):
+            values = None
+            kind = buff[:1]
+            if kind == TRACE_KEYFRAME:
+                sample = buff[1:]
+                if self.Struct is not None and len(sample) == self.Struct.size:
+                    self.DeltaBase = bytearray(sample)
+                values = self.Unpack(sample)
+            elif kind == TRACE_DELTA and self.DeltaBase is not None and \
+                    len(buff) > (len(self._fields) + 7) // 8:
+                values = self._DecodeDelta(buff)
+            samples.append((tick, values))
+        return samples
+
+
 if __name__ == "__main__":
+    import random
+    import timeit
+
     UnpackDebugBuffer(b'0000', ['BOOL'])
+
+    # microbenchmark : compare layout based batch decoding
+    # with per sample ctypes walk, on a typical watch list
+    types = [random.choice(["BOOL", "INT", "DINT", "REAL", "LREAL", "TIME"])
+             for _i in range(300)]
+    sample = b"".join(
+        [struct.pack("=" + DebugTypesStructCode[t],
+                     *([1] * len(DebugTypesStructCode[t])))
+         for t in types])
+    traces = [(tick, sample) for tick in range(100)]
+    layout = DebugTraceLayout(types)
+    assert [v for _t, v in layout.UnpackBatch(traces)] == \
+        [UnpackDebugBuffer(b, types) for _t, b in traces]
+
+    packed = PackTraces(traces, 3)
+    assert UnpackTraces(packed) == traces
+    assert TracesDropCount(packed) == 3
+    assert layout.UnpackPacked(packed) == layout.UnpackBatch(traces)
+
+    n = 10
+    t_old = timeit.timeit(
+        lambda: [UnpackDebugBuffer(b, types) for _t, b in traces], number=n)
+    t_new = timeit.timeit(lambda: layout.UnpackBatch(traces), number=n)
+    print("UnpackDebugBuffer : %.2f ms/batch" % (t_old * 1000 / n))
+    t_packed = timeit.timeit(lambda: layout.UnpackPacked(packed), number=n)
+    print("DebugTraceLayout  : %.2f ms/batch" % (t_new * 1000 / n))
+    print("Packed traces     : %.2f ms/batch" % (t_packed * 1000 / n))
+
+    # change only encoding : 1000 variables of which 2% change per
+    # sample, REAL ones jittering under deadband half of the time
+    types = [random.choice(["BOOL", "INT", "DINT", "REAL", "LREAL"])
+             for _i in range(1000)]
+    values = [0] * len(types)
+    traces = []
+    for tick in range(1000):
+        for position in random.sample(range(len(types)), 20):
+            values[position] += 1
+        sample = b"".join(
+            [struct.pack("=" + DebugTypesStructCode[t],
+                         (v % 2 if t == "BOOL" else
+                          v + random.random() * 0.001 if t in ("REAL", "LREAL") else v))
+             for t, v in zip(types, values)])
+        traces.append((tick, sample))
+    deadbands = dict((position, 0.01) for position, t in enumerate(types)
+                     if t in ("REAL", "LREAL"))
+    layout = DebugTraceLayout(types)
+    decoder = DebugTraceLayout(types)
+    packed = layout.PackDelta(traces, True)
+    assert decoder.UnpackDelta(packed) == decoder.UnpackBatch(traces)
+    layout = DebugTraceLayout(types)
+    decoder = DebugTraceLayout(types)
+    delta_packed = layout.PackDelta(traces, True, deadbands)
+    for (_tick, decoded), (_tick, sample) in zip(decoder.UnpackDelta(delta_packed),
+                                                 decoder.UnpackBatch(traces)):
+        assert all(abs(a - b) <= deadbands.get(position, 0)
+                   for position, (a, b) in enumerate(zip(decoded, sample)))
+    if numpy is not None:
+        # same encoding without numpy
+        fields_layout = DebugTraceLayout(types)
+        fields_layout._offsets = None
+        assert fields_layout.PackDelta(traces, True, deadbands) == delta_packed
+        t_fields = timeit.timeit(lambda: fields_layout.PackDelta(traces[:100], True, deadbands), number=n)
+    print("Full traces       : %d bytes" % len(PackTraces(traces)))
+    print("Delta traces      : %d bytes" % len(packed))
+    print("Deadband traces   : %d bytes" % len(delta_packed))
+    # layout is built once per trace list, keyframe forces same encoding each time
+    layout = DebugTraceLayout(types)
+    t_pack = timeit.timeit(lambda: layout.PackDelta(traces[:100], True, deadbands), number=n)
+    t_unpack = timeit.timeit(lambda: DebugTraceLayout(types).UnpackDelta(delta_packed), number=n)
+    if numpy is not None:
+        print("PackDelta, loop   : %.2f ms/100 samples" % (t_fields * 1000 / n))
+    print("PackDelta         : %.2f ms/100 samples" % (t_pack * 1000 / n))
+    print("UnpackDelta       : %.2f ms/1000 samples" % (t_unpack * 1000 / n))
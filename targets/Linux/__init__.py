@@ -28,8 +28,99 @@ class Linux_target(toolchain_gcc):
     dlopen_prefix = "./"
     extension = ".so"
 
+    def getSchedulerCFLAGS(self):
+        """ Get PLC thread scheduling from target parameters """
+        target = self.CTRInstance.GetTarget().getcontent()
+        if target.getScheduler() != "Nanosleep":
+            return []
+        return ["-DPLC_SCHED_NANOSLEEP",
+                "-DPLC_SCHED_PRIORITY=%d" % target.getPriority(),
+                "-DPLC_SCHED_CPU=%d" % target.getCPU()]
+
+    def getResourcesCFLAGS(self):
+        """
+        Get resources threads from target parameters. Resources_CPUs
+        gives CPU of resources as "resource1=1, resource2=2", resources
+        not given run on any CPU.
+        Resources don't get their own period : all of them run at each
+        common tick, and outputs are published when the last one ended,
+        so a heavy resource still delays outputs of a fast one.
+        """
+        target = self.CTRInstance.GetTarget().getcontent()
+        if not target.getMulticore_Resources():
+            return []
+        project = self.CTRInstance.Project
+        self.CheckResourcesSharedGlobals(project)
+        resources = [resource.getname().upper()
+                     for config in project.getconfigurations()
+                     for resource in config.getresource()]
+        cflags = ["-DPLC_MULTICORE_RESOURCES"]
+        for resource_cpu in target.getResources_CPUs().split(","):
+            if resource_cpu.strip():
+                try:
+                    resource, cpu = resource_cpu.split("=")
+                    cpu = int(cpu)
+                except ValueError:
+                    raise ValueError(
+                        _("Invalid resource CPU \"%s\" in Resources_CPUs\n") % resource_cpu.strip())
+                resource = resource.strip().upper()
+                if resource not in resources:
+                    raise ValueError(
+                        _("Unknown resource \"%s\" in Resources_CPUs\n") % resource_cpu.split("=")[0].strip())
+                cflags.append("-D%s_CPU=%d" % (resource, cpu))
+        return cflags
+
+    def _GetExternals(self, pous, pou_name, externals, visited):
+        """
+        Collect upper case names of external variables of a POU, and of
+        function blocks instances it declares, recursively
+        """
+        if pou_name in visited:
+            return
+        visited.add(pou_name)
+        pou = pous.get(pou_name)
+        if pou is None or pou.interface is None:
+            return
+        for varlist in pou.interface.getcontent():
+            for var in varlist.getvariable():
+                if varlist.getLocalTag() == "externalVars":
+                    externals.add(var.getname().upper())
+                vartype_content = var.gettype().getcontent()
+                if vartype_content.getLocalTag() == "derived":
+                    self._GetExternals(pous, vartype_content.getname(), externals, visited)
+
+    def CheckResourcesSharedGlobals(self, project):
+        """
+        Warn about configuration global variables used by programs of more
+        than one resource, as resources run in parallel and accesses to
+        these variables aren't synchronized
+        """
+        pous = dict([(pou.getname(), pou) for pou in project.getpous()])
+        for config in project.getconfigurations():
+            config_globals = set([var.getname().upper()
+                                  for varlist in config.getglobalVars()
+                                  for var in varlist.getvariable()])
+            users = {}
+            for resource in config.getresource():
+                externals = set()
+                visited = set()
+                instances = resource.getpouInstance() + \
+                    [instance for task in resource.gettask()
+                     for instance in task.getpouInstance()]
+                for instance in instances:
+                    self._GetExternals(pous, instance.gettypeName(), externals, visited)
+                for name in externals & config_globals:
+                    users.setdefault(name, []).append(resource.getname())
+            for name, resources in sorted(users.items()):
+                if len(resources) > 1:
+                    self.CTRInstance.logger.write_warning(
+                        _("Global variable \"{a1}\" of configuration \"{a2}\" is used by resources {a3}, "
+                          "that run in parallel without synchronization\n").format(
+                              a1=name, a2=config.getname(), a3=", ".join(resources)))
+
     def getBuilderCFLAGS(self):
-        return toolchain_gcc.getBuilderCFLAGS(self) + ["-fPIC"]
+        return toolchain_gcc.getBuilderCFLAGS(self) + self.getSchedulerCFLAGS() + \
+            self.getResourcesCFLAGS() + ["-fPIC"]
 
     def getBuilderLDFLAGS(self):
         return toolchain_gcc.getBuilderLDFLAGS(self) + ["-shared", "-lrt"]
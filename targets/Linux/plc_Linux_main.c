@@ -10,9 +10,126 @@
 #include <pthread.h>
 #include <locale.h>
 #include <semaphore.h>
+#include <sched.h>
+#include <errno.h>
+#include <stdint.h>
 
 static sem_t Run_PLC;
 
+/*
+ * PLC cycles statistics, read by runtime with GetSchedStats.
+ * Bin n of histograms counts durations in [2^(n-1), 2^n[ microseconds
+ **/
+#define SCHED_HIST_BINS 32
+typedef struct {
+    uint32_t cycles;
+    uint32_t overruns; /* cycles ended after next tick */
+    uint64_t exec_max; /* ns */
+    uint64_t jitter_max; /* ns, cycle start delay from its tick */
+    uint32_t exec_hist[SCHED_HIST_BINS];
+    uint32_t jitter_hist[SCHED_HIST_BINS];
+} sched_stats_t;
+
+static sched_stats_t sched_stats;
+/* odd while PLC thread updates sched_stats */
+static volatile unsigned long sched_stats_seq = 0;
+
+/* Next tick and period on CLOCK_MONOTONIC, as given to PLC_SetTimer */
+static pthread_mutex_t sched_mutex = PTHREAD_MUTEX_INITIALIZER;
+static struct timespec sched_next;
+static unsigned long long sched_period = 0;
+static int sched_reset = 0;
+
+static long long timespec_diff(const struct timespec *a, const struct timespec *b)
+{
+    return (long long)(a->tv_sec - b->tv_sec) * 1000000000LL + (a->tv_nsec - b->tv_nsec);
+}
+
+static void timespec_add(struct timespec *t, unsigned long long ns)
+{
+    t->tv_sec += ns / 1000000000;
+    t->tv_nsec += ns % 1000000000;
+    if (t->tv_nsec >= 1000000000) {
+        t->tv_nsec -= 1000000000;
+        t->tv_sec++;
+    }
+}
+
+static unsigned sched_hist_bin(long long ns)
+{
+    unsigned long long us = ns > 0 ? ns / 1000 : 0;
+    unsigned bin = 0;
+    while (us && bin < SCHED_HIST_BINS - 1) {
+        us >>= 1;
+        bin++;
+    }
+    return bin;
+}
+
+/* Get tick of coming cycle and period, following PLC_SetTimer calls */
+static unsigned long long sched_get_tick(struct timespec *tick)
+{
+    unsigned long long period;
+    pthread_mutex_lock(&sched_mutex);
+    if (sched_reset) {
+        *tick = sched_next;
+        sched_reset = 0;
+    }
+    period = sched_period;
+    pthread_mutex_unlock(&sched_mutex);
+    return period;
+}
+
+/* Account cycle, and move tick to next one not missed yet */
+static void sched_cycle_done(struct timespec *tick, unsigned long long period,
+                             const struct timespec *start, const struct timespec *end)
+{
+    long long exec = timespec_diff(end, start);
+    long long jitter = timespec_diff(start, tick);
+    uint32_t overrun = 0;
+
+    if (period) {
+        timespec_add(tick, period);
+        overrun = timespec_diff(end, tick) > 0;
+        /* skip ticks missed by overrun */
+        while (timespec_diff(end, tick) > 0)
+            timespec_add(tick, period);
+    }
+
+    sched_stats_seq++;
+    __sync_synchronize();
+    sched_stats.cycles++;
+    sched_stats.overruns += overrun;
+    if (exec > 0 && (uint64_t)exec > sched_stats.exec_max)
+        sched_stats.exec_max = exec;
+    if (jitter > 0 && (uint64_t)jitter > sched_stats.jitter_max)
+        sched_stats.jitter_max = jitter;
+    sched_stats.exec_hist[sched_hist_bin(exec)]++;
+    sched_stats.jitter_hist[sched_hist_bin(jitter)]++;
+    __sync_synchronize();
+    sched_stats_seq++;
+}
+
+extern "C" {
+int GetSchedStats(sched_stats_t *stats)
+{
+    unsigned long seq;
+    do {
+        seq = sched_stats_seq;
+        __sync_synchronize();
+        memcpy(stats, &sched_stats, sizeof(sched_stats_t));
+        __sync_synchronize();
+    } while ((seq & 1) || seq != sched_stats_seq);
+    return SCHED_HIST_BINS;
+}
+
+void ResetSchedStats(void)
+{
+    /* only called while PLC is stopped */
+    memset(&sched_stats, 0, sizeof(sched_stats_t));
+}
+}
+
 long AtomicCompareExchange(long* atomicvar,long compared, long exchange)
 {
     return __sync_val_compare_and_swap(atomicvar, compared, exchange);
@@ -40,6 +157,19 @@ timer_t PLC_timer;
 
 void PLC_SetTimer(unsigned long long next, unsigned long long period)
 {
+    int armed;
+    pthread_mutex_lock(&sched_mutex);
+    armed = !sched_period && period;
+    clock_gettime(CLOCK_MONOTONIC, &sched_next);
+    timespec_add(&sched_next, next);
+    sched_period = period;
+    sched_reset = 1;
+    pthread_mutex_unlock(&sched_mutex);
+#ifdef PLC_SCHED_NANOSLEEP
+    /* PLC thread waits for timer to be armed */
+    if (armed)
+        sem_post(&Run_PLC);
+#else
     struct itimerspec timerValues;
 	/*
 	printf("SetTimer(%lld,%lld)\n",next, period);
@@ -61,6 +191,7 @@ void PLC_SetTimer(unsigned long long next, unsigned long long period)
 #endif
 	}
     timer_settime (PLC_timer, 0, &timerValues, NULL);
+#endif
 }
 //
 void catch_signal(int sig)
@@ -86,14 +217,159 @@ int ForceSaveRetainReq(void) {
     return PLC_shutdown;
 }
 
+#ifdef PLC_SCHED_NANOSLEEP
+/* PLC thread sleeps until each tick, rather than being woken by a
+ * timer notification thread */
 void PLC_thread_proc(void *arg)
 {
+    struct timespec tick, start, end;
+    unsigned long long period;
+    int reset;
+
+    while (!PLC_shutdown) {
+        period = sched_get_tick(&tick);
+        if (!period) {
+            /* timer not armed */
+            sem_wait(&Run_PLC);
+            continue;
+        }
+        while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &tick, NULL) == EINTR);
+        if (PLC_shutdown)
+            break;
+        pthread_mutex_lock(&sched_mutex);
+        reset = sched_reset;
+        pthread_mutex_unlock(&sched_mutex);
+        if (reset)
+            /* tick moved by align_tick meanwhile, sleep until new one */
+            continue;
+        clock_gettime(CLOCK_MONOTONIC, &start);
+        PLC_GetTime(&__CURRENT_TIME);
+        __run();
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        sched_cycle_done(&tick, period, &start, &end);
+    }
+    pthread_exit(0);
+}
+#else
+void PLC_thread_proc(void *arg)
+{
+    struct timespec tick, start, end;
+    unsigned long long period;
+
     while (!PLC_shutdown) {
         sem_wait(&Run_PLC);
+        clock_gettime(CLOCK_MONOTONIC, &start);
         __run();
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        period = sched_get_tick(&tick);
+        sched_cycle_done(&tick, period, &start, &end);
     }
     pthread_exit(0);
 }
+#endif
+
+/* Set real-time priority of PLC threads, if any */
+static void PLC_thread_attr(pthread_attr_t *attr)
+{
+    pthread_attr_init(attr);
+#if defined(PLC_SCHED_PRIORITY) && PLC_SCHED_PRIORITY > 0
+    struct sched_param param;
+    param.sched_priority = PLC_SCHED_PRIORITY;
+    pthread_attr_setinheritsched(attr, PTHREAD_EXPLICIT_SCHED);
+    pthread_attr_setschedpolicy(attr, SCHED_FIFO);
+    pthread_attr_setschedparam(attr, &param);
+#endif
+}
+
+static void PLC_thread_affinity(pthread_t thread, int cpu)
+{
+    if (cpu >= 0) {
+        cpu_set_t cpuset;
+        CPU_ZERO(&cpuset);
+        CPU_SET(cpu, &cpuset);
+        pthread_setaffinity_np(thread, sizeof(cpu_set_t), &cpuset);
+    }
+}
+
+#ifdef PLC_MULTICORE_RESOURCES
+/* Resources threads, started by PLC thread on each tick */
+static pthread_t resources_threads[PLC_RESOURCES_COUNT];
+static sem_t resources_start[PLC_RESOURCES_COUNT];
+static sem_t resources_done;
+static unsigned long resources_tick;
+static int resources_shutdown;
+
+static void *resource_thread_proc(void *arg)
+{
+    long index = (long)arg;
+    while (1) {
+        sem_wait(&resources_start[index]);
+        if (resources_shutdown)
+            break;
+        __resources_run[index](resources_tick);
+        sem_post(&resources_done);
+    }
+    return NULL;
+}
+
+void __run_resources(unsigned long tick)
+{
+    int index;
+    resources_tick = tick;
+    for (index = 0; index < PLC_RESOURCES_COUNT; index++)
+        sem_post(&resources_start[index]);
+    /* barrier : all resources ended before outputs are published,
+     * publish calls of extensions aren't split by resource, hence
+     * slowest resource sets when outputs of all resources go out */
+    for (index = 0; index < PLC_RESOURCES_COUNT; index++)
+        sem_wait(&resources_done);
+}
+
+static void resources_threads_create(void)
+{
+    pthread_attr_t attr;
+    long index;
+    resources_shutdown = 0;
+    sem_init(&resources_done, 0, 0);
+    PLC_thread_attr(&attr);
+    for (index = 0; index < PLC_RESOURCES_COUNT; index++) {
+        sem_init(&resources_start[index], 0, 0);
+        if (pthread_create(&resources_threads[index], &attr, resource_thread_proc, (void *)index) != 0)
+            pthread_create(&resources_threads[index], NULL, resource_thread_proc, (void *)index);
+        PLC_thread_affinity(resources_threads[index], __resources_cpu[index]);
+    }
+    pthread_attr_destroy(&attr);
+}
+
+static void resources_threads_join(void)
+{
+    int index;
+    resources_shutdown = 1;
+    for (index = 0; index < PLC_RESOURCES_COUNT; index++) {
+        sem_post(&resources_start[index]);
+        pthread_join(resources_threads[index], NULL);
+        sem_destroy(&resources_start[index]);
+    }
+    sem_destroy(&resources_done);
+}
+#endif
+
+static void PLC_thread_create(void)
+{
+#ifdef PLC_SCHED_NANOSLEEP
+    pthread_attr_t attr;
+    PLC_thread_attr(&attr);
+    if (pthread_create(&PLC_thread, &attr, (void*) &PLC_thread_proc, NULL) != 0) {
+        /* not allowed to use real-time scheduling */
+        printf("PLC thread : SCHED_FIFO priority not granted, using default scheduling\n");
+        pthread_create(&PLC_thread, NULL, (void*) &PLC_thread_proc, NULL);
+    }
+    pthread_attr_destroy(&attr);
+    PLC_thread_affinity(PLC_thread, PLC_SCHED_CPU);
+#else
+    pthread_create(&PLC_thread, NULL, (void*) &PLC_thread_proc, NULL);
+#endif
+}
 
 #define maxval(a,b) ((a>b)?a:b)
 int startPLC(int argc,char **argv)
@@ -104,8 +380,13 @@ int startPLC(int argc,char **argv)
     PLC_shutdown = 0;
 
     sem_init(&Run_PLC, 0, 0);
+    sched_period = 0;
+    sched_reset = 0;
 
-    pthread_create(&PLC_thread, NULL, (void*) &PLC_thread_proc, NULL);
+#ifdef PLC_MULTICORE_RESOURCES
+    resources_threads_create();
+#endif
+    PLC_thread_create();
 
     memset (&sigev, 0, sizeof (struct sigevent));
     sigev.sigev_value.sival_int = 0;
@@ -121,7 +402,9 @@ int startPLC(int argc,char **argv)
     pthread_mutex_lock(&debug_wait_mutex);
     pthread_mutex_lock(&python_wait_mutex);
 
+#ifndef PLC_SCHED_NANOSLEEP
     timer_create (CLOCK_MONOTONIC, &sigev, &PLC_timer);
+#endif
     if(  __init(argc,argv) == 0 ){
         PLC_SetTimer(common_ticktime__,common_ticktime__);
 
@@ -158,7 +441,12 @@ int stopPLC()
     PLC_SetTimer(0,0);
 	pthread_join(PLC_thread, NULL);
 	sem_destroy(&Run_PLC);
+#ifdef PLC_MULTICORE_RESOURCES
+    resources_threads_join();
+#endif
+#ifndef PLC_SCHED_NANOSLEEP
     timer_delete (PLC_timer);
+#endif
     __cleanup();
     pthread_mutex_destroy(&debug_wait_mutex);
     pthread_mutex_destroy(&debug_mutex);
@@ -12,16 +12,42 @@
 #ifndef HAVE_RETAIN
 #include <stdio.h>
 #include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <semaphore.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "iec_types.h"
 
 int GetRetainSize(void);
 
-/* Retain buffer.  */
+/* Retain store, mapped in memory. It holds two slots, each one with a
+   whole copy of retain variables. A save goes to the slot not holding
+   latest commit, and is committed by rewriting slot header with a greater
+   sequence number once data pages are synced. Power loss while saving can
+   only corrupt slot being written, previous commit is then used.  */
+const char rs_file[] = "retain_store_file";
+
+/* Retain files of previous versions, only read when store is empty.  */
 FILE *retain_buffer;
 const char rb_file[]      = "retain_buffer_file";
 const char rb_file_bckp[] = "retain_buffer_file.bak";
 
+#define RETAIN_STORE_MAGIC 0x32544552 /* "RET2" */
+
+/* Retain store slot header, followed by hash and one CRC per data page.  */
+struct retain_slot_t {
+	uint32_t magic;
+	/* CRC from seq to last page CRC */
+	uint32_t header_crc;
+	/* commit sequence number */
+	uint32_t seq;
+	uint32_t retain_size;
+	uint32_t hash_size;
+};
 
 /* Retain header struct.  */
 struct retain_info_t {
@@ -29,13 +55,45 @@ struct retain_info_t {
 	uint32_t hash_size;
 	uint8_t* hash;
 	uint32_t header_offset;
-	uint32_t header_crc;
 };
 
 /* Init retain info structure.  */
 struct retain_info_t retain_info;
 
-/* CRC lookup table and initial state.  */
+struct retain_store_t {
+	int fd;
+	/* mapped store file, both slots */
+	uint8_t* map;
+	size_t page_size;
+	/* number of data pages in a slot */
+	uint32_t pages;
+	/* offset of pages CRC in slot */
+	size_t pages_crc_offset;
+	/* size of slot header, page aligned */
+	size_t header_size;
+	size_t slot_size;
+	/* retain variables, as given by PLC at last save */
+	uint8_t* image;
+	/* one flag per page changed since slot was last written */
+	uint8_t* dirty[2];
+	/* pages being written by flush thread */
+	uint8_t* flushing;
+	/* slot holding latest commit, -1 if none */
+	int current;
+	uint32_t seq;
+	/* image and dirty flags lock, only held by flush thread to copy pages */
+	pthread_mutex_t lock;
+	sem_t flush_sem;
+	pthread_t flush_thread;
+	int stop;
+};
+static struct retain_store_t retain_store = {-1, NULL};
+
+/* Set by InValidateRetainBuffer when PLC is saving retain variables.  */
+static int retain_saving = 0;
+static int retain_save_pending = 0;
+
+/* CRC lookup table.  */
 static const uint32_t crc32_table[256] = {
 	0x00000000, 0x77073096, 0xEE0E612C, 0x990951BA, 0x076DC419, 0x706AF48F, 0xE963A535, 0x9E6495A3,
 	0x0EDB8832, 0x79DCB8A4, 0xE0D5E91E, 0x97D2D988, 0x09B64C2B, 0x7EB17CBD, 0xE7B82D07, 0x90BF1D91,
@@ -70,20 +128,48 @@ static const uint32_t crc32_table[256] = {
 	0xBDBDF21C, 0xCABAC28A, 0x53B39330, 0x24B4A3A6, 0xBAD03605, 0xCDD70693, 0x54DE5729, 0x23D967BF,
 	0xB3667A2E, 0xC4614AB8, 0x5D681B02, 0x2A6F2B94, 0xB40BBE37, 0xC30C8EA1, 0x5A05DF1B, 0x2D02EF8D,
 };
-uint32_t retain_crc;
+/* Slicing-by-8 lookup tables, crc32_table is first one.  */
+static uint32_t crc32_tables[8][256];
 
+static void InitCRC32Tables(void)
+{
+	int i, k;
+	for (i = 0; i < 256; i++)
+		crc32_tables[0][i] = crc32_table[i];
+	for (k = 1; k < 8; k++)
+		for (i = 0; i < 256; i++)
+			crc32_tables[k][i] = (crc32_tables[k-1][i] >> 8) ^
+				crc32_table[crc32_tables[k-1][i] & 0xFF];
+}
 
-/* Calculate CRC32 for len bytes from pointer buf with init starting value.  */
+/* Calculate CRC32 for len bytes from pointer buf with init starting value,
+   8 bytes at a time. InitCRC32Tables must have been called.  */
 uint32_t GenerateCRC32Sum(const void* buf, unsigned int len, uint32_t init)
 {
 	uint32_t crc = ~init;
-	unsigned char* current = (unsigned char*) buf;
+	const uint8_t* current = (const uint8_t*) buf;
+	while (len >= 8) {
+		uint32_t one = crc ^ (current[0] | current[1] << 8 |
+			current[2] << 16 | (uint32_t)current[3] << 24);
+		uint32_t two = current[4] | current[5] << 8 |
+			current[6] << 16 | (uint32_t)current[7] << 24;
+		crc = crc32_tables[7][one & 0xFF] ^
+			crc32_tables[6][(one >> 8) & 0xFF] ^
+			crc32_tables[5][(one >> 16) & 0xFF] ^
+			crc32_tables[4][one >> 24] ^
+			crc32_tables[3][two & 0xFF] ^
+			crc32_tables[2][(two >> 8) & 0xFF] ^
+			crc32_tables[1][(two >> 16) & 0xFF] ^
+			crc32_tables[0][two >> 24];
+		current += 8;
+		len -= 8;
+	}
 	while (len--)
-		crc = crc32_table[(crc ^ *current++) & 0xFF] ^ (crc >> 8);
+		crc = crc32_tables[0][(crc ^ *current++) & 0xFF] ^ (crc >> 8);
 	return ~crc;
 }
 
-/* Calc CRC32 for retain file byte by byte.  */
+/* Calc CRC32 for retain file.  */
 int CheckFileCRC(FILE* file_buffer)
 {
 	/* Set the magic constant for one-pass CRC calc according to ZIP CRC32.  */
@@ -91,12 +177,11 @@ int CheckFileCRC(FILE* file_buffer)
 
 	/* CRC initial state.  */
 	uint32_t calc_crc32 = 0;
-	char data_block = 0;
+	char data_block[4096];
+	size_t len;
 
-	while(!feof(file_buffer)){
-		if (fread(&data_block, sizeof(data_block), 1, file_buffer))
-			calc_crc32 = GenerateCRC32Sum(&data_block, sizeof(char), calc_crc32);
-	}
+	while ((len = fread(data_block, 1, sizeof(data_block), file_buffer)) > 0)
+		calc_crc32 = GenerateCRC32Sum(data_block, len, calc_crc32);
 
 	/* Compare crc result with a magic number.  */
 	return (calc_crc32 == magic_number) ? 1 : 0;
@@ -126,10 +211,206 @@ int CheckFilehash(void)
 	return 1;
 }
 
+static struct retain_slot_t* RetainSlot(int slot)
+{
+	return (struct retain_slot_t*)(retain_store.map + slot * retain_store.slot_size);
+}
+
+static uint32_t* RetainSlotPagesCRC(int slot)
+{
+	return (uint32_t*)((uint8_t*)RetainSlot(slot) + retain_store.pages_crc_offset);
+}
+
+static uint8_t* RetainSlotData(int slot)
+{
+	return (uint8_t*)RetainSlot(slot) + retain_store.header_size;
+}
+
+static uint32_t RetainSlotHeaderCRC(int slot)
+{
+	struct retain_slot_t* header = RetainSlot(slot);
+	uint8_t* end = (uint8_t*)(RetainSlotPagesCRC(slot) + retain_store.pages);
+	return GenerateCRC32Sum(&header->seq, end - (uint8_t*)&header->seq, 0);
+}
+
+/* Check slot header, hash and data pages CRC.  */
+static int CheckRetainSlot(int slot)
+{
+	struct retain_slot_t* header = RetainSlot(slot);
+	uint32_t* pages_crc = RetainSlotPagesCRC(slot);
+	uint32_t page;
+
+	if (header->magic != RETAIN_STORE_MAGIC ||
+	    header->retain_size != retain_info.retain_size ||
+	    header->hash_size != retain_info.hash_size ||
+	    memcmp(header + 1, retain_info.hash, retain_info.hash_size) ||
+	    header->header_crc != RetainSlotHeaderCRC(slot))
+		return 0;
+
+	for (page = 0; page < retain_store.pages; page++)
+		if (pages_crc[page] != GenerateCRC32Sum(
+		        RetainSlotData(slot) + page * retain_store.page_size,
+		        retain_store.page_size, 0))
+			return 0;
+
+	return 1;
+}
+
+/* Sync pages flagged in flushing, contiguous pages at once.  */
+static void SyncRetainPages(uint8_t* data)
+{
+	uint32_t page, first;
+	size_t ps = retain_store.page_size;
+
+	for (page = 0; page < retain_store.pages; page++) {
+		if (!retain_store.flushing[page])
+			continue;
+		first = page;
+		while (page < retain_store.pages && retain_store.flushing[page])
+			page++;
+		msync(data + first * ps, (page - first) * ps, MS_SYNC);
+	}
+}
+
+/* Write pages changed since free slot was last written, and commit it.  */
+static void FlushRetainStore(void)
+{
+	int slot = retain_store.current == 0 ? 1 : 0;
+	struct retain_slot_t* header = RetainSlot(slot);
+	uint32_t* pages_crc = RetainSlotPagesCRC(slot);
+	uint8_t* data = RetainSlotData(slot);
+	size_t ps = retain_store.page_size;
+	uint32_t page;
+	int changed = 0;
+
+	/* PLC only waits for changed pages copy */
+	pthread_mutex_lock(&retain_store.lock);
+	for (page = 0; page < retain_store.pages; page++) {
+		retain_store.flushing[page] = retain_store.dirty[slot][page];
+		if (retain_store.flushing[page]) {
+			memcpy(data + page * ps, retain_store.image + page * ps, ps);
+			retain_store.dirty[slot][page] = 0;
+			changed = 1;
+		}
+	}
+	pthread_mutex_unlock(&retain_store.lock);
+
+	if (!changed)
+		return;
+
+	for (page = 0; page < retain_store.pages; page++)
+		if (retain_store.flushing[page])
+			pages_crc[page] = GenerateCRC32Sum(data + page * ps, ps, 0);
+
+	/* Data must reach storage before commit.  */
+	SyncRetainPages(data);
+
+	header->seq = retain_store.seq + 1;
+	header->retain_size = retain_info.retain_size;
+	header->hash_size = retain_info.hash_size;
+	memcpy(header + 1, retain_info.hash, retain_info.hash_size);
+	header->header_crc = RetainSlotHeaderCRC(slot);
+	header->magic = RETAIN_STORE_MAGIC;
+	msync(header, retain_store.header_size, MS_SYNC);
+
+	retain_store.seq++;
+	retain_store.current = slot;
+}
+
+static void* RetainFlushThread(void* arg)
+{
+	while (!retain_store.stop) {
+		sem_wait(&retain_store.flush_sem);
+		FlushRetainStore();
+	}
+	return NULL;
+}
+
+static int OpenRetainStore(void)
+{
+	struct stat st;
+	size_t ps = sysconf(_SC_PAGESIZE);
+	size_t size;
+
+	retain_store.page_size = ps;
+	retain_store.pages = (retain_info.retain_size + ps - 1) / ps;
+	retain_store.pages_crc_offset =
+		(sizeof(struct retain_slot_t) + retain_info.hash_size + 3) & ~3;
+	retain_store.header_size = (retain_store.pages_crc_offset +
+		retain_store.pages * sizeof(uint32_t) + ps - 1) / ps * ps;
+	retain_store.slot_size = retain_store.header_size + retain_store.pages * ps;
+	retain_store.current = -1;
+	retain_store.seq = 0;
+	retain_store.stop = 0;
+	size = 2 * retain_store.slot_size;
+
+	retain_store.fd = open(rs_file, O_RDWR | O_CREAT, 0644);
+	if (retain_store.fd < 0)
+		goto error;
+
+	/* Store with another layout belongs to another PLC program.  */
+	if (fstat(retain_store.fd, &st) ||
+	    (st.st_size != (off_t)size &&
+	     (ftruncate(retain_store.fd, 0) || ftruncate(retain_store.fd, size))))
+		goto error;
+
+	retain_store.map = (uint8_t*)mmap(NULL, size, PROT_READ | PROT_WRITE,
+		MAP_SHARED, retain_store.fd, 0);
+	if (retain_store.map == MAP_FAILED) {
+		retain_store.map = NULL;
+		goto error;
+	}
+
+	retain_store.image = (uint8_t*)calloc(retain_store.pages, ps);
+	retain_store.dirty[0] = (uint8_t*)malloc(retain_store.pages);
+	retain_store.dirty[1] = (uint8_t*)malloc(retain_store.pages);
+	retain_store.flushing = (uint8_t*)malloc(retain_store.pages);
+	/* Nothing known about slots content yet.  */
+	memset(retain_store.dirty[0], 1, retain_store.pages);
+	memset(retain_store.dirty[1], 1, retain_store.pages);
+
+	pthread_mutex_init(&retain_store.lock, NULL);
+	sem_init(&retain_store.flush_sem, 0, 0);
+	pthread_create(&retain_store.flush_thread, NULL, RetainFlushThread, NULL);
+	return 1;
+
+error:
+	fprintf(stderr, "Failed to open retain store : %s\n", rs_file);
+	if (retain_store.fd >= 0)
+		close(retain_store.fd);
+	retain_store.fd = -1;
+	return 0;
+}
+
+static void CloseRetainStore(void)
+{
+	if (!retain_store.map)
+		return;
+
+	/* Stop flush thread, and flush what PLC saved last.  */
+	retain_store.stop = 1;
+	sem_post(&retain_store.flush_sem);
+	pthread_join(retain_store.flush_thread, NULL);
+	FlushRetainStore();
+
+	sem_destroy(&retain_store.flush_sem);
+	pthread_mutex_destroy(&retain_store.lock);
+	munmap(retain_store.map, 2 * retain_store.slot_size);
+	close(retain_store.fd);
+	free(retain_store.image);
+	free(retain_store.dirty[0]);
+	free(retain_store.dirty[1]);
+	free(retain_store.flushing);
+	retain_store.map = NULL;
+	retain_store.fd = -1;
+}
+
 void InitRetain(void)
 {
 	int i;
 
+	InitCRC32Tables();
+
 	/* Get retain size in bytes */
 	retain_info.retain_size = GetRetainSize();
 
@@ -137,7 +418,7 @@ void InitRetain(void)
 	   (that's why we divide strlen in two).  */
 	retain_info.hash_size = PLC_ID ? strlen(PLC_ID)/2 : 0;
 	//retain_info.hash_size = 0;
-	retain_info.hash = malloc(retain_info.hash_size);
+	retain_info.hash = (uint8_t*)malloc(retain_info.hash_size);
 
 	/* Transform hash string into byte sequence.  */
 	for (i = 0; i < retain_info.hash_size; i++) {
@@ -146,33 +427,19 @@ void InitRetain(void)
 		retain_info.hash[i] = byte;
 	}
 
-	/* Calc header offset.  */
+	/* Calc header offset of retain files of previous versions.  */
 	retain_info.header_offset = sizeof(retain_info.retain_size) + \
 		sizeof(retain_info.hash_size) + \
 		retain_info.hash_size;
 
-	/*  Set header CRC initial state.  */
-	retain_info.header_crc = 0;
-
-	/* Calc crc for header.  */
-	retain_info.header_crc = GenerateCRC32Sum(
-		&retain_info.retain_size,
-		sizeof(retain_info.retain_size),
-		retain_info.header_crc);
-
-	retain_info.header_crc = GenerateCRC32Sum(
-		&retain_info.hash_size,
-		sizeof(retain_info.hash_size),
-		retain_info.header_crc);
-
-	retain_info.header_crc = GenerateCRC32Sum(
-		retain_info.hash,
-		retain_info.hash_size,
-		retain_info.header_crc);
+	if (retain_info.retain_size)
+		OpenRetainStore();
 }
 
 void CleanupRetain(void)
 {
+	CloseRetainStore();
+
 	/* Free hash memory.  */
 	free(retain_info.hash);
 }
@@ -193,10 +460,40 @@ int CheckRetainFile(const char * file)
 
 int CheckRetainBuffer(void)
 {
+	int slot, valid = -1, slots_valid[2];
+	uint32_t page;
+	size_t ps = retain_store.page_size;
+
 	retain_buffer = NULL;
 	if (!retain_info.retain_size)
 		return 1;
 
+	if (retain_store.map) {
+		/* Latest valid commit.  */
+		for (slot = 0; slot < 2; slot++) {
+			slots_valid[slot] = CheckRetainSlot(slot);
+			if (slots_valid[slot] && (valid < 0 ||
+			    (int32_t)(RetainSlot(slot)->seq - RetainSlot(valid)->seq) > 0))
+				valid = slot;
+		}
+
+		if (valid >= 0) {
+			retain_store.current = valid;
+			retain_store.seq = RetainSlot(valid)->seq;
+			memcpy(retain_store.image, RetainSlotData(valid),
+				retain_info.retain_size);
+			memset(retain_store.dirty[valid], 0, retain_store.pages);
+			/* Other slot only misses pages of latest commit.  */
+			slot = valid ? 0 : 1;
+			if (slots_valid[slot])
+				for (page = 0; page < retain_store.pages; page++)
+					retain_store.dirty[slot][page] = memcmp(
+						RetainSlotData(slot) + page * ps,
+						retain_store.image + page * ps, ps) != 0;
+			return 1;
+		}
+	}
+
 	/* Check latest retain file.  */
 	if (CheckRetainFile(rb_file))
 		return 1;
@@ -255,71 +552,77 @@ int RetainSaveNeeded(void)
 	return ret;
 }
 
+/* Hand retain variables saved by PLC to flush thread.  */
 void ValidateRetainBuffer(void)
 {
-	if (!retain_buffer)
-		return;
-
-	/* Add retain data CRC to the end of buffer file.  */
-	fseek(retain_buffer, 0, SEEK_END);
-	fwrite(&retain_crc, sizeof(uint32_t), 1, retain_buffer);
+	/* Retain file of previous versions was reminded.  */
+	if (retain_buffer) {
+		fclose(retain_buffer);
+		retain_buffer = NULL;
+	}
 
-	/* Sync file buffer and close file.  */
-#ifdef __WIN32
-	fflush(retain_buffer);
-#else
-	fsync(fileno(retain_buffer));
-#endif
+	if (!retain_saving)
+		return;
 
-	fclose(retain_buffer);
-	retain_buffer = NULL;
+	retain_saving = 0;
+	retain_save_pending = 0;
+	pthread_mutex_unlock(&retain_store.lock);
+	sem_post(&retain_store.flush_sem);
 }
 
 void InValidateRetainBuffer(void)
 {
-	if (!RetainSaveNeeded())
+	if (!retain_store.map)
 		return;
 
-	/* Rename old retain file into *.bak if it exists.  */
-	rename(rb_file, rb_file_bckp);
-
-	/* Set file CRC initial value.  */
-	retain_crc = retain_info.header_crc;
+	if (!retain_save_pending)
+		retain_save_pending = RetainSaveNeeded();
+	if (!retain_save_pending)
+		return;
 
-	/* Create new retain file.  */
-	retain_buffer = fopen(rb_file, "wb+");
-	if (!retain_buffer) {
-		fprintf(stderr, "Failed to create retain file : %s\n", rb_file);
+	/* Flush thread is copying pages, save at next cycle.  */
+	if (pthread_mutex_trylock(&retain_store.lock))
 		return;
-	}
 
-	/* Write header to the new file.  */
-	fwrite(&retain_info.retain_size,
-		sizeof(retain_info.retain_size), 1, retain_buffer);
-	fwrite(&retain_info.hash_size,
-		sizeof(retain_info.hash_size),   1, retain_buffer);
-	fwrite(retain_info.hash ,
-		sizeof(char), retain_info.hash_size, retain_buffer);
+	retain_saving = 1;
 }
 
 void Retain(unsigned int offset, unsigned int count, void *p)
 {
-	if (!retain_buffer)
-		return;
+	size_t ps = retain_store.page_size;
+	uint8_t* data = (uint8_t*)p;
+	unsigned int page, len;
 
-	/* Generate CRC 32 for each data block.  */
-	retain_crc = GenerateCRC32Sum(p, count, retain_crc);
+	if (!retain_saving)
+		return;
 
-	/* Save current var in file.  */
-	fseek(retain_buffer, retain_info.header_offset+offset, SEEK_SET);
-	fwrite(p, count, 1, retain_buffer);
+	/* Only changed bytes make their page dirty.  */
+	while (count) {
+		page = offset / ps;
+		len = (page + 1) * ps - offset;
+		if (len > count)
+			len = count;
+		if (memcmp(retain_store.image + offset, data, len)) {
+			memcpy(retain_store.image + offset, data, len);
+			retain_store.dirty[0][page] = retain_store.dirty[1][page] = 1;
+		}
+		offset += len;
+		data += len;
+		count -= len;
+	}
 }
 
 void Remind(unsigned int offset, unsigned int count, void *p)
 {
     int ret;
-	/* Remind variable from file.  */
-	fseek(retain_buffer, retain_info.header_offset+offset, SEEK_SET);
-	ret = fread((void *)p, count, 1, retain_buffer);
+	/* Remind variable from retain file of previous versions.  */
+	if (retain_buffer) {
+		fseek(retain_buffer, retain_info.header_offset+offset, SEEK_SET);
+		ret = fread((void *)p, count, 1, retain_buffer);
+		return;
+	}
+
+	/* Remind variable from latest commit.  */
+	memcpy(p, retain_store.image + offset, count);
 }
 #endif // !HAVE_RETAIN
@@ -71,19 +71,51 @@ static const uint32_t crc32_table[256] = {
 	0xB3667A2E, 0xC4614AB8, 0x5D681B02, 0x2A6F2B94, 0xB40BBE37, 0xC30C8EA1, 0x5A05DF1B, 0x2D02EF8D,
 };
 uint32_t retain_crc;
+
+/* Slicing-by-8 lookup tables, crc32_table is first one.  */
+static uint32_t crc32_tables[8][256];
+
+static void InitCRC32Tables(void)
+{
+	int i, k;
+	for (i = 0; i < 256; i++)
+		crc32_tables[0][i] = crc32_table[i];
+	for (k = 1; k < 8; k++)
+		for (i = 0; i < 256; i++)
+			crc32_tables[k][i] = (crc32_tables[k-1][i] >> 8) ^
+				crc32_table[crc32_tables[k-1][i] & 0xFF];
+}
+
 extern "C"
 {
-/* Calculate CRC32 for len bytes from pointer buf with init starting value.  */
+/* Calculate CRC32 for len bytes from pointer buf with init starting value,
+   8 bytes at a time. InitCRC32Tables must have been called.  */
 uint32_t GenerateCRC32Sum(const void* buf, unsigned int len, uint32_t init)
 {
 	uint32_t crc = ~init;
-	unsigned char* current = (unsigned char*) buf;
+	const uint8_t* current = (const uint8_t*) buf;
+	while (len >= 8) {
+		uint32_t one = crc ^ (current[0] | current[1] << 8 |
+			current[2] << 16 | (uint32_t)current[3] << 24);
+		uint32_t two = current[4] | current[5] << 8 |
+			current[6] << 16 | (uint32_t)current[7] << 24;
+		crc = crc32_tables[7][one & 0xFF] ^
+			crc32_tables[6][(one >> 8) & 0xFF] ^
+			crc32_tables[5][(one >> 16) & 0xFF] ^
+			crc32_tables[4][one >> 24] ^
+			crc32_tables[3][two & 0xFF] ^
+			crc32_tables[2][(two >> 8) & 0xFF] ^
+			crc32_tables[1][(two >> 16) & 0xFF] ^
+			crc32_tables[0][two >> 24];
+		current += 8;
+		len -= 8;
+	}
 	while (len--)
-		crc = crc32_table[(crc ^ *current++) & 0xFF] ^ (crc >> 8);
+		crc = crc32_tables[0][(crc ^ *current++) & 0xFF] ^ (crc >> 8);
 	return ~crc;
 }
 
-/* Calc CRC32 for retain file byte by byte.  */
+/* Calc CRC32 for retain file.  */
 int CheckFileCRC(FILE* file_buffer)
 {
 	/* Set the magic constant for one-pass CRC calc according to ZIP CRC32.  */
@@ -91,12 +123,11 @@ int CheckFileCRC(FILE* file_buffer)
 
 	/* CRC initial state.  */
 	uint32_t calc_crc32 = 0;
-	char data_block = 0;
+	char data_block[4096];
+	size_t len;
 
-	while(!feof(file_buffer)){
-		if (fread(&data_block, sizeof(data_block), 1, file_buffer))
-			calc_crc32 = GenerateCRC32Sum(&data_block, sizeof(data_block), calc_crc32);
-	}
+	while ((len = fread(data_block, 1, sizeof(data_block), file_buffer)) > 0)
+		calc_crc32 = GenerateCRC32Sum(data_block, len, calc_crc32);
 
 	/* Compare crc result with a magic number.  */
 	return (calc_crc32 == magic_number) ? 1 : 0;
@@ -130,6 +161,8 @@ void InitRetain(void)
 {
 	unsigned int i;
 
+	InitCRC32Tables();
+
 	/* Get retain size in bytes */
 	retain_info.retain_size = GetRetainSize();
 
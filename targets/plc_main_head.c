@@ -60,6 +60,19 @@ void __publish_debug(void);
 
 
 
+#ifdef PLC_MULTICORE_RESOURCES
+/*
+ * Resources of configuration, each run on its own thread by target code,
+ * on CPU given by <RESOURCE>_CPU (-1 for any)
+ **/
+%(resources_prototypes)s
+#define PLC_RESOURCES_COUNT %(resources_count)d
+void (*__resources_run[PLC_RESOURCES_COUNT])(unsigned long tick) = {%(resources_run)s};
+int __resources_cpu[PLC_RESOURCES_COUNT] = {%(resources_cpus)s};
+/* Run all resources for a tick, and wait for them to end */
+void __run_resources(unsigned long tick);
+#endif
+
 /* Help to quit cleanly when init fail at a certain level */
 static int init_level = 0;
 
@@ -78,7 +91,13 @@ void __run(void)
 
     /*__retrieve_debug();*/
 
+#ifdef PLC_MULTICORE_RESOURCES
+    /* inputs are all retrieved before resources run, and outputs
+     * published once all of them ended */
+    __run_resources(__tick);
+#else
     config_run__(__tick);
+#endif
     __publish_debug();
     %(publish_calls)s
 
@@ -27,15 +27,170 @@
 # from __future__ import absolute_import
 
 import hashlib
+import json
 import operator
 import os
 import re
+import shutil
 from functools import reduce
 
+import wx
+
 from util.ProcessLogger import ProcessLogger
 
 includes_re = re.compile(r'\s*#include\s*["<]([^">]*)[">].*')
 
+# number of variants (i.e. different headers content) kept per source
+MANIFEST_ENTRIES = 8
+
+
+class ObjectCache(object):
+    """
+    Persistent store of object files, shared between builds, projects and
+    IDE sessions, working like ccache direct mode.
+    Object is looked up by a key computed from compiler, flags and source,
+    and validated against content of every header compiler reported as a
+    dependency (-MD) when object was built. Least recently used objects
+    are evicted when store exceeds maxsize.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        # content hashes of files, computed once per build
+        self.filehashes = {}
+        for subdir in ["manifests", "objects"]:
+            if not os.path.isdir(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+
+    def _ManifestPath(self, key):
+        return os.path.join(self.path, "manifests", key + ".json")
+
+    def _ObjectPath(self, objkey):
+        return os.path.join(self.path, "objects", objkey + ".o")
+
+    def _FileHash(self, path):
+        filehash = self.filehashes.get(path)
+        if filehash is None:
+            try:
+                with open(path, "rb") as f:
+                    filehash = hashlib.md5(f.read()).hexdigest()
+            except (IOError, OSError):
+                filehash = ""
+            self.filehashes[path] = filehash
+        return filehash
+
+    def _LoadManifest(self, key):
+        try:
+            with open(self._ManifestPath(key), "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+
+    def _ReadDepFile(self, depfilename):
+        """
+        Return list of files in make rule generated by compiler -MD option
+        """
+        try:
+            with open(depfilename, "r") as f:
+                rule = f.read().replace("\\\n", " ").split("\n")[0]
+        except (IOError, OSError):
+            return None
+        # target and dependencies are separated by first colon followed
+        # by a blank, drive letter colon of windows path isn't
+        separator = re.search(r":\s", rule)
+        if separator is None:
+            return None
+        return [dep.replace("\\ ", " ")
+                for dep in re.split(r"(?<!\\)\s+", rule[separator.end():].strip())
+                if dep]
+
+    def Key(self, compiler, flags, srcpath):
+        """
+        Return cache key of source compiled by compiler with given flags
+        @param compiler: compiler identity, path and version
+        """
+        md5 = hashlib.md5()
+        for part in [compiler, flags]:
+            md5.update(part.encode())
+            md5.update(b"\0")
+        with open(srcpath, "rb") as f:
+            md5.update(f.read())
+        return md5.hexdigest()
+
+    def Fetch(self, key, objectfilename):
+        """
+        Copy cached object matching key and current headers to objectfilename
+        Return True on cache hit
+        """
+        for entry in self._LoadManifest(key):
+            if all(self._FileHash(dep) == depHash
+                   for dep, depHash in entry["deps"].items()):
+                objpath = self._ObjectPath(entry["object"])
+                try:
+                    shutil.copyfile(objpath, objectfilename)
+                    # mark object as recently used
+                    os.utime(objpath, None)
+                except (IOError, OSError):
+                    continue
+                return True
+        return False
+
+    def Store(self, key, objectfilename, depfilename):
+        """
+        Keep a copy of freshly compiled object
+        """
+        deps = self._ReadDepFile(depfilename)
+        if deps is None:
+            return
+        hashes = {dep: self._FileHash(dep) for dep in deps}
+        objkey = hashlib.md5(
+            (key + json.dumps(hashes, sort_keys=True)).encode()).hexdigest()
+        # store is shared between IDE instances : files are written aside
+        # and renamed, so that no partially written file is ever visible
+        tmpsuffix = ".%d.tmp" % os.getpid()
+        try:
+            objpath = self._ObjectPath(objkey)
+            shutil.copyfile(objectfilename, objpath + tmpsuffix)
+            os.replace(objpath + tmpsuffix, objpath)
+            manifest = [entry for entry in self._LoadManifest(key)
+                        if entry["object"] != objkey and
+                        os.path.exists(self._ObjectPath(entry["object"]))]
+            manifest.insert(0, {"deps": hashes, "object": objkey})
+            manifestpath = self._ManifestPath(key)
+            with open(manifestpath + tmpsuffix, "w") as f:
+                json.dump(manifest[:MANIFEST_ENTRIES], f)
+            os.replace(manifestpath + tmpsuffix, manifestpath)
+        except (IOError, OSError):
+            pass
+
+    def Trim(self):
+        """
+        Evict least recently used objects until store fits in maxsize
+        """
+        objdir = os.path.join(self.path, "objects")
+        objects = []
+        total = 0
+        for fname in os.listdir(objdir):
+            fpath = os.path.join(objdir, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            objects.append((st.st_mtime, st.st_size, fpath))
+            total += st.st_size
+        if total <= self.maxsize:
+            return
+        objects.sort()
+        # leave some room to avoid trimming again at next build
+        while objects and total > self.maxsize * 0.9:
+            _mtime, size, fpath = objects.pop(0)
+            try:
+                os.remove(fpath)
+            except OSError:
+                continue
+            total -= size
+
 
 class toolchain_gcc(object):
     """
@@ -44,6 +199,9 @@ class toolchain_gcc(object):
     class such as target_linux or target_win32
     """
 
+    # objects of previous build are reused, build dir must not be wiped
+    incremental = True
+
     def __init__(self, CTRInstance):
         self.CTRInstance = CTRInstance
         self.buildpath = None
@@ -68,12 +226,50 @@ class toolchain_gcc(object):
         """
         return self.CTRInstance.GetTarget().getcontent().getCompiler()
 
+    def getCompilerIdentity(self):
+        """
+        Returns compiler path and version, so that objects built by another
+        compiler are never taken from object cache
+        """
+        status, result, _err_result = ProcessLogger(
+            self.CTRInstance.logger,
+            "\"%s\" -dumpfullversion -dumpversion" % self.compiler,
+            no_stdout=True, no_stderr=True).spin()
+        path = shutil.which(self.compiler) or self.compiler
+        return "%s %s" % (os.path.realpath(path),
+                          result.strip() if not status else "")
+
     def getLinker(self):
         """
         Returns linker
         """
         return self.CTRInstance.GetTarget().getcontent().getLinker()
 
+    def getJobs(self):
+        """
+        Returns maximum number of parallel compilations,
+        0 meaning as many as available CPUs
+        """
+        jobs = self.CTRInstance.GetTarget().getcontent().getJobs()
+        if not jobs:
+            jobs = os.cpu_count() or 1
+        return jobs
+
+    def getObjectCache(self):
+        """
+        Returns persistent object cache, None if disabled
+        """
+        size = self.CTRInstance.GetTarget().getcontent().getCacheSize()
+        if not size:
+            return None
+        try:
+            return ObjectCache(
+                os.path.join(os.path.expanduser("~"), ".beremiz", "objcache"),
+                size * 1024 * 1024)
+        except OSError:
+            self.CTRInstance.logger.write_warning(_("Cannot create object cache directory.\n"))
+            return None
+
     def GetBinaryCode(self):
         try:
             return open(self.exe_path, "rb").read()
@@ -106,6 +302,8 @@ class toolchain_gcc(object):
             self.exe_path = os.path.join(self.buildpath, self.exe)
             self.md5key = None
             self.srcmd5 = {}
+            self.unitmd5 = {}
+            self.depcheck = {}
 
     def append_cfile_deps(self, src, deps):
         for l in src.splitlines():
@@ -115,36 +313,62 @@ class toolchain_gcc(object):
                 if os.path.exists(os.path.join(self.buildpath, depfn)):
                     deps.append(depfn)
 
-    def concat_deps(self, bn):
+    def concat_deps(self, bn, visited=None):
+        if visited is None:
+            visited = set()
+        # include cycle, or already concatenated
+        if bn in visited:
+            return ""
+        visited.add(bn)
         # read source
         src = open(os.path.join(self.buildpath, bn), "r").read()
         # update direct dependencies
         deps = []
         self.append_cfile_deps(src, deps)
         # recurse through deps
-        # TODO detect cicular deps.
-        return reduce(operator.concat, list(map(self.concat_deps, deps), src))
+        return reduce(operator.concat, [self.concat_deps(dep, visited) for dep in deps], src)
 
-    def check_and_update_hash_and_deps(self, bn):
+    def get_hash_and_deps(self, bn):
+        """
+        Return hash and direct dependencies of bn, read once per build
+        """
+        checked = self.depcheck.get(bn)
+        if checked is not None:
+            return checked
         # Get latest computed hash and deps
         oldhash, deps = self.srcmd5.get(bn, (None, []))
         # read source
         src = open(os.path.join(self.buildpath, bn)).read()
         # compute new hash
         newhash = hashlib.md5(src.encode()).hexdigest()
-        # compare
-        match = (oldhash == newhash)
-        if not match:
+        if oldhash != newhash:
             # file have changed
             # update direct dependencies
             deps = []
             self.append_cfile_deps(src, deps)
             # store that hashand deps
             self.srcmd5[bn] = (newhash, deps)
-        # recurse through deps
-        # TODO detect cicular deps.
-        # return reduce(operator.and_, list(map(self.check_and_update_hash_and_deps, deps)), match)
-        return match
+        self.depcheck[bn] = (newhash, deps)
+        return newhash, deps
+
+    def check_and_update_hash_and_deps(self, bn):
+        """
+        Return (match, unithash), unithash being hash of bn and all files
+        it includes, directly or not, and match True if they didn't change
+        since bn was last compiled. Hash is kept per compilation unit, and
+        only once it compiled (see compiled()), so that a failed or skipped
+        compilation is retried at next build whatever other units did.
+        """
+        hashes = {}
+        tocheck = [bn]
+        while tocheck:
+            name = tocheck.pop()
+            if name not in hashes:
+                hashes[name], deps = self.get_hash_and_deps(name)
+                tocheck.extend(deps)
+        unithash = hashlib.md5(
+            json.dumps(hashes, sort_keys=True).encode()).hexdigest()
+        return self.unitmd5.get(bn) == unithash, unithash
 
     def calc_source_md5(self):
         wholesrcdata = ""
@@ -158,16 +382,107 @@ class toolchain_gcc(object):
     def calc_md5(self):
         return hashlib.md5(self.GetBinaryCode()).hexdigest()
 
+    def compiled(self, job):
+        """
+        Record hash of successfully compiled unit, and keep object in
+        object cache
+        """
+        bn, _command, objectfilename, cachekey, unithash = job
+        self.unitmd5[bn] = unithash
+        if cachekey is not None:
+            self.objcache.Store(cachekey, objectfilename,
+                                os.path.splitext(objectfilename)[0] + ".d")
+
+    def compile(self, job):
+        bn, command = job[:2]
+        status, _result, _err_result = ProcessLogger(
+            self.CTRInstance.logger, command).spin()
+
+        if status:
+            self.unitmd5.pop(bn, None)
+            self.CTRInstance.logger.write_error(_("C compilation of %s failed.\n") % bn)
+            return False
+        self.compiled(job)
+        return True
+
+    def compile_parallel(self, compilations, jobs):
+        """
+        Run given compilations, up to jobs at once.
+        Output of each compilation is logged in one block once it and all
+        compilations started before it finished, so that lines from
+        different compilers don't interleave and come in submission order.
+        First failure kills running compilations and skips pending ones.
+        """
+        logger = self.CTRInstance.logger
+        pending = list(enumerate(compilations))
+        running = []
+        # submission index -> (job, status, result, err_result) of
+        # finished compilations, None for killed ones
+        finished = {}
+        logged = 0
+        failed = None
+        while running or (pending and failed is None):
+            while pending and failed is None and len(running) < jobs:
+                index, job = pending.pop(0)
+                running.append((index, job, ProcessLogger(logger, job[1],
+                                                          no_stdout=True, no_stderr=True)))
+            for running_job in running[:]:
+                index, job, proc = running_job
+                if proc.poll():
+                    status, result, err_result = proc.result()
+                    finished[index] = (job, status, result, err_result)
+                    if status and failed is None:
+                        failed = job[0]
+                elif failed is not None:
+                    proc.kill()
+                    # wait until killed compilation is reaped
+                    proc.spin()
+                    finished[index] = None
+                else:
+                    continue
+                running.remove(running_job)
+                if finished[index] is not None and not finished[index][1]:
+                    self.compiled(job)
+                else:
+                    # not compiled, force compilation next time
+                    self.unitmd5.pop(job[0], None)
+            while logged in finished:
+                outcome = finished.pop(logged)
+                logged += 1
+                if outcome is None:
+                    continue
+                job, status, result, err_result = outcome
+                if result:
+                    logger.write(result)
+                if err_result:
+                    logger.write_warning(err_result)
+                if status:
+                    logger.write_error(_("C compilation of %s failed.\n") % job[0])
+            if running:
+                eventLoop = wx.GUIEventLoop()
+                eventLoop.Dispatch()
+
+        for _index, job in pending:
+            self.unitmd5.pop(job[0], None)
+
+        return failed is None
+
     def build(self):
         # Retrieve compiler and linker
         self.compiler = self.getCompiler()
         self.linker = self.getLinker()
+        jobs = self.getJobs()
+        self.objcache = self.getObjectCache()
+        self.depcheck = {}
+        if self.objcache is not None:
+            compilerid = self.getCompilerIdentity()
 
         Builder_CFLAGS = ' '.join(self.getBuilderCFLAGS())
 
         # ----------------- GENERATE OBJECT FILES ------------------------
         obns = []
         objs = []
+        compilations = []
         relink = self.GetBinaryCode() is None
         for Location, CFilesAndCFLAGS, _DoCalls in self.CTRInstance.LocationCFilesAndCFLAGS:
             if CFilesAndCFLAGS:
@@ -182,24 +497,34 @@ class toolchain_gcc(object):
                     obn = os.path.splitext(bn)[0] + ".o"
                     objectfilename = os.path.splitext(CFile)[0] + ".o"
 
-                    match = self.check_and_update_hash_and_deps(bn)
+                    match, unithash = self.check_and_update_hash_and_deps(bn)
 
                     if match:
                         self.CTRInstance.logger.write("   [pass]  " + bn + " -> " + obn + "\n")
                     else:
                         relink = True
 
-                        self.CTRInstance.logger.write("   [CC]  " + bn + " -> " + obn + "\n")
-
-                        status, _result, _err_result = ProcessLogger(
-                            self.CTRInstance.logger,
-                            "\"%s\" -c \"%s\" -o \"%s\" -O2 %s %s" %
+                        command = "\"%s\" -c \"%s\" -o \"%s\" -O2 %s %s" % \
                             (self.compiler, CFile, objectfilename, Builder_CFLAGS, CFLAGS)
-                        ).spin()
+                        cachekey = None
+                        if self.objcache is not None:
+                            cachekey = self.objcache.Key(
+                                compilerid, Builder_CFLAGS + " " + CFLAGS, CFile)
+                            if self.objcache.Fetch(cachekey, objectfilename):
+                                self.unitmd5[bn] = unithash
+                                self.CTRInstance.logger.write("   [cache]  " + bn + " -> " + obn + "\n")
+                                obns.append(obn)
+                                objs.append(objectfilename)
+                                continue
+                            # have compiler list headers object depends on
+                            command += " -MD -MF \"%s\"" % (os.path.splitext(CFile)[0] + ".d")
 
-                        if status:
-                            self.srcmd5.pop(bn)
-                            self.CTRInstance.logger.write_error(_("C compilation of %s failed.\n") % bn)
+                        self.CTRInstance.logger.write("   [CC]  " + bn + " -> " + obn + "\n")
+
+                        job = (bn, command, objectfilename, cachekey, unithash)
+                        if jobs > 1:
+                            compilations.append(job)
+                        elif not self.compile(job):
                             return False
                     obns.append(obn)
                     objs.append(objectfilename)
@@ -207,6 +532,12 @@ class toolchain_gcc(object):
                     obns.append(os.path.basename(CFile))
                     objs.append(CFile)
 
+        if compilations and not self.compile_parallel(compilations, jobs):
+            return False
+
+        if self.objcache is not None:
+            self.objcache.Trim()
+
         # ---------------- GENERATE OUTPUT FILE --------------------------
         # Link all the object files into one binary file
         self.CTRInstance.logger.write(_("Linking :\n"))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Beremiz, a Integrated Development Environment for
+# programming IEC 61131-3 automates supporting plcopen standard and CanFestival.
+#
+# See COPYING file for copyrights details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import conftest
+from lxml import etree
+
+from PLCControler import PLCControler
+from plcopen.plcopen import LoadProject, SaveProject, MaterializeLazyBodies, LAZY_BODY_PI
+
+
+class TestProjectBuffer(unittest.TestCase):
+    """Test undo buffer of lazily loaded projects"""
+
+    def setUp(self):
+        self.source = os.path.join(
+            os.path.dirname(__file__), "..", "first_steps", "plc.xml")
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "plc.xml")
+        shutil.copy(self.source, self.filepath)
+        self.controller = PLCControler()
+        self.assertIsNone(self.controller.OpenXMLFile(self.filepath))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def GetSavedPou(self, name):
+        """Return POU as found in project file, loaded without lazy bodies"""
+        with open(self.filepath, "rb") as project_file:
+            self.assertNotIn(LAZY_BODY_PI.encode(), project_file.read())
+        project, _error = LoadProject(self.filepath)
+        return etree.tostring(project.getpou(name), method="c14n")
+
+    def testUndoAfterSave(self):
+        """Bodies put back by undo after a save are saved parsed"""
+        original, _error = LoadProject(self.source)
+        expected = etree.tostring(original.getpou("plc_prg"), method="c14n")
+
+        # saving parses all bodies of project
+        SaveProject(self.controller.Project, self.filepath)
+        self.controller.Project.getpou("plc_prg").setdescription("edited")
+        self.controller.BufferProject()
+        # undo puts back plc_prg as snapshotted before save
+        self.controller.LoadPrevious()
+        SaveProject(self.controller.Project, self.filepath)
+
+        self.assertEqual(self.GetSavedPou("plc_prg"), expected)
+
+    def testUndoParsesBodies(self):
+        """Bodies put back by undo are parsed"""
+        self.controller.Project.getpou("plc_prg").setdescription("edited")
+        self.controller.BufferProject()
+        self.controller.LoadPrevious()
+
+        pou = self.controller.Project.getpou("plc_prg")
+        self.assertNotIn(LAZY_BODY_PI.encode(), etree.tostring(pou))
+        self.assertEqual(pou.getdescription(), "")
+
+    def CheckUndo(self, edit):
+        """Check that undo reverts edit made on project"""
+        project = self.controller.Project
+        # undo parses bodies it puts back, compare with parsed bodies
+        MaterializeLazyBodies(project)
+        expected = etree.tostring(project, method="c14n")
+        edit(project)
+        self.controller.BufferProject()
+        self.assertNotEqual(
+            etree.tostring(self.controller.Project, method="c14n"), expected)
+        self.controller.LoadPrevious()
+        self.assertEqual(
+            etree.tostring(self.controller.Project, method="c14n"), expected)
+
+    def testUndoEditThroughList(self):
+        """Edit of an element got from list of project elements is undone"""
+        self.CheckUndo(
+            lambda project: project.getpous()[1].setdescription("edited"))
+
+    def testUndoEditThroughXPath(self):
+        """Edit of an element found by xpath is undone"""
+        def edit(project):
+            variable = project.xpath(
+                "//ppx:pou[@name='plc_prg']//ppx:variable",
+                namespaces={"ppx": "http://www.plcopen.org/xml/tc6_0201"})[0]
+            variable.set("name", "Renamed")
+        self.CheckUndo(edit)
+
+    def testUndoEditOfHeldElement(self):
+        """Edit of an element held since previous snapshot is undone"""
+        pou = self.controller.Project.getpou("plc_prg")
+        self.controller.Project.getpou("plc_prg").setdescription("first")
+        self.controller.BufferProject()
+        self.CheckUndo(lambda project: pou.setdescription("second"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Beremiz, a Integrated Development Environment for
+# programming IEC 61131-3 automates supporting plcopen standard and CanFestival.
+#
+# See COPYING file for copyrights details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import glob
+import os
+import unittest
+
+import conftest
+
+from plcopen.plcopen import LoadProject, CompilePattern
+from plcopen.ProjectSearchIndex import ProjectSearchIndex
+from plcopen.ProjectSnapshot import ProjectSnapshotStore
+
+
+TESTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "..")
+
+COUNTER_POUS = ["P::CounterST", "P::CounterFBD", "P::CounterSFC", "P::CounterLD"]
+
+
+class TestProjectSearchIndex(unittest.TestCase):
+    """Test indexed search and references in project"""
+
+    def LoadProject(self, name):
+        self.project, _error = LoadProject(
+            os.path.join(TESTS_DIRECTORY, name, "plc.xml"))
+        self.snapshots = ProjectSnapshotStore()
+        self.index = ProjectSearchIndex(self.snapshots)
+        self.index.Update(self.snapshots.Snapshot(self.project))
+
+    def UpdateIndex(self):
+        self.index.Update(self.snapshots.Snapshot(self.project))
+
+    def testSearch(self):
+        """Indexed search gives same results as project search"""
+        for filepath in sorted(glob.glob(os.path.join(TESTS_DIRECTORY, "*", "plc.xml"))):
+            self.LoadProject(os.path.basename(os.path.dirname(filepath)))
+            for find_pattern, regular_expression in [
+                    ("Reset", False), ("ount", False), ("NOT Reset", False),
+                    ("Cnt := Cnt", False), (":=", False), ("zzz", False),
+                    ("c.*r", True)]:
+                for case_sensitive in [False, True]:
+                    criteria = {"find_pattern": find_pattern,
+                                "case_sensitive": case_sensitive,
+                                "regular_expression": regular_expression,
+                                "filter": "all"}
+                    CompilePattern(criteria)
+                    self.assertEqual(self.index.Search(criteria),
+                                     self.project.Search(criteria))
+
+    def testFindReferences(self):
+        """References are found case insensitively, in project order"""
+        self.LoadProject("first_steps")
+        self.assertEqual(self.index.FindReferences("resetcountervalue"),
+                         COUNTER_POUS + ["R::config::resource1"])
+        self.assertEqual(self.index.FindReferences("CounterST"),
+                         ["P::plc_prg", "P::CounterST"])
+        self.assertEqual(self.index.FindReferences("Unknown"), [])
+
+    def testCommentsAreNotReferences(self):
+        """Words in comments and strings don't refer to identifiers"""
+        self.LoadProject("first_steps")
+        # graphical comment of plc_prg
+        self.assertEqual(self.index.FindReferences("functionality"), [])
+
+        pou = self.project.getpou("CounterST")
+        pou.settext(pou.gettext() + "\n(* AVCnt *) // Cnt1\nOut := 'Cnt2';")
+        self.UpdateIndex()
+        self.assertEqual(self.index.FindReferences("AVCnt"), ["P::plc_prg"])
+        self.assertEqual(self.index.FindReferences("Cnt1"),
+                         ["P::AverageVal", "P::plc_prg"])
+        self.assertEqual(self.index.FindReferences("Cnt2"),
+                         ["P::AverageVal", "P::plc_prg"])
+
+    def testRenameImpact(self):
+        """Rename impact gives whole word occurrences outside comments"""
+        self.LoadProject("first_steps")
+        pou = self.project.getpou("CounterST")
+        pou.settext(pou.gettext() + "\n(* Cnt *)")
+        self.UpdateIndex()
+
+        results = self.index.GetRenameImpact("cnt")
+        self.assertEqual(sorted(set([infos[0] for infos, _start, _end, _text in results])),
+                         sorted(COUNTER_POUS))
+        for infos, start, end, text in results:
+            self.assertNotIn("comment", infos)
+            self.assertEqual(start[0], end[0])
+            line = text.splitlines()[0]
+            self.assertEqual(line[start[1]:end[1] + 1], "Cnt")
+        # "Cnt" twice in the two last lines of CounterST body, not in comment
+        body_results = [(start, end) for infos, start, end, _text in results
+                        if infos == ("P::CounterST", "body", 0)]
+        self.assertEqual(body_results[-3:],
+                         [((3, 2), (3, 4)), ((3, 9), (3, 11)), ((6, 7), (6, 9))])
+
+    def testIncrementalUpdate(self):
+        """Index follows renamed identifier"""
+        self.LoadProject("first_steps")
+        self.project.updateElementName("ResetCounterValue", "InitValue")
+        for variable in self.project.xpath(
+                "//ppx:variable[@name='ResetCounterValue']",
+                namespaces={"ppx": "http://www.plcopen.org/xml/tc6_0201"}):
+            variable.set("name", "InitValue")
+        self.UpdateIndex()
+        self.assertEqual(self.index.FindReferences("ResetCounterValue"), [])
+        self.assertEqual(self.index.FindReferences("InitValue"),
+                         COUNTER_POUS + ["R::config::resource1"])
+        self.assertNotIn("RESETCOUNTERVALUE", self.index.Identifiers)
+        self.assertNotIn("RESETCOUNTERVALUE", self.index.Words)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -228,11 +228,21 @@ class ProcessLogger(object):
                 self.kill()
             self.finishsem.release()
 
+    def poll(self):
+        """
+        Non blocking alternative to spin() : returns True once process
+        finished, then result() gives the same as spin() would.
+        """
+        return self.finishsem.acquire(blocking=False)
+
     def spin(self):
-        while not self.finishsem.acquire(blocking=False) and (
+        while not self.poll() and (
                 not self._timeout or ((time.time() - self.startTime) * 1000) < self._timeout):
             eventLoop = wx.GUIEventLoop()
             eventLoop.Dispatch()
+        return self.result()
+
+    def result(self):
         try:
             return [self.exitcode, "".join([x.decode('gbk', errors='ignore') for x in self.outdata]),
                     "".join([x.decode('gbk', errors='ignore') for x in self.errdata])]
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Beremiz, a Integrated Development Environment for
+# programming IEC 61131-3 automates supporting plcopen standard and CanFestival.
+#
+# See COPYING file for copyrights details.
+
+
+import hashlib
+import json
+import os
+import sys
+from array import array
+
+# Bump when table layout changes, to invalidate persisted tables
+TABLE_VERSION = 2
+
+# describes CSV columns
+ProgramsListAttributeName = ["num", "C_path", "type"]
+VariablesListAttributeName = [
+    "num", "vartype", "IEC_path", "C_path", "type", "derived"]
+
+
+class VariablesTable(object):
+    """
+    Columnar table of programs and variables described in VARIABLES.csv
+    generated by IEC2C compiler.
+
+    Each variable is a row index in columns. Repeated strings (types,
+    vartypes, derived) are interned, IEC paths are indexed for O(1)
+    lookup.
+    """
+
+    def __init__(self):
+        self.Programs = []
+        self.Num = array('l')
+        self.VarType = []
+        self.IECPath = []
+        self.CPath = []
+        self.Type = []
+        self.Derived = []
+        # row -> debug index, -1 if variable can't be debugged
+        self.DebugIdx = array('l')
+        # debug index -> row
+        self.DebugRows = array('l')
+        self.Ticktime = 0
+        self._BuildIndexes()
+
+    def _BuildIndexes(self):
+        self._PathToRow = dict(zip(self.IECPath, range(len(self.IECPath))))
+
+    def __len__(self):
+        return len(self.IECPath)
+
+    def _ToColumns(self):
+        """
+        Return table content as plain lists, to be persisted as JSON
+        """
+        return {"programs": self.Programs,
+                "num": self.Num.tolist(),
+                "vartype": self.VarType,
+                "IEC_path": self.IECPath,
+                "C_path": self.CPath,
+                "type": self.Type,
+                "derived": self.Derived,
+                "debug_idx": self.DebugIdx.tolist(),
+                "debug_rows": self.DebugRows.tolist(),
+                "ticktime": self.Ticktime}
+
+    @classmethod
+    def _FromColumns(cls, columns):
+        table = cls()
+        table.Programs = columns["programs"]
+        table.Num = array('l', columns["num"])
+        # JSON doesn't preserve interning
+        table.VarType = list(map(sys.intern, columns["vartype"]))
+        table.IECPath = columns["IEC_path"]
+        table.CPath = columns["C_path"]
+        table.Type = list(map(sys.intern, columns["type"]))
+        table.Derived = list(map(sys.intern, columns["derived"]))
+        table.DebugIdx = array('l', columns["debug_idx"])
+        table.DebugRows = array('l', columns["debug_rows"])
+        table.Ticktime = int(columns["ticktime"])
+        if len(set(map(len, [table.Num, table.VarType, table.IECPath, table.CPath,
+                             table.Type, table.Derived, table.DebugIdx]))) != 1:
+            raise ValueError("Inconsistent variables table columns")
+        table._BuildIndexes()
+        return table
+
+    @classmethod
+    def Parse(cls, lines, debug_types):
+        """
+        Build table from VARIABLES.csv lines. Only variables whose type
+        is in debug_types get a debug index.
+        """
+        table = cls()
+
+        # Separate sections
+        ListGroup = []
+        for line in lines:
+            strippedline = line.strip()
+            if strippedline.startswith("//"):
+                # Start new section
+                ListGroup.append([])
+            elif len(strippedline) > 0 and len(ListGroup) > 0:
+                # append to this section
+                ListGroup[-1].append(strippedline)
+
+        # first section contains programs
+        for line in ListGroup[0]:
+            # Split and Maps each field to dictionnary entries
+            attrs = dict(
+                list(zip(ProgramsListAttributeName, line.split(';'))))
+            # Truncate "C_path" to remove conf an resources names
+            attrs["C_path"] = '__'.join(
+                attrs["C_path"].split(".", 2)[1:])
+            table.Programs.append(attrs)
+
+        # second section contains all variables
+        config_FBs = {}
+        Idx = 0
+        intern = sys.intern
+        no_debug = ("FB", "EXT", "TEMP")
+        DebugIdx = []
+        DebugRows = []
+        Num = []
+        VarType = table.VarType
+        IECPath = table.IECPath
+        CPath = table.CPath
+        Type = table.Type
+        Derived = table.Derived
+        for line in ListGroup[1]:
+            fields = line.split(';')
+            num, vartype, IEC_path, C_path, iectype = fields[:5]
+            derived = fields[5] if len(fields) > 5 else ""
+            # Truncate "C_path" to remove conf an resources names
+            parts = C_path.split(".", 2)
+            if len(parts) > 2:
+                config_FB = config_FBs.get(tuple(parts[:2]))
+                if config_FB:
+                    C_path = '.'.join([config_FB] + parts[2:])
+                else:
+                    C_path = '__'.join(parts[1:])
+            else:
+                C_path = '__'.join(parts)
+                if vartype == "FB":
+                    config_FBs[tuple(parts)] = C_path
+            if vartype not in no_debug and iectype in debug_types:
+                # Ignores numbers given in CSV file
+                # Count variables only, ignore FBs
+                DebugIdx.append(Idx)
+                DebugRows.append(len(IECPath))
+                Idx += 1
+            else:
+                DebugIdx.append(-1)
+            Num.append(int(num))
+            VarType.append(intern(vartype))
+            IECPath.append(IEC_path)
+            CPath.append(C_path)
+            Type.append(intern(iectype))
+            Derived.append(intern(derived))
+        table.Num = array('l', Num)
+        table.DebugIdx = array('l', DebugIdx)
+        table.DebugRows = array('l', DebugRows)
+
+        # third section contains ticktime
+        if len(ListGroup) > 2:
+            table.Ticktime = int(ListGroup[2][0])
+
+        table._BuildIndexes()
+        return table
+
+    @classmethod
+    def Load(cls, csvfile, debug_types):
+        """
+        Return table for given VARIABLES.csv, reusing table persisted
+        next to it if CSV didn't change since. CSV is only hashed when
+        its size or modification time changed. Persisted table is plain
+        JSON, as build directory content isn't trusted.
+        """
+        cachefile = csvfile + ".table"
+        st = os.stat(csvfile)
+        stamp = [st.st_mtime_ns, st.st_size]
+        debug_key = sorted(debug_types)
+        cached = None
+        try:
+            with open(cachefile, "r") as f:
+                cached = json.load(f)
+            if cached["version"] != TABLE_VERSION or \
+               cached["debug_types"] != debug_key:
+                cached = None
+            else:
+                cached["table"] = cls._FromColumns(cached["columns"])
+        except Exception:
+            cached = None
+
+        if cached is not None and cached["stamp"] == stamp:
+            return cached["table"]
+
+        with open(csvfile, "rb") as f:
+            content = f.read()
+        digest = hashlib.md5(content).hexdigest()
+        if cached is not None and cached["digest"] == digest:
+            table = cached["table"]
+        else:
+            table = cls.Parse(content.decode('utf-8').splitlines(), debug_types)
+
+        try:
+            with open(cachefile, "w") as f:
+                json.dump({"version": TABLE_VERSION,
+                           "debug_types": debug_key,
+                           "stamp": stamp,
+                           "digest": digest,
+                           "columns": table._ToColumns()}, f)
+        except (IOError, OSError):
+            pass
+        return table
+
+    def Row(self, row):
+        """
+        Return variable at given row as a dict, as VARIABLES.csv
+        parser used to
+        """
+        return {"num": str(self.Num[row]),
+                "vartype": self.VarType[row],
+                "IEC_path": self.IECPath[row],
+                "C_path": self.CPath[row],
+                "type": self.Type[row],
+                "derived": self.Derived[row]}
+
+    def Rows(self):
+        return [self.Row(row) for row in range(len(self))]
+
+    def DebugVariables(self):
+        return [self.Row(row) for row in self.DebugRows]
+
+    def GetDebugIdx(self, IECPath):
+        """
+        Return (debug index, IEC type) of given variable,
+        (None, None) if it doesn't exist or can't be debugged
+        """
+        row = self._PathToRow.get(IECPath)
+        if row is None or self.DebugIdx[row] < 0:
+            return None, None
+        return self.DebugIdx[row], self.Type[row]
+
+    def HasDebugVariable(self, IECPath):
+        row = self._PathToRow.get(IECPath)
+        return row is not None and self.DebugIdx[row] >= 0
+
+
+if __name__ == "__main__":
+    import tempfile
+    import timeit
+
+    # benchmark : 100k variables, old dict based parsing versus
+    # columnar table, parsed and persisted
+    debug_types = {"BOOL", "INT", "REAL"}
+    lines = ["// Programs", "0;CONFIG.RES.INST0;MAIN;", "",
+             "// Variables"]
+    for i in range(100000):
+        lines.append("%d;VAR;CONFIG.RES.INST0.FB%d.V%d;CONFIG.RES.INST0.FB%d.V%d;%s;" % (
+            i, i // 100, i, i // 100, i, ["BOOL", "INT", "REAL", "TIME"][i % 4]))
+    lines += ["", "// Ticktime", "10000000", ""]
+    tmpdir = tempfile.mkdtemp()
+    csvfile = os.path.join(tmpdir, "VARIABLES.csv")
+    with open(csvfile, "w") as f:
+        f.write("\n".join(lines))
+
+    def old_parse():
+        variables = []
+        IECPathToIdx = {}
+        Idx = 0
+        for line in open(csvfile, 'r', encoding='utf-8').readlines()[4:100004]:
+            attrs = dict(list(zip(VariablesListAttributeName, line.strip().split(';'))))
+            attrs["C_path"] = '__'.join(attrs["C_path"].split(".", 2)[1:])
+            if attrs["type"] in debug_types:
+                IECPathToIdx[attrs["IEC_path"]] = (Idx, attrs["type"])
+                Idx += 1
+            variables.append(attrs)
+        return variables, IECPathToIdx
+
+    table = VariablesTable.Load(csvfile, debug_types)
+    assert len(table) == 100000 and table.Ticktime == 10000000
+    assert table.GetDebugIdx("CONFIG.RES.INST0.FB0.V5") == (4, "INT")
+    assert table.GetDebugIdx("CONFIG.RES.INST0.FB0.V3") == (None, None)
+    assert table.CPath[5] == "RES__INST0.FB0.V5"
+    reloaded = VariablesTable.Load(csvfile, debug_types)
+    assert reloaded.Rows() == table.Rows() and list(reloaded.DebugRows) == list(table.DebugRows)
+    _vars, IECPathToIdx = old_parse()
+    assert all(table.GetDebugIdx(path) == idx for path, idx in IECPathToIdx.items())
+
+    for name, func in [
+            ("dict parse", old_parse),
+            ("table parse", lambda: VariablesTable.Parse(lines, debug_types)),
+            ("table load", lambda: VariablesTable.Load(csvfile, debug_types))]:
+        print("%-11s : %.1f ms" % (name, min(timeit.repeat(func, number=1, repeat=3)) * 1000))
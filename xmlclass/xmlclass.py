@@ -1848,6 +1848,10 @@ class XMLElementClassLookUp(etree.PythonElementClassLookup):
         :return:
             Returns element class corresponding to given element.
         """
+        if not isinstance(element.tag, str):
+            # comments and processing instructions use fallback
+            return None
+
         element_class = self.GetLookupResult(element)
         if element_class is not None:
             return element_class